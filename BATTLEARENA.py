@@ -1,8 +1,12 @@
 # client.py
 # Pygame client that auto-discovers the server via UDP beacon (port 5001)
 # Now supports shooting and uses server-assigned id to avoid drawing yourself twice.
-# Run: python client.py
+# Run: python client.py [--profile] [--trace frames.json]
 
+import argparse
+import collections
+import os
+import queue
 import socket
 import threading
 import json
@@ -10,25 +14,118 @@ import time
 import pygame as pg
 import random
 import math
+import struct
 import sys
+import zlib
 
 DISCOVERY_PORT = 5001
 TCP_PORT = 5000   # default if server announces different port
+DISCOVERY_LISTEN = 1.5   # after the first beacon keep listening this long to hear every server (beacons come every 1s)
+DISCOVERY_TIMEOUT = 4.0  # give up on beacons after this long
+SERVER_CACHE = os.path.join(os.path.expanduser("~"), ".pyarena_server")  # last server we played on
+CACHE_PROBE_TIMEOUT = 0.5  # connect timeout when trying the cached server
 UPDATE_FREQUENCY = 20.0  # sends updates ~20 times/sec
+USE_UDP = True           # ask for the UDP channel for updates/snapshots (falls back to TCP)
+USE_COMPRESSION = True   # ask for a zlib-compressed TCP stream (the server decides)
+USE_INPUT_COMMANDS = True  # send key presses for the server to simulate instead of our position
+USE_BULLET_EVENTS = True   # get bullets once when fired and simulate them here, not every snapshot
+UDP_HELLO_TRIES = 8      # UDP hellos sent before giving up on the UDP channel
+UDP_HELLO_INTERVAL = 0.25
+UDP_TIMEOUT = 2.0        # go back to TCP when no snapshot came over UDP for this long
+SNAPSHOT_HISTORY = 32    # received snapshots kept as delta baselines (matches the server)
+INTERP_DELAY = None      # draw other players and bullets this far (s) in the past; None = two snapshot intervals
+INTERP_BUFFER = 32       # timestamped snapshots kept for interpolation
+MAX_EXTRAPOLATION = 0.25 # when snapshots stop, keep things moving along their last velocity this long (s)
+TELEPORT_DIST = 120.0    # px between two snapshots that is a respawn, not movement
+RECV_CHUNK = 65536       # bytes read from a socket at a time
+SPRITE_CACHE_SIZE = 256  # pre-rendered player sprites kept (least recently drawn go first)
+PROFILE_HISTORY = 120    # frames shown in the profiler overlay (F3)
+PROFILE_REFRESH = 0.25   # seconds between updates of the overlay's numbers
+
+# wire protocols (see arenatoken.py). We offer them in this order in "join";
+# the server picks one and names it in "join_ack".
+PROTO_JSON = 0
+PROTO_BINARY = 1
+WIRE_PROTOCOLS = [PROTO_BINARY, PROTO_JSON]
+POS_SCALE = 8.0
+FRAME_HDR = struct.Struct("<I")
+S_PLAYER_INFO = 1
+S_STATE = 2
+C_UPDATE = 16
+C_SHOOT = 17
+C_ACK = 18
+C_QUIT = 19
+C_UDP_OK = 20
+C_UPDATE_SEQ = 21
+PLAYER_INFO_HDR = struct.Struct("<BIBBBB")
+STATE_HDR = struct.Struct("<BIIdHHHH")
+PLAYER_REC = struct.Struct("<IhhBH")
+BULLET_REC = struct.Struct("<IhhI")
+BULLET_SPAWN_REC = struct.Struct("<IhhhhdI")  # id, x, y, vx, vy, server time at x/y, owner
+BULLET_TTL = 2.5         # s, as the server has it; a bullet whose removal we missed stops here
+ID_REC = struct.Struct("<I")
+UPDATE_REC = struct.Struct("<Bhh")
+SHOOT_REC = struct.Struct("<Bff")
+ACK_REC = struct.Struct("<BI")
+UPDATE_SEQ_REC = struct.Struct("<BIhh")
+C_INPUT = 22
+S_INPUT_ACK = 3
+INPUT_HDR = struct.Struct("<BIB")
+INPUT_CMD = struct.Struct("<BH")
+INPUT_ACK_REC = struct.Struct("<BIff")
+MAX_INPUT_CMDS = 16      # commands per input message (matches the server)
+MAX_INPUT_MS = 250
+KEY_UP, KEY_DOWN, KEY_LEFT, KEY_RIGHT = 1, 2, 4, 8
+PLAYER_SPEED = 200.0     # pixels per second, as the server simulates it
+PLAYER_BOUNDS = (10, 10, 790, 590)
+COMPRESS_ZLIB = "zlib2"  # must match the server's
 
 # networking state
 server_addr = None  # tuple (ip, port)
 tcp_sock = None
+send_lock = threading.Lock()  # the recv thread sends acks on the same socket
 recv_thread_running = False
-players = {}       # pid -> {name, x, y, color, hp}
-players_lock = threading.Lock()
-bullets = []       # list of bullet dicts {id,x,y,owner}
-bullets_lock = threading.Lock()
+players = {}       # pid -> {name, x, y, color, hp}; replaced by each snapshot, never modified
+bullets = []       # list of bullet rows [id, x, y, owner]; replaced the same way
+bullet_events = False  # server sends bullet spawn rows [id, x, y, vx, vy, time, owner] instead of positions
 my_id = None
+wire_proto = PROTO_JSON
+player_info = {}   # pid -> (name, color), static data from S_PLAYER_INFO frames
+udp_sock = None    # connected UDP socket once the server offered the UDP channel
+udp_active = False # UDP hello answered; updates and acks go over UDP
+last_udp_rx = 0.0  # time the last snapshot arrived over UDP
+update_seq = 0
+state_lock = threading.Lock()  # snapshots arrive on both the TCP and UDP threads
+snapshot_history = {}  # seq -> (players, bullets_by_id) of recent snapshots
+last_state_seq = 0
+interp_snapshots = collections.deque(maxlen=INTERP_BUFFER)  # (server time, players, bullets_by_id), oldest first
+clock_offset = None        # local time - server time, from the least delayed snapshots
+snapshot_interval = 0.05   # smoothed server time between snapshots
+arrival_gap = 0.0          # smoothed local time between snapshot arrivals
+arrival_jitter = 0.0       # smoothed |arrival gap - server send gap| (RFC 3550 style)
+last_arrival = None        # (perf_counter, server time) of the newest snapshot
+snapshot_arrivals = collections.deque(maxlen=256)  # (perf_counter, seq) for the trace, drained by the render loop
+state_lock_wait = 0.0      # seconds the last interpolated_state() waited for state_lock
+
+# renderer state, only touched by the pygame loop
+sprite_cache = collections.OrderedDict()  # (name, color, hp bar fill px, is us) -> (surface, center x, center y)
+sprite_keys = {}  # pid -> cache keys drawn for that player, dropped when it leaves
+input_mode = False         # server agreed to simulate our input commands
+input_lock = threading.Lock()
+pending_inputs = collections.deque()  # (seq, keys, ms) sent but not acknowledged yet, oldest first
+input_seq = 0              # seq of the last command made
+input_acked = 0            # last command the server applied
+input_base = None          # (x, y) the server had us at after input_acked
 
-def discover_server(timeout=4.0):
+def discover_servers(timeout=4.0, listen=DISCOVERY_LISTEN):
+    # -> {(host, port): latest announce} of every server heard: wait up to
+    # timeout for a first beacon, then listen for the others a little longer
+    servers = {}
     udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        # every client on this machine hears the beacons, not just the first
+        udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     try:
         udp.bind(('', DISCOVERY_PORT))
     except Exception:
@@ -36,200 +133,898 @@ def discover_server(timeout=4.0):
             udp.bind(('0.0.0.0', DISCOVERY_PORT))
         except Exception:
             udp.close()
-            return None
-    udp.settimeout(timeout)
-    start = time.time()
+            return servers
+    end = time.time() + timeout
     try:
         while True:
+            left = end - time.time()
+            if left <= 0:
+                return servers
+            udp.settimeout(left)
             try:
                 data, addr = udp.recvfrom(4096)
             except socket.timeout:
-                return None
+                return servers
             try:
                 msg = json.loads(data.decode('utf-8', errors='ignore'))
                 if msg.get("type") == "server_announce":
                     host = msg.get("host") or addr[0]
                     port = int(msg.get("tcp_port", TCP_PORT))
-                    return (host, port)
+                    if not servers:
+                        end = min(end, time.time() + listen)
+                    servers[(host, port)] = msg
             except Exception:
                 pass
-            if time.time() - start > timeout:
-                return None
     finally:
         udp.close()
 
-def tcp_recv_loop(sock):
-    global recv_thread_running, my_id
+def server_load(msg):
+    # sort key for an announce: healthy servers with room first, then the
+    # emptiest. Servers that do not report load count as healthy and empty
+    players = msg.get("players", 0)
+    capacity = msg.get("capacity") or 0
+    full = bool(capacity) and players >= capacity
+    return (msg.get("healthy", True) is False, full, players / capacity if capacity else 0.0, players)
+
+def pick_server(servers):
+    # (host, port) of the least loaded server heard, or None
+    if not servers:
+        return None
+    return min(servers, key=lambda addr: server_load(servers[addr]))
+
+def load_cached_server():
+    try:
+        with open(SERVER_CACHE) as f:
+            entry = json.load(f)
+        return entry["host"], int(entry["port"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def save_cached_server(addr):
+    try:
+        with open(SERVER_CACHE, "w") as f:
+            json.dump({"host": addr[0], "port": addr[1]}, f)
+    except OSError:
+        pass
+
+def find_servers():
+    # look for a server in the background: listen for beacons and try the
+    # cached server at the same time. Each path puts one result on the
+    # returned queue: ("beacons", {addr: announce}) and ("cached", addr, sock)
+    # where sock is already connected, or None
+    found = queue.Queue()
+    def listen():
+        found.put(("beacons", discover_servers(DISCOVERY_TIMEOUT)))
+    def probe():
+        addr = load_cached_server()
+        sock = None
+        if addr is not None:
+            try:
+                sock = socket.create_connection(addr, timeout=CACHE_PROBE_TIMEOUT)
+            except OSError:
+                sock = None
+        found.put(("cached", addr, sock))
+    threading.Thread(target=listen, daemon=True).start()
+    threading.Thread(target=probe, daemon=True).start()
+    return found
+
+def wait_for_server(found, deadline):
+    # -> (servers heard, (host, port) to use or None, connected socket or None).
+    # Beacons win when they are in (they know the load), otherwise the
+    # cached server as soon as it answers; waits until deadline at most
+    servers, cached, sock = {}, None, None
+    pending = 2
+    while pending:
+        try:
+            res = found.get(block=cached is None, timeout=max(0.0, deadline - time.time()))
+        except queue.Empty:
+            break
+        pending -= 1
+        if res[0] == "beacons":
+            servers = res[1]
+        elif res[2] is not None:
+            cached, sock = res[1], res[2]
+        if servers:
+            break
+    best = pick_server(servers)
+    if best is None and cached is not None:
+        return servers, cached, sock
+    if sock is not None and best != cached:
+        sock.close()
+        sock = None
+    return servers, best, sock
+
+def apply_state(msg, base):
+    # rebuild the full (players, bullets_by_id) state for a state message.
+    # Delta messages are applied on top of base, the snapshot they name
+    if base is None:
+        new_players = {}
+        new_bullets = {}
+    else:
+        new_players = dict(base[0])
+        new_bullets = dict(base[1])
+        for pid in msg.get("removed", []):
+            new_players.pop(pid, None)
+        for bid in msg.get("bullets_removed", []):
+            new_bullets.pop(bid, None)
+    for pid, p in msg.get("players", {}).items():
+        new_players[pid] = {"name": p.get("name","?"), "x": float(p.get("x",0)), "y": float(p.get("y",0)), "color": p.get("color",[255,0,0]), "hp": p.get("hp",100)}
+    for row in msg.get("bullets", []):
+        new_bullets[row[0]] = row
+    return new_players, new_bullets
+
+def decode_server_frame(body):
+    # binary server frame -> the same dict the JSON protocol would have carried
+    mtype = body[0]
+    if mtype == S_PLAYER_INFO:
+        _, pid, r, g, b, n = PLAYER_INFO_HDR.unpack_from(body)
+        start = PLAYER_INFO_HDR.size
+        player_info[str(pid)] = (bytes(body[start:start + n]).decode('utf-8', errors='replace'), [r, g, b])
+        return None
+    if mtype == S_INPUT_ACK:
+        _, seq, x, y = INPUT_ACK_REC.unpack_from(body)
+        return {"type": "input_ack", "seq": seq, "x": x, "y": y}
+    if mtype != S_STATE:
+        return None
+    _, seq, base, t, n_players, n_removed, n_bullets, n_bremoved = STATE_HDR.unpack_from(body)
+    off = STATE_HDR.size
+    pmap = {}
+    end = off + n_players * PLAYER_REC.size
+    for pid, x, y, hp, kills in PLAYER_REC.iter_unpack(body[off:end]):
+        # name/color stay None: they come from player_info at draw time, since
+        # the S_PLAYER_INFO frame (TCP) may arrive after a UDP snapshot
+        pmap[str(pid)] = {"name": None, "x": x / POS_SCALE, "y": y / POS_SCALE, "color": None, "hp": hp, "kills": kills}
+    off, end = end, end + n_removed * ID_REC.size
+    removed = [str(pid) for pid, in ID_REC.iter_unpack(body[off:end])]
+    if bullet_events:
+        off, end = end, end + n_bullets * BULLET_SPAWN_REC.size
+        blist = [(bid, x / POS_SCALE, y / POS_SCALE, vx / POS_SCALE, vy / POS_SCALE, t, owner)
+                 for bid, x, y, vx, vy, t, owner in BULLET_SPAWN_REC.iter_unpack(body[off:end])]
+    else:
+        off, end = end, end + n_bullets * BULLET_REC.size
+        blist = [(bid, x / POS_SCALE, y / POS_SCALE, owner) for bid, x, y, owner in BULLET_REC.iter_unpack(body[off:end])]
+    off, end = end, end + n_bremoved * ID_REC.size
+    bremoved = [bid for bid, in ID_REC.iter_unpack(body[off:end])]
+    msg = {"type": "state", "seq": seq, "players": pmap, "removed": removed, "bullets": blist,
+           "bullets_removed": bremoved, "time": t}
+    if base:
+        msg["base"] = base
+    return msg
+
+def handle_state(sock, msg):
+    # apply a state message from either channel and ack it. The new state is
+    # built without holding a lock (snapshots are never modified once made)
+    # and then swapped in, so the render loop never waits for a parse
+    global last_state_seq, players, bullets
+    seq = msg.get("seq")
+    base_seq = msg.get("base")
+    with state_lock:
+        if seq is not None and seq <= last_state_seq:
+            return  # stale or duplicate (UDP)
+        base = None if base_seq is None else snapshot_history.get(base_seq)
+    if base_seq is not None and base is None:
+        return  # baseline no longer kept
+    try:
+        state = apply_state(msg, base)
+    except Exception:
+        return
+    new_players, new_bullets = state
+    with state_lock:
+        if seq is not None and seq <= last_state_seq:
+            return  # the other channel delivered it meanwhile
+        players = new_players
+        bullets = list(new_bullets.values())
+        buffer_snapshot(msg.get("time"), new_players, new_bullets)
+        if seq is None:
+            return
+        last_state_seq = seq
+        snapshot_history[seq] = state
+        for old in [s for s in snapshot_history if s <= seq - SNAPSHOT_HISTORY]:
+            del snapshot_history[old]
+    send_msg(sock, {"type":"ack", "seq": seq})
+
+def move_by_keys(x, y, keys, dt):
+    # same arithmetic as the server's move_by_keys, so predictions agree
+    dx = dy = 0.0
+    if keys & KEY_UP:
+        dy -= 1
+    if keys & KEY_DOWN:
+        dy += 1
+    if keys & KEY_LEFT:
+        dx -= 1
+    if keys & KEY_RIGHT:
+        dx += 1
+    if dx != 0 and dy != 0:
+        mul = (2**0.5)/2.0
+        dx *= mul
+        dy *= mul
+    x0, y0, x1, y1 = PLAYER_BOUNDS
+    return max(x0, min(x1, x + dx * PLAYER_SPEED * dt)), max(y0, min(y1, y + dy * PLAYER_SPEED * dt))
+
+def handle_input_ack(msg):
+    # reconcile: the server's position after command seq becomes the new
+    # base and only the commands after it are still predicted. The same seq
+    # can come again with a new position (respawn)
+    global input_acked, input_base
+    try:
+        seq, x, y = int(msg["seq"]), float(msg["x"]), float(msg["y"])
+    except Exception:
+        return
+    with input_lock:
+        if seq < input_acked:
+            return  # older ack, reordered on UDP
+        input_acked = seq
+        input_base = (x, y)
+        while pending_inputs and pending_inputs[0][0] <= seq:
+            pending_inputs.popleft()
+
+def predicted_position(keys, dt):
+    # where we are: the acknowledged position with the unacknowledged
+    # commands and the one still being held (keys for dt) replayed on top
+    with input_lock:
+        if input_base is None:
+            return None
+        x, y = input_base
+        for _, k, ms in pending_inputs:
+            x, y = move_by_keys(x, y, k, ms / 1000.0)
+    return move_by_keys(x, y, keys, dt)
+
+def buffer_snapshot(t, new_players, new_bullets):
+    # keep a snapshot for interpolation, stamped with the server's send time;
+    # call with state_lock held
+    global clock_offset, snapshot_interval, arrival_gap, arrival_jitter, last_arrival
+    if t is None:
+        return
+    t = float(t)
+    if interp_snapshots and t <= interp_snapshots[-1][0]:
+        return
+    arrived = time.perf_counter()
+    if last_arrival is not None:
+        gap = arrived - last_arrival[0]
+        arrival_gap += (gap - arrival_gap) * 0.1
+        arrival_jitter += (abs(gap - (t - last_arrival[1])) - arrival_jitter) / 16
+    last_arrival = (arrived, t)
+    snapshot_arrivals.append((arrived, t))
+    offset = time.time() - t
+    if clock_offset is None or offset < clock_offset:
+        clock_offset = offset
+    else:
+        # creep up slowly, so clock drift or a slower route do not leave us behind
+        clock_offset += (offset - clock_offset) * 0.01
+    if interp_snapshots:
+        dt = t - interp_snapshots[-1][0]
+        if dt < 1.0:
+            snapshot_interval += (dt - snapshot_interval) * 0.1
+    interp_snapshots.append((t, new_players, new_bullets))
+
+def lerp_pos(ax, ay, bx, by, f):
+    if abs(bx - ax) + abs(by - ay) > TELEPORT_DIST:
+        return bx, by
+    return ax + (bx - ax) * f, ay + (by - ay) * f
+
+def simulated_bullets(rows, t):
+    # bullet events: where the bullets fired by server time t are at t
+    out = []
+    for bid, x, y, vx, vy, t0, owner in rows:
+        age = t - t0
+        if -0.05 <= age <= BULLET_TTL:
+            # slightly negative: fired in the tick we are drawing
+            age = max(0.0, age)
+            out.append((bid, x + vx * age, y + vy * age, owner))
+    return out
+
+def interpolated_state(now):
+    # -> (players, bullet rows) as the server had them a short delay ago,
+    # blended between the two snapshots around that moment; past the newest
+    # snapshot, extrapolated for up to MAX_EXTRAPOLATION
+    global state_lock_wait
+    t0 = time.perf_counter()
+    with state_lock:
+        state_lock_wait = time.perf_counter() - t0
+        snaps = list(interp_snapshots)
+        offset, interval = clock_offset, snapshot_interval
+    if not snaps:
+        return {}, []
+    delay = INTERP_DELAY if INTERP_DELAY is not None else 2 * interval
+    t = now - offset - delay
+    if len(snaps) == 1 or t <= snaps[0][0]:
+        if bullet_events:
+            return snaps[0][1], simulated_bullets(snaps[0][2].values(), t)
+        return snaps[0][1], list(snaps[0][2].values())
+    if t >= snaps[-1][0]:
+        a, b = snaps[-2], snaps[-1]
+        t = min(t, b[0] + MAX_EXTRAPOLATION)
+    else:
+        k = len(snaps) - 2
+        while snaps[k][0] > t:
+            k -= 1
+        a, b = snaps[k], snaps[k + 1]
+    f = (t - a[0]) / (b[0] - a[0])
+    view_players = {}
+    for pid, p in b[1].items():
+        q = a[1].get(pid)
+        if q is not None:
+            p = dict(p)
+            p["x"], p["y"] = lerp_pos(q["x"], q["y"], p["x"], p["y"], f)
+        view_players[pid] = p
+    if bullet_events:
+        # bullets of the newer snapshot (the older one may hold ones since removed)
+        return view_players, simulated_bullets(b[2].values(), t)
+    view_bullets = []
+    for bid, row in b[2].items():
+        old = a[2].get(bid)
+        if old is not None:
+            x, y = lerp_pos(old[1], old[2], row[1], row[2], f)
+            row = (bid, x, y, row[3])
+        view_bullets.append(row)
+    return view_players, view_bullets
+
+def tcp_recv_loop(sock, buf=b"", inflate=None):
+    # buf: whatever arrived after the join_ack line; inflate: decompressobj
+    # when the server agreed to compress the stream. Reads go straight into
+    # one chunk buffer; frames are parsed where they lie in buf and the
+    # consumed bytes are cut off once per read, not once per frame
+    global recv_thread_running
     recv_thread_running = True
-    buf = ""
+    chunk = bytearray(RECV_CHUNK)
+    view = memoryview(chunk)
+    buf = bytearray(inflate.decompress(buf) if inflate is not None else buf)
     try:
         while True:
+            msgs = []
+            pos = 0
+            if wire_proto == PROTO_BINARY:
+                with memoryview(buf) as mv:
+                    while len(buf) - pos >= FRAME_HDR.size:
+                        n, = FRAME_HDR.unpack_from(buf, pos)
+                        end = pos + FRAME_HDR.size + n
+                        if len(buf) < end:
+                            break
+                        try:
+                            msg = decode_server_frame(mv[pos + FRAME_HDR.size:end])
+                        except Exception:
+                            msg = None
+                        pos = end
+                        if msg is not None:
+                            msgs.append(msg)
+            else:
+                while True:
+                    nl = buf.find(b'\n', pos)
+                    if nl < 0:
+                        break
+                    line = buf[pos:nl].strip()
+                    pos = nl + 1
+                    if not line:
+                        continue
+                    try:
+                        msgs.append(json.loads(line))
+                    except Exception:
+                        continue
+            del buf[:pos]
+            for msg in msgs:
+                if msg.get("type") == "state":
+                    handle_state(sock, msg)
+                elif msg.get("type") == "input_ack":
+                    handle_input_ack(msg)
             try:
-                data = sock.recv(4096)
+                n = sock.recv_into(chunk)
             except Exception:
                 break
-            if not data:
+            if not n:
                 break
-            buf += data.decode('utf-8', errors='ignore')
-            while '\n' in buf:
-                line, buf = buf.split('\n', 1)
-                if not line.strip():
-                    continue
+            if inflate is not None:
                 try:
-                    msg = json.loads(line.strip())
-                except Exception:
-                    continue
-                mtype = msg.get("type")
-                if mtype == "state":
-                    with players_lock:
-                        players.clear()
-                        pmap = msg.get("players", {})
-                        for pid, p in pmap.items():
-                            players[pid] = {"name": p.get("name","?"), "x": float(p.get("x",0)), "y": float(p.get("y",0)), "color": p.get("color",[255,0,0]), "hp": p.get("hp",100)}
-                    with bullets_lock:
-                        bullets[:] = msg.get("bullets", [])
-                elif mtype == "join_ack":
-                    my_id = str(msg.get("id"))
-                    print("Assigned id:", my_id)
+                    buf += inflate.decompress(view[:n])
+                except zlib.error:
+                    break
+            else:
+                buf += view[:n]
     finally:
         recv_thread_running = False
 
+def udp_recv_loop(usock, sock, token):
+    # open the UDP channel (hello until the server answers), then receive
+    # snapshots on it. If nothing answers we simply stay on TCP.
+    global udp_active, last_udp_rx
+    hello = json.dumps({"type":"udp_hello", "id": my_id, "token": token}).encode('utf-8')
+    usock.settimeout(UDP_HELLO_INTERVAL)
+    for _ in range(UDP_HELLO_TRIES):
+        try:
+            usock.send(hello)
+            data = usock.recv(65536)
+        except socket.timeout:
+            continue
+        except OSError:
+            break
+        try:
+            if json.loads(data).get("type") == "udp_ack":
+                break
+        except Exception:
+            continue
+    else:
+        print("No answer on the UDP channel, staying on TCP.")
+        return
+    usock.settimeout(None)
+    last_udp_rx = time.time()
+    udp_active = True
+    send_msg(sock, {"type":"udp_ok"})
+    print("UDP channel open.")
+    chunk = bytearray(RECV_CHUNK)
+    view = memoryview(chunk)
+    while True:
+        try:
+            n = usock.recv_into(chunk)
+        except OSError:
+            break
+        try:
+            if wire_proto == PROTO_BINARY:
+                msg = decode_server_frame(view[FRAME_HDR.size:n])
+            else:
+                msg = json.loads(chunk[:n])
+        except Exception:
+            continue
+        if msg is None:
+            continue
+        if msg.get("type") == "state":
+            last_udp_rx = time.time()
+            handle_state(sock, msg)
+        elif msg.get("type") == "input_ack":
+            handle_input_ack(msg)
+
 def send_json(sock, obj):
     try:
-        sock.sendall((json.dumps(obj) + '\n').encode('utf-8'))
+        data = (json.dumps(obj) + '\n').encode('utf-8')
+        with send_lock:
+            sock.sendall(data)
+        return True
+    except Exception:
+        return False
+
+def quantize(v):
+    return max(-32768, min(32767, int(round(v * POS_SCALE))))
+
+def encode_client_msg(obj):
+    mtype = obj.get("type")
+    if mtype == "update" and "seq" in obj:
+        body = UPDATE_SEQ_REC.pack(C_UPDATE_SEQ, obj["seq"], quantize(obj["x"]), quantize(obj["y"]))
+    elif mtype == "update":
+        body = UPDATE_REC.pack(C_UPDATE, quantize(obj["x"]), quantize(obj["y"]))
+    elif mtype == "input":
+        cmds = obj["cmds"]
+        body = INPUT_HDR.pack(C_INPUT, obj["seq"], len(cmds)) + b"".join(INPUT_CMD.pack(k, ms) for k, ms in cmds)
+    elif mtype == "shoot":
+        body = SHOOT_REC.pack(C_SHOOT, obj["dx"], obj["dy"])
+    elif mtype == "ack":
+        body = ACK_REC.pack(C_ACK, obj["seq"])
+    elif mtype == "quit":
+        body = bytes([C_QUIT])
+    elif mtype == "udp_ok":
+        body = bytes([C_UDP_OK])
+    else:
+        return None
+    return FRAME_HDR.pack(len(body)) + body
+
+def send_msg(sock, obj):
+    # send a game message in whichever protocol the server picked at join.
+    # Updates, inputs and acks take the UDP channel while it is healthy.
+    global udp_active, update_seq
+    mtype = obj.get("type")
+    if udp_active and mtype in ("update", "input", "ack"):
+        if time.time() - last_udp_rx > UDP_TIMEOUT:
+            # server has not reached us over UDP for a while, it is back on TCP
+            udp_active = False
+            print("UDP channel timed out, falling back to TCP.")
+        else:
+            if mtype == "update":
+                update_seq += 1
+                obj = dict(obj, seq=update_seq)
+            try:
+                if wire_proto == PROTO_BINARY:
+                    data = encode_client_msg(obj)
+                else:
+                    data = json.dumps(obj).encode('utf-8')
+                udp_sock.send(data)
+                return True
+            except Exception:
+                return False
+    if wire_proto != PROTO_BINARY:
+        return send_json(sock, obj)
+    try:
+        data = encode_client_msg(obj)
+        if data is None:
+            return False
+        with send_lock:
+            sock.sendall(data)
         return True
     except Exception:
         return False
 
-def start_network_connection(host, port, name, color):
-    global tcp_sock
-    tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    tcp_sock.settimeout(5.0)
-    tcp_sock.connect((host, port))
+def flush_inputs(sock, keys, ms, resend):
+    # turn ms of holding keys into a command (nothing for standing still) and
+    # send it. Over UDP every unacknowledged command goes again, so a lost
+    # datagram is covered by the next one; resend repeats them with nothing new
+    global input_seq
+    with input_lock:
+        new = []
+        while keys and ms > 0:
+            input_seq += 1
+            cmd = (input_seq, keys, min(ms, MAX_INPUT_MS))
+            pending_inputs.append(cmd)
+            new.append(cmd)
+            ms -= cmd[2]
+        cmds = list(pending_inputs)[-MAX_INPUT_CMDS:] if udp_active else new
+    if not new and not (resend and udp_active and cmds):
+        return
+    send_msg(sock, {"type":"input", "seq": cmds[0][0], "cmds": [[k, ms] for _, k, ms in cmds[:MAX_INPUT_CMDS]]})
+
+def join_server(sock, name, color):
+    # send join and wait for join_ack: it names the protocol for everything
+    # after it. -> (ack, bytes that came after it)
+    join = {"type":"join", "name": name, "color": color, "protocols": WIRE_PROTOCOLS, "udp": USE_UDP}
+    if USE_COMPRESSION:
+        join["compress"] = [COMPRESS_ZLIB]
+    if USE_INPUT_COMMANDS:
+        join["inputs"] = 1
+    if USE_BULLET_EVENTS:
+        join["bullet_events"] = 1
+    if not send_json(sock, join):
+        raise ConnectionError("could not send join")
+    buf = b""
+    while b'\n' not in buf:
+        data = sock.recv(4096)
+        if not data:
+            raise ConnectionError("server closed the connection during join")
+        buf += data
+    line, buf = buf.split(b'\n', 1)
+    return json.loads(line), buf
+
+def start_network_connection(host, port, name, color, sock=None):
+    # sock: a connection to (host, port) made earlier, e.g. by find_servers
+    global tcp_sock, my_id, wire_proto, udp_sock, input_mode, bullet_events
+    ack = None
+    if sock is not None:
+        sock.settimeout(5.0)
+        try:
+            ack, buf = join_server(sock, name, color)
+        except (OSError, ValueError):
+            # idle too long (servers drop connections that do not join), connect again
+            sock.close()
+    if ack is None:
+        sock = socket.create_connection((host, port), timeout=5.0)
+        ack, buf = join_server(sock, name, color)
+    tcp_sock = sock
+    my_id = str(ack.get("id"))
+    wire_proto = ack.get("proto", PROTO_JSON)
+    input_mode = bool(ack.get("inputs"))
+    bullet_events = bool(ack.get("bullet_events"))
+    inflate = None
+    if ack.get("compress") == COMPRESS_ZLIB:
+        inflate = zlib.decompressobj()
+    print("Assigned id:", my_id, "protocol:", ("binary" if wire_proto == PROTO_BINARY else "json")
+          + (", compressed" if inflate else "") + (", input commands" if input_mode else "")
+          + (", bullet events" if bullet_events else ""))
     tcp_sock.settimeout(None)
-    join = {"type":"join", "name": name, "color": color}
-    send_json(tcp_sock, join)
-    t = threading.Thread(target=tcp_recv_loop, args=(tcp_sock,), daemon=True)
+    t = threading.Thread(target=tcp_recv_loop, args=(tcp_sock, buf, inflate), daemon=True)
     t.start()
+    if ack.get("udp_port"):
+        try:
+            udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp_sock.connect((host, int(ack["udp_port"])))
+        except OSError as e:
+            print("UDP channel unavailable:", e)
+        else:
+            u = threading.Thread(target=udp_recv_loop, args=(udp_sock, tcp_sock, ack.get("udp_token")), daemon=True)
+            u.start()
     return tcp_sock
 
 # ----------------- Pygame client (arena + shooting) -----------------
-def run_game(sock, name, color):
+def render_player_sprite(font, name, color, fill, me):
+    # circle, name tag and hp bar on one transparent surface
+    bar_w, bar_h = (36, 8) if me else (32, 6)
+    name_surf = font.render(name, True, (240,240,240))
+    w = max(name_surf.get_width(), bar_w, 32)
+    cx, cy = w // 2, 24
+    surf = pg.Surface((w, cy + 18 + bar_h), pg.SRCALPHA)
+    pg.draw.circle(surf, color, (cx, cy), 16)
+    surf.blit(name_surf, (cx - name_surf.get_width()//2, 0))
+    pg.draw.rect(surf, (60,60,60), (cx - bar_w//2, cy + 18, bar_w, bar_h))
+    pg.draw.rect(surf, (200,30,30), (cx - bar_w//2, cy + 18, fill, bar_h))
+    return surf.convert_alpha(), cx, cy
+
+def player_sprite(font, pid, name, color, hp, me=False):
+    # cached sprite for a player; the hp bar is bucketed by the pixels it fills
+    fill = int((36 if me else 32) * (max(0, min(100, hp)) / 100.0))
+    key = (name, tuple(color), fill, me)
+    sprite = sprite_cache.get(key)
+    if sprite is not None:
+        sprite_cache.move_to_end(key)
+        return sprite
+    sprite = sprite_cache[key] = render_player_sprite(font, name, [int(c) for c in color], fill, me)
+    sprite_keys.setdefault(pid, set()).add(key)
+    if len(sprite_cache) > SPRITE_CACHE_SIZE:
+        sprite_cache.popitem(last=False)
+    return sprite
+
+def forget_sprites(present):
+    # drop the sprites of players no longer in the game
+    for pid in sprite_keys.keys() - present:
+        for key in sprite_keys.pop(pid):
+            sprite_cache.pop(key, None)
+
+class FrameProfiler:
+    # where each frame of run_game goes: per-phase times for the F3 overlay
+    # and, with --trace, a CSV or Chrome trace (chrome://tracing, Perfetto)
+    # of every frame and snapshot arrival
+    PHASES = ("events", "input", "lock", "draw", "flip")
+    COLORS = {"events": (90,160,240), "input": (120,220,120), "lock": (240,80,80),
+              "draw": (240,200,60), "flip": (200,120,240)}
+
+    def __init__(self, trace_path=None, show=False):
+        self.show = show
+        self.frames = collections.deque(maxlen=PROFILE_HISTORY)  # (idle, {phase: seconds})
+        self.origin = time.perf_counter()
+        self.last = self.origin
+        self.lock_time = 0.0
+        self.cur = None
+        self.start = 0.0
+        self.idle = 0.0
+        self.n = 0
+        self.lines = []
+        self.refreshed = 0.0
+        self.trace = None
+        self.chrome = False
+        if trace_path:
+            self.chrome = trace_path.endswith(".json")
+            self.trace = open(trace_path, "w")
+            if self.chrome:
+                # array format; the closing bracket is optional, so a crash still leaves a readable file
+                self.trace.write('[\n')
+            else:
+                self.trace.write("frame,time_ms,idle_ms," + ",".join(p + "_ms" for p in self.PHASES)
+                                 + ",arrival_gap_ms,jitter_ms,clock_offset_ms\n")
+
+    def begin(self):
+        now = time.perf_counter()
+        self.idle = now - self.last
+        self.start = self.last = now
+        self.cur = dict.fromkeys(self.PHASES, 0.0)
+
+    def waited(self, seconds):
+        # lock wait inside the running phase, counted as "lock" instead
+        self.cur["lock"] += seconds
+        self.lock_time += seconds
+
+    def mark(self, phase):
+        # time since the previous mark goes to phase
+        now = time.perf_counter()
+        self.cur[phase] += now - self.last - self.lock_time
+        self.last = now
+        self.lock_time = 0.0
+
+    def end(self):
+        self.n += 1
+        self.frames.append((self.idle, self.cur))
+        if self.trace is not None:
+            self.write_frame()
+
+    def write_frame(self):
+        offset = (clock_offset or 0.0) * 1000
+        if not self.chrome:
+            cols = [self.n, (self.start - self.origin) * 1000, self.idle * 1000]
+            cols += [self.cur[p] * 1000 for p in self.PHASES]
+            cols += [arrival_gap * 1000, arrival_jitter * 1000, offset]
+            self.trace.write(",".join(f"{c:.3f}" if isinstance(c, float) else str(c) for c in cols) + "\n")
+            return
+        events = []
+        ts = (self.start - self.origin) * 1e6
+        events.append({"name": "frame", "ph": "X", "ts": ts, "dur": (self.last - self.start) * 1e6,
+                       "pid": 1, "tid": 1, "args": {"n": self.n}})
+        for p in self.PHASES:
+            # phases as consecutive slices (lock wait is shown before the draw it interrupted)
+            events.append({"name": p, "ph": "X", "ts": ts, "dur": self.cur[p] * 1e6, "pid": 1, "tid": 1})
+            ts += self.cur[p] * 1e6
+        while snapshot_arrivals:
+            arrived, t = snapshot_arrivals.popleft()
+            events.append({"name": "snapshot", "ph": "i", "s": "t", "ts": (arrived - self.origin) * 1e6,
+                           "pid": 1, "tid": 2, "args": {"server_time": t}})
+        events.append({"name": "network", "ph": "C", "ts": (self.start - self.origin) * 1e6, "pid": 1,
+                       "args": {"jitter_ms": arrival_jitter * 1000, "arrival_gap_ms": arrival_gap * 1000}})
+        events.append({"name": "clock offset ms", "ph": "C", "ts": (self.start - self.origin) * 1e6, "pid": 1,
+                       "args": {"offset": offset}})
+        self.trace.write("".join(json.dumps(e) + ",\n" for e in events))
+
+    def close(self):
+        if self.trace is not None:
+            if self.chrome:
+                self.trace.write('{"name": "end", "ph": "i", "s": "g", "ts": %f, "pid": 1}]\n'
+                                 % ((time.perf_counter() - self.origin) * 1e6))
+            self.trace.close()
+            self.trace = None
+
+    def refresh(self, font):
+        # averages and worst frame over the history, re-rendered a few times a second
+        frames = list(self.frames)
+        if not frames:
+            return
+        busy = [sum(cur.values()) for _, cur in frames]
+        total = [b + idle for b, (idle, _) in zip(busy, frames)]
+        avg_total = sum(total) / len(total)
+        text = (230,230,230)
+        lines = [(f"frame {avg_total * 1000:5.1f} ms ({1 / max(avg_total, 1e-6):4.0f} fps)  "
+                  f"busy {sum(busy) / len(busy) * 1000:5.1f} ms, worst {max(busy) * 1000:5.1f} ms", text)]
+        for p in self.PHASES:
+            vals = [cur[p] for _, cur in frames]
+            lines.append((f"{p:<7} avg {sum(vals) / len(vals) * 1000:6.2f} ms  max {max(vals) * 1000:6.2f} ms",
+                          self.COLORS[p]))
+        lines.append((f"snapshots every {arrival_gap * 1000:5.1f} ms, jitter {arrival_jitter * 1000:5.1f} ms", text))
+        if clock_offset is not None:
+            lines.append((f"clock - server {clock_offset * 1000:+8.1f} ms (incl. one-way delay)", text))
+        self.lines = [font.render(line, True, col) for line, col in lines]
+
+    def draw(self, screen, font):
+        now = time.perf_counter()
+        if now - self.refreshed >= PROFILE_REFRESH:
+            self.refreshed = now
+            self.refresh(font)
+        w, h = screen.get_size()
+        panel_w, graph_h = 340, 60
+        y0 = 28
+        panel = pg.Surface((panel_w, 12 + 16 * len(self.lines) + graph_h), pg.SRCALPHA)
+        panel.fill((0,0,0,170))
+        screen.blit(panel, (w - panel_w - 8, y0))
+        for i, surf in enumerate(self.lines):
+            screen.blit(surf, (w - panel_w, y0 + 6 + 16 * i))
+        # stacked per-phase bars, 2 px per frame; the line is 60 fps
+        base = y0 + 6 + 16 * len(self.lines) + graph_h
+        scale = graph_h / 0.033
+        x = w - 8 - 2 * len(self.frames)
+        for _, cur in self.frames:
+            y = base
+            for p in self.PHASES:
+                hgt = min(cur[p] * scale, y - (base - graph_h))
+                if hgt >= 0.5:
+                    pg.draw.rect(screen, self.COLORS[p], (x, int(y - hgt), 2, max(1, int(hgt))))
+                y -= hgt
+            x += 2
+        line_y = base - int(scale / 60)
+        pg.draw.line(screen, (255,255,255), (w - panel_w - 8, line_y), (w - 8, line_y))
+
+def run_game(sock, name, color, profiler=None):
     pg.init()
     screen = pg.display.set_mode((800, 600))
     clock = pg.time.Clock()
     pg.display.set_caption(f"PyArena - {name}")
     # local position (client-predicted)
     x, y = random.randint(50, 750), random.randint(50, 550)
-    speed = 200.0  # pixels per second
+    located = not input_mode  # in input mode the server places us, wait for its first ack
     last_send = 0.0
     send_interval = 1.0 / UPDATE_FREQUENCY
+    # input mode: the keys held since the last command and for how long
+    held_keys = 0
+    held_time = 0.0
 
     running = True
     font = pg.font.SysFont(None, 18)
+    # static pieces are rendered once
+    hint = font.render("WASD / Arrows to move — LMB or SPACE to shoot toward mouse — F3 profiler", True, (200,200,200)).convert_alpha()
+    bullet_surf = pg.Surface((12, 12), pg.SRCALPHA)
+    pg.draw.circle(bullet_surf, (240,220,40), (6, 6), 6)
+    bullet_surf = bullet_surf.convert_alpha()
+    if profiler is None:
+        profiler = FrameProfiler()
     while running:
         dt = clock.tick(60) / 1000.0
+        profiler.begin()
         for ev in pg.event.get():
             if ev.type == pg.QUIT:
                 running = False
+            elif ev.type == pg.KEYDOWN and ev.key == pg.K_F3:
+                profiler.show = not profiler.show
             elif ev.type == pg.MOUSEBUTTONDOWN and ev.button == 1:
                 mx, my = pg.mouse.get_pos()
                 dx = mx - x
                 dy = my - y
                 # send shoot
-                send_json(sock, {"type":"shoot", "dx": dx, "dy": dy})
+                send_msg(sock, {"type":"shoot", "dx": dx, "dy": dy})
             elif ev.type == pg.KEYDOWN:
                 if ev.key == pg.K_SPACE:
                     mx, my = pg.mouse.get_pos()
                     dx = mx - x
                     dy = my - y
-                    send_json(sock, {"type":"shoot", "dx": dx, "dy": dy})
+                    send_msg(sock, {"type":"shoot", "dx": dx, "dy": dy})
+
+        profiler.mark("events")
 
         keys = pg.key.get_pressed()
-        dx = dy = 0.0
+        mask = 0
         if keys[pg.K_w] or keys[pg.K_UP]:
-            dy -= 1
+            mask |= KEY_UP
         if keys[pg.K_s] or keys[pg.K_DOWN]:
-            dy += 1
+            mask |= KEY_DOWN
         if keys[pg.K_a] or keys[pg.K_LEFT]:
-            dx -= 1
+            mask |= KEY_LEFT
         if keys[pg.K_d] or keys[pg.K_RIGHT]:
-            dx += 1
-        if dx != 0 and dy != 0:
-            mul = (2**0.5)/2.0
-            dx *= mul
-            dy *= mul
-        x += dx * speed * dt
-        y += dy * speed * dt
-        x = max(10, min(790, x))
-        y = max(10, min(590, y))
+            mask |= KEY_RIGHT
 
         now = time.time()
-        if now - last_send >= send_interval:
-            last_send = now
-            try:
-                send_json(sock, {"type":"update", "x": x, "y": y})
-            except Exception:
-                pass
+        if input_mode:
+            # one command per change of keys, or per send interval while held
+            resend = now - last_send >= send_interval
+            if mask != held_keys or resend:
+                if resend:
+                    last_send = now
+                ms = int(round(held_time * 1000))
+                flush_inputs(sock, held_keys, ms, resend)
+                held_keys, held_time = mask, held_time - ms / 1000.0
+            held_time += dt
+            pos = predicted_position(held_keys, held_time)
+            if pos is not None:
+                x, y = pos
+                located = True
+        else:
+            x, y = move_by_keys(x, y, mask, dt)
+            if now - last_send >= send_interval:
+                last_send = now
+                try:
+                    send_msg(sock, {"type":"update", "x": x, "y": y})
+                except Exception:
+                    pass
+        profiler.mark("input")
 
         screen.fill((30,30,30))
 
-        # draw other players from server state (skip our own server-entry if we know my_id)
-        with players_lock:
-            for pid, p in players.items():
-                if my_id is not None and pid == my_id:
-                    continue
-                col = tuple(int(c) for c in (p.get("color",[255,0,0])))
-                pg.draw.circle(screen, col, (int(p["x"]), int(p["y"])), 16)
-                name_surf = font.render(p.get("name",""), True, (240,240,240))
-                screen.blit(name_surf, (p["x"] - name_surf.get_width()//2, p["y"] - 24))
-                # hp bar
-                hp = p.get("hp",100)
-                hp_w = 32 * (max(0, min(100, hp)) / 100.0)
-                pg.draw.rect(screen, (60,60,60), (p["x"]-16, p["y"]+18, 32, 6))
-                pg.draw.rect(screen, (200,30,30), (p["x"]-16, p["y"]+18, int(hp_w), 6))
+        # draw other players and bullets a little in the past, smoothly
+        # interpolated between snapshots (skip our own server-entry if we know my_id)
+        view_players, view_bullets = interpolated_state(now)
+        profiler.waited(state_lock_wait)
+        forget_sprites(view_players.keys() | {my_id})
+        for pid, p in view_players.items():
+            if my_id is not None and pid == my_id:
+                continue
+            pname, pcolor = p.get("name"), p.get("color")
+            if pname is None:
+                pname, pcolor = player_info.get(pid, ("?", [255,0,0]))
+            surf, cx, cy = player_sprite(font, pid, pname, pcolor, p.get("hp",100))
+            screen.blit(surf, (int(p["x"]) - cx, int(p["y"]) - cy))
 
         # draw bullets
-        with bullets_lock:
-            for b in bullets:
-                try:
-                    bx = int(b.get("x",0))
-                    by = int(b.get("y",0))
-                    pg.draw.circle(screen, (240,220,40), (bx, by), 6)
-                except Exception:
-                    pass
+        for b in view_bullets:
+            try:
+                screen.blit(bullet_surf, (int(b[1]) - 6, int(b[2]) - 6))
+            except Exception:
+                pass
 
         # draw our local player on top
-        try:
-            pg.draw.circle(screen, tuple(int(c) for c in color), (int(x), int(y)), 16)
-            with players_lock:
-                hp = None
-                if my_id is not None and my_id in players:
-                    hp = players[my_id].get("hp", 100)
-            if hp is None:
-                hp = 100
-            name_surf = font.render(name + " (you)", True, (240,240,240))
-            screen.blit(name_surf, (x - name_surf.get_width()//2, y - 24))
-            hp_w = 36 * (max(0, min(100, hp)) / 100.0)
-            pg.draw.rect(screen, (60,60,60), (x-18, y+18, 36, 8))
-            pg.draw.rect(screen, (200,30,30), (x-18, y+18, int(hp_w), 8))
-        except Exception:
-            pass
+        if located:
+            try:
+                me = players.get(my_id)
+                hp = me.get("hp", 100) if me is not None else 100
+                surf, cx, cy = player_sprite(font, my_id, name + " (you)", color, hp, me=True)
+                screen.blit(surf, (int(x) - cx, int(y) - cy))
+            except Exception:
+                pass
 
         # HUD hint
-        hint = font.render("WASD / Arrows to move — LMB or SPACE to shoot toward mouse", True, (200,200,200))
         screen.blit(hint, (8, 8))
+        if profiler.show:
+            profiler.draw(screen, font)
+        profiler.mark("draw")
 
         pg.display.flip()
+        profiler.mark("flip")
+        profiler.end()
 
     try:
-        send_json(sock, {"type":"quit"})
+        send_msg(sock, {"type":"quit"})
     except Exception:
         pass
     try:
         sock.close()
+        if udp_sock is not None:
+            udp_sock.close()
     except Exception:
         pass
+    profiler.close()
     pg.quit()
 
 def parse_color_input(s):
@@ -248,14 +1043,34 @@ def parse_color_input(s):
     return None
 
 def main():
+    ap = argparse.ArgumentParser(description="PyArena client")
+    ap.add_argument("--profile", action="store_true", help="start with the frame-time overlay shown (F3 toggles it)")
+    ap.add_argument("--trace", metavar="PATH",
+                    help="record frame times and snapshot arrivals to PATH: Chrome trace if it ends in .json, else CSV")
+    args = ap.parse_args()
     print("PyArena client — will try to auto-discover the server on the LAN.")
-    print("Listening for server beacons (UDP port {})...".format(DISCOVERY_PORT))
-    discovered = discover_server(timeout=4.0)
+    # look for servers while the player answers the prompts
+    started = time.time()
+    found = find_servers()
+    name = input("Enter your player name (leave blank for random): ").strip()
+    if not name:
+        name = "Player" + str(random.randint(1000,9999))
+    c_in = input("Enter color as r,g,b (or 'random' / leave blank for random): ").strip()
+    col = parse_color_input(c_in)
+    if col is None:
+        col = [random.randint(40,255) for _ in range(3)]
+
+    print("Looking for servers (beacons on UDP port {}, last server played on)...".format(DISCOVERY_PORT))
+    servers, discovered, sock = wait_for_server(found, started + DISCOVERY_TIMEOUT + DISCOVERY_LISTEN)
+    for (host, port), msg in sorted(servers.items()):
+        load = f"{msg['players']}/{msg['capacity']} players" if "capacity" in msg else "load unknown"
+        health = "" if msg.get("healthy", True) else f", ticks slow (p99 {msg.get('tick_p99_ms', 0):.1f} ms)"
+        print(f"  {host}:{port} {load}{health}")
     server_ip = None
     server_port = TCP_PORT
     if discovered:
         server_ip, server_port = discovered
-        print(f"Found server at {server_ip}:{server_port}")
+        print(f"Found server at {server_ip}:{server_port}" + ("" if servers else " (last played on)"))
     else:
         print("No server beacon found automatically.")
         manual = input("Type server IP to connect to (or leave blank to use localhost): ").strip()
@@ -263,23 +1078,17 @@ def main():
             server_ip = manual
         else:
             server_ip = '127.0.0.1'
-    name = input("Enter your player name (leave blank for random): ").strip()
-    if not name:
-        name = "Player" + str(random.randint(1000,9999))
-    c_in = input("Enter color as r,g,b (or 'random' / leave blank for random): ").strip()
-    col = parse_color_input(c_in)
-    if col is None:
-        col = [random.randint(40,255) for _ in range(3)]
 
     print(f"Connecting to server {server_ip}:{server_port} as '{name}' with color {col} ...")
     try:
-        sock = start_network_connection(server_ip, server_port, name, col)
+        sock = start_network_connection(server_ip, server_port, name, col, sock)
     except Exception as e:
         print("Failed to connect to server:", e)
         print("Exiting.")
         return
+    save_cached_server((server_ip, server_port))
     time.sleep(0.05)
-    run_game(sock, name, col)
+    run_game(sock, name, col, FrameProfiler(args.trace, args.profile))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
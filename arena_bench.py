@@ -0,0 +1,532 @@
+# arena_bench.py
+# Micro-benchmarks for the arena server (arenatoken.py).
+# Run: python arena_bench.py
+
+import argparse
+import json
+import os
+import random
+import selectors
+import socket
+import subprocess
+import sys
+import time
+import zlib
+
+import arenatoken
+
+ARENA_W, ARENA_H = 800, 600
+
+def find_hits_bruteforce(bullet_rows, players):
+    # the original every-bullet-vs-every-player scan from physics_tick
+    hits = []
+    for key, bx, by, owner in bullet_rows:
+        owner_s = str(owner)
+        for pid, p in players.items():
+            if pid == owner_s:
+                continue
+            dx = bx - p["x"]
+            dy = by - p["y"]
+            if dx*dx + dy*dy <= (16*16):
+                hits.append((key, owner, pid))
+    return hits
+
+def make_world(n_players, n_bullets, rng):
+    players = {}
+    for i in range(1, n_players + 1):
+        players[str(i)] = {"x": rng.uniform(0, ARENA_W), "y": rng.uniform(0, ARENA_H)}
+    bullet_rows = []
+    for i in range(n_bullets):
+        bullet_rows.append((i, rng.uniform(-50, ARENA_W + 50), rng.uniform(-50, ARENA_H + 50),
+                            rng.randint(1, n_players)))
+    return players, bullet_rows
+
+def best_of(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        t = time.perf_counter() - t0
+        if best is None or t < best:
+            best = t
+    return best
+
+def bench_collision(args):
+    rng = random.Random(args.seed)
+    print("collision: brute force vs spatial hash (best of {}, ms per tick)".format(args.repeat))
+    print(f"{'players':>8} {'bullets':>8} {'brute':>10} {'grid':>10} {'speedup':>8} {'hits':>6}")
+    for n_players in args.players:
+        for n_bullets in args.bullets:
+            players, bullet_rows = make_world(n_players, n_bullets, rng)
+            ref = find_hits_bruteforce(bullet_rows, players)
+            got = arenatoken.find_hits(bullet_rows, players)
+            if got != ref:
+                raise SystemExit(f"hit mismatch at players={n_players} bullets={n_bullets}")
+            t_brute = best_of(lambda: find_hits_bruteforce(bullet_rows, players), args.repeat)
+            t_grid = best_of(lambda: arenatoken.find_hits(bullet_rows, players), args.repeat)
+            print(f"{n_players:>8} {n_bullets:>8} {t_brute*1000:>10.3f} {t_grid*1000:>10.3f} "
+                  f"{t_brute/max(t_grid, 1e-9):>7.1f}x {len(ref):>6}")
+
+def tick_bullet_dicts(bullet_list, dt):
+    # the original list-of-dicts integrate + expire pass from physics_tick
+    remove_bullets = []
+    for b in bullet_list:
+        b["x"] += b["vx"] * dt
+        b["y"] += b["vy"] * dt
+        b["ttl"] -= dt
+        if b["ttl"] <= 0:
+            remove_bullets.append(b["id"])
+    if remove_bullets:
+        bullet_list[:] = [bb for bb in bullet_list if bb["id"] not in remove_bullets]
+
+def bench_bullets(args):
+    rng = random.Random(args.seed)
+    dt = 1.0 / arenatoken.TICK_RATE
+    print("bullet store: list of dicts vs BulletPool (best of {}, ms per tick)".format(args.repeat))
+    print(f"{'bullets':>8} {'dicts':>10} {'pool':>10} {'speedup':>8}")
+    for n_bullets in args.bullets:
+        if n_bullets > arenatoken.MAX_BULLETS:
+            continue
+        spawns = [(rng.uniform(0, ARENA_W), rng.uniform(0, ARENA_H), rng.uniform(-420, 420),
+                   rng.uniform(-420, 420), rng.randint(1, 40), rng.uniform(0.5, 2.5)) for _ in range(n_bullets)]
+
+        def run_dicts():
+            bl = [{"id": str(i), "x": x, "y": y, "vx": vx, "vy": vy, "owner": str(o), "ttl": ttl}
+                  for i, (x, y, vx, vy, o, ttl) in enumerate(spawns)]
+            for _ in range(args.ticks):
+                tick_bullet_dicts(bl, dt)
+                [{"id": b["id"], "x": b["x"], "y": b["y"], "owner": b["owner"]} for b in bl]
+
+        def run_pool():
+            pool = arenatoken.BulletPool()
+            for x, y, vx, vy, o, ttl in spawns:
+                pool.spawn(x, y, vx, vy, o, ttl)
+            for _ in range(args.ticks):
+                pool.step(dt)
+                _, ids, xs, ys, owners = pool.snapshot()
+                list(zip(ids, xs, ys, owners))
+
+        t_dicts = best_of(run_dicts, args.repeat) / args.ticks
+        t_pool = best_of(run_pool, args.repeat) / args.ticks
+        print(f"{n_bullets:>8} {t_dicts*1000:>10.3f} {t_pool*1000:>10.3f} {t_dicts/max(t_pool, 1e-9):>7.1f}x")
+
+def make_state_msg(n_players, n_bullets, rng):
+    players = {str(i): {"name": f"Player{i}", "x": rng.uniform(0, ARENA_W), "y": rng.uniform(0, ARENA_H),
+                        "color": [rng.randint(40, 255) for _ in range(3)], "hp": rng.choice([25, 50, 75, 100]),
+                        "kills": rng.randint(0, 20)} for i in range(1, n_players + 1)}
+    bl = {i: (i, rng.uniform(0, ARENA_W), rng.uniform(0, ARENA_H), rng.randint(1, n_players)) for i in range(1, n_bullets + 1)}
+    return arenatoken.build_state_msg(1, time.time(), (players, bl))
+
+def bench_wire(args):
+    # full snapshots: server encode, client decode and bytes on the wire per protocol
+    os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+    import BATTLEARENA as client
+    rng = random.Random(args.seed)
+    print("wire: JSON vs binary full snapshot (best of {}, ms per message)".format(args.repeat))
+    print(f"{'players':>8} {'bullets':>8} {'json B':>9} {'bin B':>9} {'json enc':>9} {'bin enc':>9} {'json dec':>9} {'bin dec':>9}")
+    for n_players in args.players:
+        for n_bullets in args.bullets:
+            msg = make_state_msg(n_players, n_bullets, rng)
+            js = (json.dumps(msg) + '\n').encode('utf-8')
+            bn = arenatoken.encode_state_binary(msg)
+            body = memoryview(bn)[arenatoken.FRAME_HDR.size:]
+            t_je = best_of(lambda: (json.dumps(msg) + '\n').encode('utf-8'), args.repeat)
+            t_be = best_of(lambda: arenatoken.encode_state_binary(msg), args.repeat)
+            t_jd = best_of(lambda: client.apply_state(json.loads(js), None), args.repeat)
+            t_bd = best_of(lambda: client.apply_state(client.decode_server_frame(body), None), args.repeat)
+            print(f"{n_players:>8} {n_bullets:>8} {len(js):>9} {len(bn):>9} {t_je*1000:>9.3f} {t_be*1000:>9.3f} "
+                  f"{t_jd*1000:>9.3f} {t_bd*1000:>9.3f}")
+
+class CountingConn:
+    # fake client for broadcast_once(): counts what its send queue received
+    def __init__(self, out):
+        self.out = out
+        self.sent = 0
+
+    def drain(self):
+        while True:
+            data = self.out.pop(block=False)
+            if data is None:
+                return
+            self.sent += len(data)
+
+def bench_broadcast(args):
+    # broadcast_once() cost and bytes per client, with and without area of
+    # interest, and with bullet events (bullets only go out when fired, none are here)
+    a = arenatoken
+    rng = random.Random(args.seed)
+    print(f"broadcast: one broadcast_once() to every client, binary protocol, acking clients (mean of {args.ticks} snapshots)")
+    print(f"{'clients':>8} {'bullets':>8} {'aoi':>6} {'events':>6} {'ms':>9} {'B/client':>9}")
+    saved_aoi = a.AOI_RADIUS
+    try:
+        for n_clients in args.broadcast_clients:
+            for n_bullets in args.bullets:
+                if n_bullets > a.MAX_BULLETS:
+                    continue
+                for radius, events in ((0.0, False), (args.aoi_radius, False), (0.0, True)):
+                    a.AOI_RADIUS = radius
+                    a.players.clear()
+                    a.clients.clear()
+                    a.client_state.clear()
+                    a.bullets = a.BulletPool()
+                    conns = []
+                    for i in range(1, n_clients + 1):
+                        pid = str(i)
+                        a.players[pid] = {"name": f"bot{i}", "x": rng.uniform(0, ARENA_W), "y": rng.uniform(0, ARENA_H),
+                                          "color": [200, 200, 200], "hp": 100, "kills": 0}
+                        conn = CountingConn(a.SendQueue())
+                        a.clients[conn] = pid
+                        a.client_state[conn] = {"ack": None, "proto": a.PROTO_BINARY, "known": set(), "roster": 0, "udp": False,
+                                                "udp_addr": None, "ack_time": 0.0, "last_seen": time.time(), "views": {}, "out": conn.out,
+                                                "inputs": False, "events": events}
+                        conns.append(conn)
+                    for _ in range(n_bullets):
+                        a.bullets.spawn(rng.uniform(0, ARENA_W), rng.uniform(0, ARENA_H), rng.uniform(-420, 420),
+                                        rng.uniform(-420, 420), rng.randint(1, n_clients), 1e9)
+                    bstate = a.new_broadcast_state()
+                    a.publish()
+                    a.broadcast_once(bstate)  # first, full snapshot
+                    for conn in conns:
+                        conn.drain()
+                        conn.sent = 0
+                    elapsed = 0.0
+                    for _ in range(args.ticks):
+                        for st in a.client_state.values():
+                            st["ack"] = bstate["seq"]
+                        for p in rng.sample(list(a.players.values()), max(1, n_clients // 4)):
+                            p["x"] = min(ARENA_W, max(0, p["x"] + rng.uniform(-10, 10)))
+                        a.bullets.step(1.0 / a.BROADCAST_FPS)
+                        a.publish()
+                        t0 = time.perf_counter()
+                        a.broadcast_once(bstate)
+                        elapsed += time.perf_counter() - t0
+                        for conn in conns:
+                            conn.drain()
+                    per_client = sum(c.sent for c in conns) / len(conns) / args.ticks
+                    label = f"{radius:.0f}" if radius else "off"
+                    print(f"{n_clients:>8} {n_bullets:>8} {label:>6} {'on' if events else 'off':>6} "
+                          f"{elapsed / args.ticks * 1000:>9.3f} {per_client:>9.0f}")
+    finally:
+        a.AOI_RADIUS = saved_aoi
+        a.players.clear()
+        a.clients.clear()
+        a.client_state.clear()
+
+def bench_compress(args):
+    # what --compress buys: a stream of delta snapshots to one acking client,
+    # through a per-connection zlib stream with a sync flush per frame
+    a = arenatoken
+    rng = random.Random(args.seed)
+    configs = [("l1", 1), ("l6", 6)]
+    print(f"compress: delta snapshot stream, {args.ticks} frames (ratio : 1 and us per frame)")
+    print(f"{'players':>8} {'bullets':>8} {'proto':>6} {'raw B':>7} " + " ".join(f"{n:>15}" for n, _ in configs))
+    try:
+        for n_players in args.players:
+            for n_bullets in args.bullets:
+                if n_bullets > a.MAX_BULLETS:
+                    continue
+                a.players.clear()
+                a.bullets = a.BulletPool()
+                for i in range(1, n_players + 1):
+                    a.players[str(i)] = {"name": f"bot{i}", "x": rng.uniform(0, ARENA_W), "y": rng.uniform(0, ARENA_H),
+                                         "color": [200, 200, 200], "hp": 100, "kills": 0}
+                for _ in range(n_bullets):
+                    a.bullets.spawn(rng.uniform(0, ARENA_W), rng.uniform(0, ARENA_H), rng.uniform(-420, 420),
+                                    rng.uniform(-420, 420), rng.randint(1, n_players), 1e9)
+                frames = {a.PROTO_JSON: [], a.PROTO_BINARY: []}
+                prev = None
+                for seq in range(1, args.ticks + 1):
+                    for p in rng.sample(list(a.players.values()), max(1, n_players // 4)):
+                        p["x"] = min(ARENA_W, max(0, p["x"] + rng.uniform(-10, 10)))
+                    a.bullets.step(1.0 / a.BROADCAST_FPS)
+                    a.publish()
+                    _, snap, ids, xs, ys, owners, _ = a.published
+                    cur = (snap, dict(zip(ids, zip(ids, xs, ys, owners))))
+                    msg = a.build_state_msg(seq, time.time(), cur, seq - 1, prev[1]) if prev else \
+                        a.build_state_msg(seq, time.time(), cur)
+                    frames[a.PROTO_JSON].append(a.encode_state_json(msg))
+                    frames[a.PROTO_BINARY].append(a.encode_state_binary(msg))
+                    prev = (seq, cur)
+                for proto, name in ((a.PROTO_JSON, "json"), (a.PROTO_BINARY, "binary")):
+                    raw = sum(len(f) for f in frames[proto])
+                    cols = []
+                    for _, level in configs:
+                        z = zlib.compressobj(level)
+                        out = 0
+                        t0 = time.perf_counter()
+                        for f in frames[proto]:
+                            out += len(z.compress(f) + z.flush(zlib.Z_SYNC_FLUSH))
+                        took = time.perf_counter() - t0
+                        cols.append(f"{raw / out:>6.2f} {took / args.ticks * 1e6:>8.1f}")
+                    print(f"{n_players:>8} {n_bullets:>8} {name:>6} {raw // args.ticks:>7} " + " ".join(f"{c:>15}" for c in cols))
+    finally:
+        a.players.clear()
+
+# runs arenatoken.main() in a subprocess with physics_tick wrapped in a timer;
+# prints tick duration percentiles as JSON after the measurement window
+SERVER_HARNESS = r"""
+import json, os, sys, threading, time
+import arenatoken
+warmup, duration = float(sys.argv[1]), float(sys.argv[2])
+samples = []  # (start, duration, how far the simulation trails the wall clock at the end of the tick)
+sim = {"t": 0.0, "wall0": None}
+physics_tick = arenatoken.physics_tick
+def timed_tick(dt):
+    t0 = time.perf_counter()
+    physics_tick(dt)
+    t1 = time.perf_counter()
+    if sim["wall0"] is None:
+        sim["wall0"] = t0
+    sim["t"] += dt
+    samples.append((t0, t1 - t0, (t1 - sim["wall0"]) - sim["t"]))
+arenatoken.physics_tick = timed_tick
+def cpu_time():
+    t = os.times()
+    return t.user + t.system
+def report():
+    start = time.perf_counter()
+    time.sleep(warmup)
+    cpu0 = cpu_time()
+    time.sleep(duration)
+    cpu = cpu_time() - cpu0
+    win = [s for s in samples if s[0] >= start + warmup]
+    d = sorted(s[1] for s in win)
+    if not win:
+        # --sim-process: ticks run in the child, take the stats it shares
+        ts = arenatoken.tick_stats
+        d = sorted(list(ts["durations"])[-int(duration * arenatoken.TICK_RATE):])
+        win = [(0.0, t, 0.0) for t in d]
+    base = win[0][2] if win else 0.0
+    lag = sorted(s[2] - base for s in win)
+    pct = lambda v, q: v[min(len(v) - 1, int(q * len(v)))] * 1000 if v else 0.0
+    print("RESULT " + json.dumps({"ticks": len(d), "p50_ms": pct(d, 0.50), "p99_ms": pct(d, 0.99),
+                                  "max_ms": pct(d, 1.0), "lag_p99_ms": pct(lag, 0.99),
+                                  "cpu_pct": cpu / duration * 100,
+                                  # how late the scheduler woke up for its ticks, if it keeps track
+                                  "jitter_p99_ms": pct(sorted(getattr(arenatoken, "tick_stats", {}).get("jitters", ())), 0.99)}),
+          flush=True)
+    os._exit(0)
+threading.Thread(target=report, daemon=True).start()
+sys.argv = ["arenatoken.py"] + sys.argv[3:]
+arenatoken.main()
+"""
+
+def run_fake_clients(port, n_clients, seconds, rng, n_stalled=0):
+    # n binary-protocol clients on one selector: join, then update at 20 Hz,
+    # shoot now and then, and drain whatever the server sends. The n_stalled
+    # extra clients take the (bigger) JSON snapshots, keep sending updates so
+    # they are not reaped, and never read.
+    # -> (bytes and snapshots received per reading client, stalled clients the server closed)
+    a = arenatoken
+    sel = selectors.DefaultSelector()
+    socks = []
+    stalled = []
+    for i in range(n_stalled):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        s.connect(("127.0.0.1", port))
+        join = {"type": "join", "name": f"stalled{i}", "color": [90, 90, 90], "protocols": [a.PROTO_JSON]}
+        s.sendall((json.dumps(join) + "\n").encode())
+        s.setblocking(False)
+        stalled.append(s)
+    received = 0
+    snapshots = 0
+    bufs = {}  # socket -> unparsed bytes, None until join_ack was read
+    for i in range(n_clients):
+        s = socket.create_connection(("127.0.0.1", port))
+        join = {"type": "join", "name": f"bot{i}", "color": [200, 200, 200], "protocols": [a.PROTO_BINARY]}
+        s.sendall((json.dumps(join) + "\n").encode())
+        s.setblocking(False)
+        sel.register(s, selectors.EVENT_READ)
+        bufs[s] = None
+        socks.append([s, rng.uniform(50, ARENA_W - 50), rng.uniform(50, ARENA_H - 50)])
+    time.sleep(0.2)  # let join_ack arrive before the first binary frame
+    end = time.time() + seconds
+    next_send = time.time()
+    while time.time() < end:
+        for key, _ in sel.select(timeout=max(0.0, next_send - time.time())):
+            try:
+                data = key.fileobj.recv(65536)
+            except (BlockingIOError, OSError):
+                continue
+            received += len(data)
+            buf = bufs[key.fileobj]
+            if buf is None:
+                data = data.split(b"\n", 1)[1] if b"\n" in data else b""  # skip the join_ack line
+                buf = b""
+            buf += data
+            pos = 0
+            while len(buf) - pos >= a.FRAME_HDR.size:
+                n, = a.FRAME_HDR.unpack_from(buf, pos)
+                if len(buf) - pos - a.FRAME_HDR.size < n:
+                    break
+                if buf[pos + a.FRAME_HDR.size] == a.S_STATE:
+                    snapshots += 1
+                pos += a.FRAME_HDR.size + n
+            bufs[key.fileobj] = buf[pos:]
+        if time.time() >= next_send:
+            next_send += 0.05
+            for entry in socks:
+                s = entry[0]
+                entry[1] = min(ARENA_W, max(0, entry[1] + rng.uniform(-8, 8)))
+                entry[2] = min(ARENA_H, max(0, entry[2] + rng.uniform(-8, 8)))
+                data = a.encode_frame(a.UPDATE_REC.pack(a.C_UPDATE, a.quantize(entry[1]), a.quantize(entry[2])))
+                if rng.random() < 0.1:
+                    data += a.encode_frame(a.SHOOT_REC.pack(a.C_SHOOT, rng.uniform(-1, 1), rng.uniform(-1, 1)))
+                try:
+                    s.send(data)
+                except (BlockingIOError, OSError):
+                    pass
+            for s in stalled:
+                try:
+                    s.send(b'{"type": "update", "x": 400, "y": 300}\n')
+                except (BlockingIOError, OSError):
+                    pass
+    for s, _, _ in socks:
+        s.close()
+    closed = 0
+    for s in stalled:
+        # a closed connection shows up as EOF or a reset once the backlog is read
+        s.setblocking(True)
+        s.settimeout(2.0)
+        try:
+            while s.recv(1 << 20):
+                pass
+            closed += 1
+        except ConnectionResetError:
+            closed += 1
+        except OSError:
+            pass
+        s.close()
+    return received / max(1, n_clients), snapshots / max(1, n_clients), closed
+
+def bench_server(args):
+    # physics tick time under client load: thread-per-client, asyncio, and
+    # threads with the physics in its own process
+    rng = random.Random(args.seed)
+    print(f"server: physics_tick time under load ({args.seconds:.0f}s per run, ms)")
+    print("  (lag: how far the simulation trails the wall clock when a tick finishes)")
+    print(f"{'clients':>8} {'mode':>8} {'ticks':>7} {'p50':>8} {'p99':>8} {'max':>8} {'lag p99':>8}")
+    here = os.path.dirname(os.path.abspath(__file__))
+    for n_clients in args.clients:
+        for mode in ("threads", "asyncio", "sim-proc"):
+            cmd = [sys.executable, "-c", SERVER_HARNESS, "1.0", str(args.seconds),
+                   "--host", "127.0.0.1", "--port", str(args.port), "--udp-port", "0"]
+            if mode == "asyncio":
+                cmd.append("--asyncio")
+            elif mode == "sim-proc":
+                cmd.append("--sim-process")
+            proc = subprocess.Popen(cmd, cwd=here, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            try:
+                time.sleep(0.5)
+                run_fake_clients(args.port, n_clients, args.seconds + 1.5, rng)
+                out = proc.communicate(timeout=10)[0]
+            finally:
+                proc.kill()
+            line = next((l for l in out.splitlines() if l.startswith("RESULT ")), None)
+            if line is None:
+                raise SystemExit("server run failed:\n" + out)
+            r = json.loads(line[len("RESULT "):])
+            print(f"{n_clients:>8} {mode:>8} {r['ticks']:>7} {r['p50_ms']:>8.3f} {r['p99_ms']:>8.3f} {r['max_ms']:>8.3f} {r['lag_p99_ms']:>8.3f}")
+
+def bench_idle(args):
+    # CPU use and tick timing of a server with nobody connected
+    print(f"idle: server with no clients ({args.seconds:.0f}s)")
+    here = os.path.dirname(os.path.abspath(__file__))
+    cmd = [sys.executable, "-c", SERVER_HARNESS, "1.0", str(args.seconds),
+           "--host", "127.0.0.1", "--port", str(args.port), "--udp-port", "0"]
+    proc = subprocess.Popen(cmd, cwd=here, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    try:
+        out = proc.communicate(timeout=args.seconds + 10)[0]
+    finally:
+        proc.kill()
+    line = next((l for l in out.splitlines() if l.startswith("RESULT ")), None)
+    if line is None:
+        raise SystemExit("server run failed:\n" + out)
+    r = json.loads(line[len("RESULT "):])
+    print(f"  cpu {r['cpu_pct']:.1f}% of a core, {r['ticks'] / args.seconds:.0f} ticks/s, "
+          f"tick p99 {r['p99_ms']:.3f} ms, wake-up jitter p99 {r['jitter_p99_ms']:.3f} ms")
+
+def bench_rooms(args):
+    # snapshots/s delivered with the players spread over N room processes;
+    # a server that keeps up sends BROADCAST_FPS per client
+    rng = random.Random(args.seed)
+    print(f"rooms: snapshots/s received ({args.seconds:.0f}s per run, {os.cpu_count()} cores, "
+          f"{arenatoken.BROADCAST_FPS:.0f}/s per client when keeping up)")
+    print(f"{'clients':>8} {'rooms':>6} {'total':>12} {'per client':>11}")
+    here = os.path.dirname(os.path.abspath(__file__))
+    for n_clients in args.clients:
+        for n_rooms in args.rooms:
+            cmd = [sys.executable, os.path.join(here, "arenatoken.py"), "--host", "127.0.0.1",
+                   "--port", str(args.port), "--udp-port", "0", "--rooms", str(n_rooms)]
+            proc = subprocess.Popen(cmd, cwd=here, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                time.sleep(0.5 + 0.3 * n_rooms)
+                _, snaps, _ = run_fake_clients(args.port, n_clients, args.seconds, rng)
+            finally:
+                proc.terminate()
+                proc.wait()
+            total = snaps * n_clients / args.seconds
+            print(f"{n_clients:>8} {n_rooms:>6} {total:>12.0f} {snaps / args.seconds:>11.1f}")
+
+def bench_stall(args):
+    # snapshot throughput of healthy clients while a few clients stop reading
+    rng = random.Random(args.seed)
+    print(f"stall: bytes/s received per reading client with {args.stalled} clients that never read ({args.seconds:.0f}s per run)")
+    print(f"{'clients':>8} {'mode':>8} {'stalled':>8} {'B/s':>10} {'kicked':>7}")
+    here = os.path.dirname(os.path.abspath(__file__))
+    for n_clients in args.clients:
+        for mode in ("threads", "asyncio"):
+            for n_stalled in (0, args.stalled):
+                cmd = [sys.executable, os.path.join(here, "arenatoken.py"),
+                       "--host", "127.0.0.1", "--port", str(args.port), "--udp-port", "0"]
+                if mode == "asyncio":
+                    cmd.append("--asyncio")
+                proc = subprocess.Popen(cmd, cwd=here, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                try:
+                    time.sleep(0.5)
+                    per_client, _, kicked = run_fake_clients(args.port, n_clients, args.seconds, rng, n_stalled)
+                finally:
+                    proc.kill()
+                    proc.wait()
+                print(f"{n_clients:>8} {mode:>8} {n_stalled:>8} {per_client / args.seconds:>10.0f} {kicked:>7}")
+
+BENCHES = {
+    "collision": bench_collision,
+    "bullets": bench_bullets,
+    "wire": bench_wire,
+    "broadcast": bench_broadcast,
+    "compress": bench_compress,
+    "server": bench_server,
+    "stall": bench_stall,
+    "idle": bench_idle,
+    "rooms": bench_rooms,
+}
+
+def main():
+    ap = argparse.ArgumentParser(description="arena server benchmarks")
+    ap.add_argument("which", nargs="*", help="benchmarks to run: {} (default: all)".format(", ".join(BENCHES)))
+    ap.add_argument("--players", type=int, nargs="+", default=[10, 40, 100, 200])
+    ap.add_argument("--bullets", type=int, nargs="+", default=[50, 200, 1000])
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--ticks", type=int, default=60, help="ticks simulated per bullet-store run")
+    ap.add_argument("--clients", type=int, nargs="+", default=[50, 150], help="connected clients for the server benchmark")
+    ap.add_argument("--broadcast-clients", type=int, nargs="+", default=[100, 400, 800],
+                    help="connected clients for the broadcast benchmark")
+    ap.add_argument("--seconds", type=float, default=5.0, help="measurement window per server run")
+    ap.add_argument("--port", type=int, default=5710, help="TCP port for the server benchmark")
+    ap.add_argument("--rooms", type=int, nargs="+", default=[1, 2, 4], help="room process counts for the rooms benchmark")
+    ap.add_argument("--stalled", type=int, default=3, help="clients that never read, for the stall benchmark")
+    ap.add_argument("--aoi-radius", type=float, default=250.0, help="area-of-interest radius for the broadcast benchmark")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+    for name in args.which:
+        if name not in BENCHES:
+            ap.error(f"unknown benchmark: {name}")
+    # these start real servers, so they only run when asked for
+    for name in (args.which or [n for n in BENCHES if n not in ("server", "stall", "idle", "rooms")]):
+        BENCHES[name](args)
+        print()
+
+if __name__ == "__main__":
+    main()
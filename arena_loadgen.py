@@ -0,0 +1,299 @@
+# arena_loadgen.py
+# Headless load generator for the arena server (arenatoken.py): hundreds of
+# scripted bots on one selector loop, no pygame needed. Each bot joins,
+# wanders around, shoots and acks snapshots like the real client.
+# Reports join success, snapshot latency and bytes/s per client, and
+# writes the results as JSON so runs can be compared across server versions.
+# Snapshot latency compares the server's send time with our receive time, so
+# it is only meaningful when both clocks agree (same machine, or NTP).
+# Run: python arena_loadgen.py --bots 200 --seconds 30 --out run.json
+
+import argparse
+import json
+import math
+import random
+import selectors
+import socket
+import time
+import zlib
+
+import arenatoken as a
+
+ARENA_W, ARENA_H = 800, 600
+
+def discover_server(timeout):
+    # first server_announce beacon heard on the discovery port, or None
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        udp.bind(('', a.DISCOVERY_PORT))
+    except OSError:
+        udp.close()
+        return None
+    end = time.time() + timeout
+    try:
+        while time.time() < end:
+            udp.settimeout(max(0.01, end - time.time()))
+            try:
+                data, addr = udp.recvfrom(4096)
+            except socket.timeout:
+                return None
+            try:
+                msg = json.loads(data.decode('utf-8', errors='ignore'))
+            except Exception:
+                continue
+            if isinstance(msg, dict) and msg.get("type") == "server_announce":
+                return msg.get("host") or addr[0], int(msg.get("tcp_port", a.PORT))
+    finally:
+        udp.close()
+    return None
+
+def new_bot(i, proto, compress, rng):
+    return {"name": f"loadbot{i}", "proto": proto, "compress": compress, "inflate": None,
+            "sock": None, "state": "new", "buf": b"",
+            "x": rng.uniform(50, ARENA_W - 50), "y": rng.uniform(50, ARENA_H - 50),
+            "heading": rng.uniform(0, 2 * math.pi), "connect_t": 0.0, "join_ms": None,
+            "bytes": 0, "snapshots": 0, "latencies": [], "error": None}
+
+def start_bot(bot, addr, sel):
+    bot["connect_t"] = time.time()
+    try:
+        s = socket.create_connection(addr, timeout=5.0)
+        join = {"type": "join", "name": bot["name"], "color": [120, 200, 120], "protocols": [bot["proto"]]}
+        if bot["compress"]:
+            join["compress"] = [a.COMPRESS_ZLIB]
+        s.sendall((json.dumps(join) + "\n").encode('utf-8'))
+    except OSError as e:
+        bot["state"] = "failed"
+        bot["error"] = str(e)
+        return
+    s.setblocking(False)
+    bot["sock"] = s
+    bot["state"] = "joining"
+    sel.register(s, selectors.EVENT_READ, bot)
+
+def bot_send(bot, data):
+    try:
+        bot["sock"].send(data)
+    except (BlockingIOError, OSError):
+        pass  # a bot that cannot send just skips this update
+
+def on_snapshot(bot, seq, sent_at, now):
+    bot["snapshots"] += 1
+    bot["latencies"].append(now - sent_at)
+    if bot["proto"] == a.PROTO_BINARY:
+        bot_send(bot, a.encode_frame(a.ACK_REC.pack(a.C_ACK, seq)))
+    else:
+        bot_send(bot, (json.dumps({"type": "ack", "seq": seq}) + "\n").encode('utf-8'))
+
+def bot_receive(bot, sel, now):
+    try:
+        data = bot["sock"].recv(65536)
+    except BlockingIOError:
+        return
+    except OSError as e:
+        data = b""
+        bot["error"] = str(e)
+    if not data:
+        sel.unregister(bot["sock"])
+        bot["sock"].close()
+        bot["state"] = "failed" if bot["state"] == "joining" else "closed"
+        if bot["error"] is None:
+            bot["error"] = "connection closed by server"
+        return
+    bot["bytes"] += len(data)  # on the wire, so compressed if the stream is
+    if bot["inflate"] is not None:
+        data = bot["inflate"].decompress(data)
+    buf = bot["buf"] + data
+    if bot["state"] == "joining":
+        if b"\n" not in buf:
+            bot["buf"] = buf
+            return
+        line, buf = buf.split(b"\n", 1)
+        try:
+            ack = json.loads(line)
+        except ValueError:
+            ack = None
+        if not isinstance(ack, dict) or ack.get("type") != "join_ack":
+            bot["state"] = "failed"
+            bot["error"] = "no join_ack"
+            return
+        bot["state"] = "joined"
+        bot["proto"] = ack.get("proto", a.PROTO_JSON)
+        if ack.get("compress") == a.COMPRESS_ZLIB:
+            bot["inflate"] = zlib.decompressobj()
+            buf = bot["inflate"].decompress(buf)
+        bot["join_ms"] = (now - bot["connect_t"]) * 1000
+    if bot["proto"] == a.PROTO_BINARY:
+        pos = 0
+        while len(buf) - pos >= a.FRAME_HDR.size:
+            n, = a.FRAME_HDR.unpack_from(buf, pos)
+            start = pos + a.FRAME_HDR.size
+            if len(buf) - start < n:
+                break
+            if n >= a.STATE_HDR.size and buf[start] == a.S_STATE:
+                _, seq, _, sent_at = a.STATE_HDR.unpack_from(buf, start)[:4]
+                on_snapshot(bot, seq, sent_at, now)
+            pos = start + n
+        bot["buf"] = buf[pos:]
+    else:
+        *lines, bot["buf"] = buf.split(b"\n")
+        for line in lines:
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(msg, dict) and msg.get("type") == "state":
+                on_snapshot(bot, msg.get("seq", 0), msg.get("time", now), now)
+
+def bot_step(bot, dt, shoot_chance, rng):
+    # wander: keep a heading, turn a little, bounce off the walls
+    bot["heading"] += rng.uniform(-0.6, 0.6)
+    speed = 160.0
+    x = bot["x"] + math.cos(bot["heading"]) * speed * dt
+    y = bot["y"] + math.sin(bot["heading"]) * speed * dt
+    if not (20 <= x <= ARENA_W - 20 and 20 <= y <= ARENA_H - 20):
+        bot["heading"] += math.pi
+        x = min(ARENA_W - 20, max(20, x))
+        y = min(ARENA_H - 20, max(20, y))
+    bot["x"], bot["y"] = x, y
+    if bot["proto"] == a.PROTO_BINARY:
+        data = a.encode_frame(a.UPDATE_REC.pack(a.C_UPDATE, a.quantize(x), a.quantize(y)))
+    else:
+        data = (json.dumps({"type": "update", "x": x, "y": y}) + "\n").encode('utf-8')
+    if rng.random() < shoot_chance:
+        dx, dy = rng.uniform(-1, 1), rng.uniform(-1, 1)
+        if bot["proto"] == a.PROTO_BINARY:
+            data += a.encode_frame(a.SHOOT_REC.pack(a.C_SHOOT, dx, dy))
+        else:
+            data += (json.dumps({"type": "shoot", "dx": dx, "dy": dy}) + "\n").encode('utf-8')
+    bot_send(bot, data)
+
+def percentiles(values, scale=1.0):
+    v = sorted(values)
+    if not v:
+        return None
+    pick = lambda q: v[min(len(v) - 1, int(q * len(v)))] * scale
+    return {"min": v[0] * scale, "p50": pick(0.50), "p90": pick(0.90), "p99": pick(0.99),
+            "max": v[-1] * scale, "mean": sum(v) / len(v) * scale}
+
+def run(args, addr):
+    rng = random.Random(args.seed)
+    proto = a.PROTO_JSON if args.proto == "json" else a.PROTO_BINARY
+    sel = selectors.DefaultSelector()
+    bots = [new_bot(i, proto, args.compress, rng) for i in range(args.bots)]
+    interval = 1.0 / args.update_rate
+    shoot_chance = min(1.0, args.shoot_rate / args.update_rate)
+    # joins are spread over the ramp, measurement starts once it is over
+    join_at = [i * args.ramp / max(1, args.bots) for i in range(args.bots)]
+    t0 = time.time()
+    measure_from = t0 + args.ramp + args.join_timeout
+    end = measure_from + args.seconds
+    window = {}  # bot index -> (bytes, snapshots) at measure_from
+    next_join = 0
+    next_tick = t0
+    while True:
+        now = time.time()
+        if now >= end:
+            break
+        while next_join < len(bots) and now - t0 >= join_at[next_join]:
+            start_bot(bots[next_join], addr, sel)
+            next_join += 1
+        if not window and now >= measure_from:
+            for i, bot in enumerate(bots):
+                bot["latencies"] = []
+                window[i] = (bot["bytes"], bot["snapshots"])
+        for key, _ in sel.select(timeout=max(0.0, min(next_tick, end) - now)):
+            bot_receive(key.data, sel, time.time())
+        now = time.time()
+        if now >= next_tick:
+            next_tick += interval
+            if next_tick < now:
+                next_tick = now + interval  # fell behind, do not burst
+            for bot in bots:
+                if bot["state"] == "joined":
+                    bot_step(bot, interval, shoot_chance, rng)
+                elif bot["state"] == "joining" and now - bot["connect_t"] > args.join_timeout:
+                    sel.unregister(bot["sock"])
+                    bot["sock"].close()
+                    bot["state"] = "failed"
+                    bot["error"] = "join timed out"
+    for bot in bots:
+        if bot["sock"] is not None and bot["state"] in ("joining", "joined"):
+            bot_send(bot, a.encode_frame(bytes([a.C_QUIT])) if bot["proto"] == a.PROTO_BINARY
+                     else b'{"type": "quit"}\n')
+            bot["sock"].close()
+    return bots, window
+
+def summarize(args, addr, bots, window):
+    joined = [i for i, b in enumerate(bots) if b["join_ms"] is not None]
+    measured = [i for i in joined if i in window]
+    bps = [(bots[i]["bytes"] - window[i][0]) / args.seconds for i in measured]
+    sps = [(bots[i]["snapshots"] - window[i][1]) / args.seconds for i in measured]
+    latencies = [l for i in measured for l in bots[i]["latencies"]]
+    errors = {}
+    for b in bots:
+        if b["error"]:
+            errors[b["error"]] = errors.get(b["error"], 0) + 1
+    return {
+        "label": args.label,
+        "server": f"{addr[0]}:{addr[1]}",
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "settings": {"bots": args.bots, "seconds": args.seconds, "ramp": args.ramp, "proto": args.proto,
+                     "compress": args.compress, "update_rate": args.update_rate, "shoot_rate": args.shoot_rate, "seed": args.seed},
+        "joined": len(joined),
+        "compressed": sum(1 for i in joined if bots[i]["inflate"] is not None),
+        "join_success_rate": len(joined) / max(1, args.bots),
+        "join_ms": percentiles([bots[i]["join_ms"] for i in joined]),
+        "disconnected": sum(1 for b in bots if b["state"] == "closed"),
+        "errors": errors,
+        "snapshot_latency_ms": percentiles(latencies, 1000.0),
+        "snapshots_per_sec_per_client": percentiles(sps),
+        "bytes_per_sec_per_client": percentiles(bps),
+        "bytes_per_sec_total": sum(bps),
+    }
+
+def main():
+    ap = argparse.ArgumentParser(description="headless load generator for the arena server")
+    ap.add_argument("--host", help="server address (default: wait for a discovery beacon)")
+    ap.add_argument("--port", type=int, default=a.PORT)
+    ap.add_argument("--bots", type=int, default=100)
+    ap.add_argument("--seconds", type=float, default=20.0, help="measurement window, after every bot joined")
+    ap.add_argument("--ramp", type=float, default=2.0, help="spread the joins over this many seconds")
+    ap.add_argument("--join-timeout", type=float, default=3.0)
+    ap.add_argument("--update-rate", type=float, default=20.0, help="position updates per second per bot")
+    ap.add_argument("--shoot-rate", type=float, default=1.0, help="shots per second per bot")
+    ap.add_argument("--proto", choices=("binary", "json"), default="binary")
+    ap.add_argument("--compress", action="store_true", help="ask for a compressed stream (server needs --compress)")
+    ap.add_argument("--discover-timeout", type=float, default=4.0)
+    ap.add_argument("--label", default="", help="free text stored with the results, e.g. the server version")
+    ap.add_argument("--out", help="write the results as JSON to this file")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+    if args.host:
+        addr = (args.host, args.port)
+    else:
+        print(f"Listening for server beacons (UDP port {a.DISCOVERY_PORT})...")
+        addr = discover_server(args.discover_timeout)
+        if addr is None:
+            raise SystemExit("no server found; pass --host")
+    print(f"{args.bots} bots -> {addr[0]}:{addr[1]}, {args.proto}{', compressed' if args.compress else ''}, {args.seconds:.0f}s")
+    bots, window = run(args, addr)
+    result = summarize(args, addr, bots, window)
+    lat = result["snapshot_latency_ms"] or {}
+    bps = result["bytes_per_sec_per_client"] or {}
+    sps = result["snapshots_per_sec_per_client"] or {}
+    print(f"joined {result['joined']}/{args.bots} ({result['join_success_rate'] * 100:.1f}%), "
+          f"disconnected {result['disconnected']}, compressed {result['compressed']}")
+    if lat:
+        print(f"snapshot latency ms: p50 {lat['p50']:.2f}  p99 {lat['p99']:.2f}  max {lat['max']:.2f}")
+        print(f"per client: {bps['mean']:.0f} B/s, {sps['mean']:.1f} snapshots/s (slowest client {sps['min']:.1f})")
+    for err, n in result["errors"].items():
+        print(f"  {n} x {err}")
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+        print("Results written to", args.out)
+
+if __name__ == "__main__":
+    main()
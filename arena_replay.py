@@ -0,0 +1,208 @@
+# arena_replay.py
+# Viewer for match recordings made with `python arenatoken.py --record PATH`.
+# The recording is memory-mapped, and its index (PATH.idx) says where every
+# snapshot and its keyframe start, so seeking to any time only decodes the
+# few seconds between the keyframe before it and the snapshot itself.
+# Keys: SPACE pause, LEFT/RIGHT seek -/+5s, UP/DOWN playback speed, HOME restart.
+# Run: python arena_replay.py match.rec
+#      python arena_replay.py match.rec --info
+#      python arena_replay.py match.rec --at 90 --dump
+
+import argparse
+import mmap
+import struct
+import sys
+import time
+
+import numpy as np
+
+import arenatoken as a
+
+INDEX_DTYPE = np.dtype([("seq", "<u4"), ("time", "<f8"), ("offset", "<u8"), ("key", "<u8")])
+assert INDEX_DTYPE.itemsize == a.INDEX_REC.size
+SEEK_STEP = 5.0
+SPEEDS = [0.25, 0.5, 1.0, 2.0, 4.0, 8.0]
+
+def open_recording(path):
+    # -> dict with the mapped data and the index as a structured array
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, started = a.RECORD_HDR.unpack_from(data)
+    if magic != a.RECORD_MAGIC or version != a.RECORD_VERSION:
+        raise ValueError(f"{path}: not an arena recording (version {a.RECORD_VERSION})")
+    with open(path + ".idx", "rb") as f:
+        raw = f.read()
+    # a recording still being written can end in half an index entry
+    raw = raw[:len(raw) - len(raw) % INDEX_DTYPE.itemsize]
+    index = np.frombuffer(raw, dtype=INDEX_DTYPE)
+    if not len(index):
+        raise ValueError(f"{path}: recording is empty")
+    return {"path": path, "data": data, "view": memoryview(data), "index": index, "started": started,
+            "times": index["time"] - index["time"][0]}
+
+def new_state():
+    # players: pid -> [x, y, hp, kills]; bullets: bid -> (x, y, owner);
+    # info: pid -> (name, color). pos: index entry last applied
+    return {"players": {}, "bullets": {}, "info": {}, "pos": -1}
+
+def apply_record(rec, state, i):
+    # decode entry i's frames (player infos, then one state) into state
+    buf = rec["view"]
+    off = int(rec["index"]["offset"][i])
+    seq = int(rec["index"]["seq"][i])
+    while True:
+        n, = a.FRAME_HDR.unpack_from(buf, off)
+        body = buf[off + a.FRAME_HDR.size:off + a.FRAME_HDR.size + n]
+        off += a.FRAME_HDR.size + n
+        if body[0] == a.S_PLAYER_INFO:
+            _, pid, r, g, b, ln = a.PLAYER_INFO_HDR.unpack_from(body)
+            start = a.PLAYER_INFO_HDR.size
+            state["info"][pid] = (bytes(body[start:start + ln]).decode("utf-8", errors="replace"), (r, g, b))
+        elif body[0] == a.S_STATE:
+            break
+    _, got, base, t, n_players, n_removed, n_bullets, n_bremoved = a.STATE_HDR.unpack_from(body)
+    if got != seq:
+        raise ValueError(f"{rec['path']}: index entry {i} points at snapshot {got}, expected {seq}")
+    players, bullets = state["players"], state["bullets"]
+    if not base:
+        # keyframe
+        players.clear()
+        bullets.clear()
+    off = a.STATE_HDR.size
+    end = off + n_players * a.PLAYER_REC.size
+    for pid, x, y, hp, kills in a.PLAYER_REC.iter_unpack(body[off:end]):
+        players[pid] = [x / a.POS_SCALE, y / a.POS_SCALE, hp, kills]
+    off, end = end, end + n_removed * a.ID_REC.size
+    for pid, in a.ID_REC.iter_unpack(body[off:end]):
+        players.pop(pid, None)
+    off, end = end, end + n_bullets * a.BULLET_REC.size
+    for bid, x, y, owner in a.BULLET_REC.iter_unpack(body[off:end]):
+        bullets[bid] = (x / a.POS_SCALE, y / a.POS_SCALE, owner)
+    off, end = end, end + n_bremoved * a.ID_REC.size
+    for bid, in a.ID_REC.iter_unpack(body[off:end]):
+        bullets.pop(bid, None)
+    state["pos"] = i
+
+def seek(rec, state, t):
+    # state as of t seconds into the recording: start over at the keyframe
+    # before t and apply the deltas up to t
+    index = rec["index"]
+    i = max(0, int(np.searchsorted(rec["times"], t, side="right")) - 1)
+    k = int(np.searchsorted(index["offset"], index["key"][i]))
+    state["players"].clear()
+    state["bullets"].clear()
+    for j in range(k, i + 1):
+        apply_record(rec, state, j)
+
+def advance(rec, state, t):
+    # play forward to t; long jumps go through seek()
+    times = rec["times"]
+    i = state["pos"]
+    if i < 0 or t < times[i] or t - times[i] > a.RECORD_KEYFRAME_INTERVAL:
+        seek(rec, state, t)
+        return
+    while i + 1 < len(times) and times[i + 1] <= t:
+        i += 1
+        apply_record(rec, state, i)
+
+def print_info(rec):
+    index = rec["index"]
+    times = rec["times"]
+    size = len(rec["data"])
+    duration = float(times[-1])
+    print(f"recording:  {rec['path']}")
+    print(f"started:    {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(rec['started']))}")
+    print(f"duration:   {duration:.1f}s")
+    print(f"snapshots:  {len(index)} (seq {index['seq'][0]}..{index['seq'][-1]})")
+    print(f"keyframes:  {len(np.unique(index['key']))}")
+    print(f"size:       {size} bytes ({size / max(duration, 1e-9):.0f} B/s)")
+
+def dump_state(rec, state):
+    i = state["pos"]
+    print(f"t={rec['times'][i]:.3f}s seq={rec['index']['seq'][i]} players={len(state['players'])} bullets={len(state['bullets'])}")
+    for pid, (x, y, hp, kills) in sorted(state["players"].items()):
+        name = state["info"].get(pid, ("?",))[0]
+        print(f"  player {pid:>5} {name:<16} x={x:7.1f} y={y:7.1f} hp={hp:3} kills={kills}")
+
+def run_viewer(rec, t=0.0):
+    import pygame as pg
+    pg.init()
+    screen = pg.display.set_mode((800, 600))
+    pg.display.set_caption(f"PyArena replay - {rec['path']}")
+    clock = pg.time.Clock()
+    font = pg.font.SysFont(None, 18)
+    state = new_state()
+    end = float(rec["times"][-1])
+    speed = SPEEDS.index(1.0)
+    paused = False
+    running = True
+    while running:
+        dt = clock.tick(60) / 1000.0
+        for ev in pg.event.get():
+            if ev.type == pg.QUIT:
+                running = False
+            elif ev.type == pg.KEYDOWN:
+                if ev.key == pg.K_ESCAPE:
+                    running = False
+                elif ev.key == pg.K_SPACE:
+                    paused = not paused
+                elif ev.key == pg.K_LEFT:
+                    t = max(0.0, t - SEEK_STEP)
+                elif ev.key == pg.K_RIGHT:
+                    t = min(end, t + SEEK_STEP)
+                elif ev.key == pg.K_UP:
+                    speed = min(len(SPEEDS) - 1, speed + 1)
+                elif ev.key == pg.K_DOWN:
+                    speed = max(0, speed - 1)
+                elif ev.key == pg.K_HOME:
+                    t = 0.0
+        if not paused:
+            t = min(end, t + dt * SPEEDS[speed])
+        advance(rec, state, t)
+
+        screen.fill((30,30,30))
+        for pid, (x, y, hp, kills) in state["players"].items():
+            pname, pcolor = state["info"].get(pid, ("?", (255,0,0)))
+            pg.draw.circle(screen, pcolor, (int(x), int(y)), 16)
+            name_surf = font.render(f"{pname} ({kills})", True, (240,240,240))
+            screen.blit(name_surf, (x - name_surf.get_width()//2, y - 24))
+            hp_w = 32 * (max(0, min(100, hp)) / 100.0)
+            pg.draw.rect(screen, (60,60,60), (x-16, y+18, 32, 6))
+            pg.draw.rect(screen, (200,30,30), (x-16, y+18, int(hp_w), 6))
+        for x, y, _ in state["bullets"].values():
+            pg.draw.circle(screen, (240,220,40), (int(x), int(y)), 6)
+
+        status = "paused" if paused else f"x{SPEEDS[speed]:g}"
+        hud = font.render(f"{t:6.1f}s / {end:.1f}s  {status}  -  SPACE pause, LEFT/RIGHT seek, UP/DOWN speed",
+                          True, (200,200,200))
+        screen.blit(hud, (8, 8))
+        pg.display.flip()
+    pg.quit()
+
+def main():
+    ap = argparse.ArgumentParser(description="replay an arena match recording")
+    ap.add_argument("path", help="recording written by arenatoken.py --record")
+    ap.add_argument("--info", action="store_true", help="print what is in the recording and exit")
+    ap.add_argument("--at", type=float, default=0.0, help="start this many seconds into the recording")
+    ap.add_argument("--dump", action="store_true", help="print the state at --at instead of opening a window")
+    args = ap.parse_args()
+    try:
+        rec = open_recording(args.path)
+    except (OSError, ValueError, struct.error) as e:
+        print(f"Cannot open recording: {e}")
+        sys.exit(1)
+    if args.info:
+        print_info(rec)
+        return
+    if args.dump:
+        state = new_state()
+        t0 = time.perf_counter()
+        seek(rec, state, args.at)
+        took = time.perf_counter() - t0
+        dump_state(rec, state)
+        print(f"seek took {took * 1000:.2f} ms")
+        return
+    run_viewer(rec, args.at)
+
+if __name__ == "__main__":
+    main()
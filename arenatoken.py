@@ -2,30 +2,294 @@
 # LAN multiplayer server for a simple arena game with UDP discovery, player HP, and bullets.
 # Run: python server.py
 
+import argparse
+import asyncio
+import bisect
+import collections
+import heapq
+import http.server
 import socket
 import threading
 import json
 import time
 import random
 import math
+import multiprocessing
+import multiprocessing.reduction
+import multiprocessing.shared_memory
+import os
+import struct
+import zlib
+
+import numpy as np
 
 HOST = "0.0.0.0"
 PORT = 5000
 DISCOVERY_PORT = 5001   # UDP beacon port
+UDP_PORT = 5002         # UDP game channel (position updates and state snapshots)
+METRICS_PORT = 5003     # local HTTP metrics endpoint, /metrics (text) and /metrics.json
+UDP_MAX_DATAGRAM = 8192 # bigger snapshots go over TCP instead
+UDP_TIMEOUT = 2.0       # fall back to TCP when a UDP client stops acking for this long
 BROADCAST_FPS = 20.0    # how many times per second server broadcasts states
 TICK_RATE = 60.0        # server physics tick rate
+ROOM_REPORT_INTERVAL = 1.0  # how often room processes report their player count (s)
+BEACON_INTERVAL = 1.0   # discovery beacon period (s)
+MAX_PLAYERS = 100       # capacity announced in beacons; clients prefer servers below it
+HEALTHY_TICK_P99 = 0.5  # ticks count as healthy while p99 duration stays under this share of the tick
+JOIN_TIMEOUT = 5.0      # the room front drops connections that do not send join in time (s)
+MAX_CATCHUP_TICKS = 5   # ticks run back to back after a stall; time beyond that is dropped
+TICK_REPORT_INTERVAL = 60.0  # print tick timing stats this often (s)
+TICK_BUCKETS = (0.0005, 0.001, 0.002, 0.004, 0.008, 0.016, 0.032, 0.064)  # tick duration histogram bounds (s)
+PLAYER_RADIUS = 16      # collision radius of a player (px)
+GRID_CELL = 32          # spatial hash cell size (px) for bullet/player collision
+MAX_BULLETS = 4096      # capacity of the bullet pool
+BULLET_SPEED = 420.0    # px/sec
+BULLET_TTL = 2.5        # seconds
+PLAYER_SPEED = 200.0    # px/sec of players moved by input commands (the client predicts with the same)
+PLAYER_BOUNDS = (10.0, 10.0, 790.0, 590.0)  # where a player can stand: x min, y min, x max, y max
+MAX_INPUT_CMDS = 16     # input commands per message (UDP messages repeat the unacknowledged ones)
+MAX_INPUT_MS = 250      # longest single input command (ms)
+INPUT_TIME_SLACK = 0.5  # input commands may run ahead of real time by this much (s), beyond that dt is cut
+INPUT_ACK_REPEAT = 3    # broadcasts that repeat a changed input ack to a UDP client, in case one is lost
+SNAPSHOT_HISTORY = 32   # snapshots kept as delta baselines (~1.6 s at 20 Hz)
+AOI_RADIUS = 0.0        # per-client area of interest (px); 0 sends every entity to every client
+AOI_FAR_RATE = 0.25     # update rate of players just outside the radius, as a fraction of snapshots
+AOI_CELLS = 1           # area-of-interest grid cells per AOI_RADIUS: smaller cells fit the radius closer, but fewer clients share one
+SEND_QUEUE_MAX = 64     # frames a client may have waiting before it counts as slow
+SLOW_CLIENT_TIMEOUT = 3.0  # disconnect a client whose queue has not moved for this long (s)
+INPUT_RATE = 60.0       # update/shoot messages per second a client may send; the rest is dropped
+INPUT_BURST = 60.0      # messages a client may send at once (e.g. a backlog after a network hiccup)
+SIM_MAX_PLAYERS = 1024  # players the shared snapshot has room for (--sim-process)
+SIM_RING_SIZE = 8192    # client input records the shared ring holds (--sim-process)
+
+# wire protocols, negotiated in join/join_ack. The handshake itself is always a
+# JSON line; after join_ack both sides switch to the chosen protocol.
+PROTO_JSON = 0          # newline-delimited JSON
+PROTO_BINARY = 1        # version 1 of the length-prefixed binary protocol
+SUPPORTED_PROTOCOLS = (PROTO_BINARY, PROTO_JSON)  # server preference order
+POS_SCALE = 8.0         # binary positions are int16 fixed point, 1/8 px
+# optional TCP compression: a client that offers "compress": [COMPRESS_ZLIB]
+# in join gets "compress": COMPRESS_ZLIB in join_ack (when the server runs
+# with --compress), and everything after join_ack is one zlib stream,
+# sync-flushed after every frame. No preset dictionary: the stream's own
+# window holds the previous snapshots, which match better than any sample
+# ("zlib1" used one).
+COMPRESS_ZLIB = "zlib2"
+COMPRESS_LEVEL = 1       # 4-5x cheaper than 6 for ~10% less ratio on snapshot streams
+COMPRESSION = False     # accept compression requests (--compress)
+
+# binary frames: u32 length + body, body[0] is the message type
+FRAME_HDR = struct.Struct("<I")
+S_PLAYER_INFO = 1       # server -> client: static player data, sent once per player
+S_STATE = 2             # server -> client: (delta) state snapshot
+C_UPDATE = 16           # client -> server
+C_SHOOT = 17
+C_ACK = 18
+C_QUIT = 19
+C_UDP_OK = 20           # client received our udp_ack, start sending snapshots over UDP
+C_UPDATE_SEQ = 21       # sequence-numbered update, used on the UDP channel
+C_INPUT = 22            # input mode: sequence-numbered movement commands
+S_INPUT_ACK = 3         # server -> client, input mode: last command applied and where it left the player
+PLAYER_INFO_HDR = struct.Struct("<BIBBBB")  # type, id, r, g, b, name length (+ utf-8 name)
+STATE_HDR = struct.Struct("<BIIdHHHH")      # type, seq, base (0 = full), time, #players, #removed, #bullets, #bullets removed
+PLAYER_REC = struct.Struct("<IhhBH")        # id, x, y, hp, kills
+BULLET_REC = struct.Struct("<IhhI")         # id, x, y, owner
+BULLET_SPAWN_REC = struct.Struct("<IhhhhdI")  # bullet events: id, x, y, vx, vy (fixed point), server time at x/y, owner
+ID_REC = struct.Struct("<I")
+BULLET_DTYPE = np.dtype([("id", "<u4"), ("x", "<i2"), ("y", "<i2"), ("owner", "<u4")])  # BULLET_REC as an array
+UPDATE_REC = struct.Struct("<Bhh")          # type, x, y
+SHOOT_REC = struct.Struct("<Bff")           # type, dx, dy
+ACK_REC = struct.Struct("<BI")              # type, seq
+UPDATE_SEQ_REC = struct.Struct("<BIhh")     # type, seq, x, y
+INPUT_HDR = struct.Struct("<BIB")           # type, seq of the first command, #commands (+ INPUT_CMD each)
+INPUT_CMD = struct.Struct("<BH")            # KEY_* bitmask, dt in ms
+INPUT_ACK_REC = struct.Struct("<BIff")      # type, seq, x, y
+KEY_UP, KEY_DOWN, KEY_LEFT, KEY_RIGHT = 1, 2, 4, 8
+
+# match recordings (--record PATH): PATH holds RECORD_HDR and then the
+# broadcast snapshots as binary protocol frames, a full one (keyframe, with
+# S_PLAYER_INFO frames for everybody in front) every RECORD_KEYFRAME_INTERVAL
+# seconds and deltas against the previous record in between. PATH.idx has
+# one INDEX_REC per record, so a viewer can find the keyframe for any time.
+RECORD_HDR = struct.Struct("<8sHd")         # magic, version, start time
+RECORD_MAGIC = b"ARENAREC"
+RECORD_VERSION = 1
+INDEX_REC = struct.Struct("<IdQQ")          # seq, time, offset of the record, offset of its keyframe
+RECORD_KEYFRAME_INTERVAL = 5.0  # seconds between keyframes
+RECORD_QUEUE_MAX = 256  # snapshots waiting for the writer before records are dropped
+RECORD_FLUSH_INTERVAL = 1.0  # at most this much recording is lost in a crash (s)
+
+class TimedLock:
+    # threading.Lock that keeps count of how long acquirers had to wait.
+    # The uncontended path is one non-blocking acquire, so it costs about
+    # the same as a plain lock.
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.acquires = 0
+        self.contended = 0
+        self.wait = 0.0
+        self.max_wait = 0.0
+
+    def __enter__(self):
+        if not self.lock.acquire(blocking=False):
+            t0 = time.perf_counter()
+            self.lock.acquire()
+            waited = time.perf_counter() - t0
+            # updated while holding the lock, so no increments are lost
+            self.contended += 1
+            self.wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        self.acquires += 1
+        return self
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+timed_locks = []  # every TimedLock, for the metrics endpoint
+
+def new_timed_lock(name):
+    lock = TimedLock(name)
+    timed_locks.append(lock)
+    return lock
 
 next_id = 1
-next_id_lock = threading.Lock()
+next_id_lock = new_timed_lock("next_id")
 
+# connection tables, shared by the network threads under clients_lock
 clients = {}  # client_socket -> player_id
-players = {}  # player_id -> {name, x, y, color, last_seen, hp, kills}
-players_lock = threading.Lock()
+clients_lock = new_timed_lock("clients")
+client_state = {}  # client_socket -> {"ack": last acked snapshot seq, "proto": PROTO_*, "known": player ids sent static info, "roster": broadcast roster they were checked against, "out": SendQueue, "last_seen", udp fields}
+udp_clients = {}  # (ip, port) -> client_socket, for clients that completed the UDP hello
+udp_sock = None   # bound in main(); None means TCP only
+
+class BulletPool:
+    # fixed-capacity struct-of-arrays bullet store. Slots are handed out from a
+    # free-list, lowest first, so live bullets stay packed under the high-water
+    # mark hw and the per-tick passes only look at [:hw]; a slot's id is the
+    # bullet's spawn sequence number (0 = free).
+    def __init__(self, capacity=MAX_BULLETS):
+        self.capacity = capacity
+        # x/y and vx/vy are column views, so one operation moves every bullet
+        self.pos = np.zeros((capacity, 2), dtype=np.float64)
+        self.vel = np.zeros((capacity, 2), dtype=np.float64)
+        self.x, self.y = self.pos.T
+        self.vx, self.vy = self.vel.T
+        self.ttl = np.full(capacity, np.inf)  # free slots never expire
+        self.owner = np.zeros(capacity, dtype=np.int32)
+        self.id = np.zeros(capacity, dtype=np.int64)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.free = list(range(capacity))  # heap of free slots
+        self.hw = 0  # slots from hw on are all free
+        self.next_id = 1
+        # id -> (id, x, y, vx, vy, time, owner): where a bullet was at a server
+        # time, all a client needs to simulate it (bullet events)
+        self.rows = {}
+        self.fresh = []  # slots spawned since the last stamp()
+
+    def __len__(self):
+        return self.capacity - len(self.free)
+
+    def spawn(self, x, y, vx, vy, owner, ttl=BULLET_TTL):
+        if not self.free:
+            return None  # pool exhausted, drop the shot
+        i = heapq.heappop(self.free)
+        if i >= self.hw:
+            self.hw = i + 1
+        bid = self.next_id
+        self.next_id += 1
+        self.x[i] = x
+        self.y[i] = y
+        self.vx[i] = vx
+        self.vy[i] = vy
+        self.ttl[i] = ttl
+        self.owner[i] = owner
+        self.id[i] = bid
+        self.alive[i] = True
+        self.fresh.append(i)
+        return bid
+
+    def step(self, dt):
+        # integrate every slot under hw (free slots have zero velocity) and expire by ttl
+        n = self.hw
+        if not n:
+            return 0
+        self.pos[:n] += self.vel[:n] * dt
+        ttl = self.ttl[:n]
+        ttl -= dt
+        expired = (ttl <= 0).nonzero()[0]
+        if len(expired):
+            self.kill(expired)
+        return len(expired)
+
+    def kill(self, slots):
+        slots = np.asarray(slots, dtype=np.intp)
+        for bid in self.id[slots].tolist():
+            self.rows.pop(bid, None)
+        self.alive[slots] = False
+        self.vel[slots] = 0.0
+        self.ttl[slots] = np.inf
+        self.id[slots] = 0
+        free = self.free
+        for i in slots.tolist():
+            heapq.heappush(free, i)
+        # lower hw past the free slots at its top
+        n = self.hw
+        alive = self.alive
+        while n and not alive[n - 1]:
+            n -= 1
+        self.hw = n
+
+    def stamp(self, now):
+        # spawn rows for the bullets spawned since the last call, taken where
+        # they are now (after their first step), at server time now
+        for i in self.fresh:
+            if self.alive[i]:
+                bid = int(self.id[i])
+                self.rows[bid] = (bid, float(self.x[i]), float(self.y[i]), float(self.vx[i]), float(self.vy[i]),
+                                  now, int(self.owner[i]))
+        self.fresh.clear()
+
+    def live_slots(self):
+        # slots of live bullets in spawn order
+        slots = self.alive[:self.hw].nonzero()[0]
+        if len(slots) > 1:
+            slots = slots[self.id[slots].argsort()]
+        return slots
+
+    def snapshot(self):
+        # -> (slots, ids, xs, ys, owners) as plain lists, in spawn order
+        s = self.live_slots()
+        xs, ys = self.pos[s].T.tolist()
+        return s.tolist(), self.id[s].tolist(), xs, ys, self.owner[s].tolist()
 
-bullets = []  # list of bullet dicts: {id, x, y, vx, vy, owner, ttl}
-bullets_lock = threading.Lock()
-next_bullet_id = 1
-next_bullet_lock = threading.Lock()
+# simulation state: only the sim thread (run_physics) touches players and
+# bullets. Network threads push commands, the broadcaster reads published.
+players = {}  # player_id -> {name, x, y, color, hp, kills}
+bullets = BulletPool(MAX_BULLETS)
+commands = collections.deque()  # ("join"/"input"/"shoot"/"quit", player_id, args...); append/popleft need no lock
+moves = {}  # player_id -> latest (x, y) not yet applied; network threads overwrite, the sim thread pops
+published = (0, {}, [], [], [], [], [])  # (tick, players snapshot, bullet ids, xs, ys, owners, spawn rows); replaced each tick, never modified
+input_acks = {}  # player_id -> (last input seq applied, x, y) of input mode players; replaced with published
+sim_tick = 0
+sim_shared = None  # in the --sim-process child: the shared memory, see start_sim_process()
+
+# physics scheduler timing, all in seconds; durations/jitters hold the last
+# few hundred ticks for percentiles
+tick_stats = {"ticks": 0, "overruns": 0, "dropped": 0, "max_duration": 0.0, "max_jitter": 0.0,
+              "durations": collections.deque(maxlen=600), "jitters": collections.deque(maxlen=600),
+              "hist": [0] * (len(TICK_BUCKETS) + 1),  # tick durations per TICK_BUCKETS bucket, last one is overflow
+              "duration_sum": 0.0,
+              "catchup": [0] * (MAX_CATCHUP_TICKS + 1)}  # wake-ups by number of ticks run
+# compression totals of closed connections; live ones are in their SendQueue
+compress_stats = {"clients": 0, "raw": 0, "sent": 0, "time": 0.0}
+# client input: updates accepted, updates overwritten by a newer one before
+# a tick applied them, update/shoot messages dropped by the rate limit
+input_stats = {"updates": 0, "coalesced": 0, "rate_limited": 0}
+# broadcaster timing and traffic; bytes of live clients are in their SendQueue
+broadcast_stats = {"count": 0, "time": 0.0, "max_time": 0.0, "encode_time": 0.0, "max_encode_time": 0.0,
+                   "tcp_bytes_closed": 0, "udp_bytes": 0,
+                   "rate_samples": collections.deque(maxlen=6)}  # (time, total bytes sent), about one per second
 
 def get_local_ip():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -45,118 +309,581 @@ def recv_lines(conn, buf):
         return None, buf
     if not data:
         return None, buf
-    buf += data.decode('utf-8', errors='ignore')
+    buf += data
     lines = []
-    while '\n' in buf:
-        line, buf = buf.split('\n', 1)
-        if line.strip():
-            lines.append(line.strip())
+    while b'\n' in buf:
+        line, buf = buf.split(b'\n', 1)
+        line = line.strip()
+        if line:
+            lines.append(line.decode('utf-8', errors='ignore'))
     return lines, buf
 
-def handle_client(conn, addr):
+def recv_frames(conn, buf):
+    # binary-protocol counterpart of recv_lines: returns complete frame bodies
+    try:
+        data = conn.recv(4096)
+    except Exception:
+        return None, buf
+    if not data:
+        return None, buf
+    buf += data
+    frames = []
+    while len(buf) >= FRAME_HDR.size:
+        n, = FRAME_HDR.unpack_from(buf)
+        end = FRAME_HDR.size + n
+        if len(buf) < end:
+            break
+        frames.append(buf[FRAME_HDR.size:end])
+        buf = buf[end:]
+    return frames, buf
+
+def recv_messages(conn, buf, proto):
+    # -> (list of message dicts, buf), or (None, buf) when the connection is gone
+    if proto == PROTO_BINARY:
+        frames, buf = recv_frames(conn, buf)
+        if frames is None:
+            return None, buf
+        msgs = []
+        for body in frames:
+            msg = decode_client_frame(body)
+            if msg is not None:
+                msgs.append(msg)
+        return msgs, buf
+    lines, buf = recv_lines(conn, buf)
+    if lines is None:
+        return None, buf
+    msgs = []
+    for line in lines:
+        try:
+            msg = json.loads(line)
+        except Exception:
+            continue
+        if isinstance(msg, dict):
+            msgs.append(msg)
+    return msgs, buf
+
+def quantize(v):
+    # float px -> int16 fixed point
+    try:
+        q = int(round(v * POS_SCALE))
+    except (ValueError, OverflowError):
+        return 0
+    return max(-32768, min(32767, q))
+
+def encode_frame(body):
+    return FRAME_HDR.pack(len(body)) + body
+
+def encode_player_info(pid, name, color):
+    try:
+        r, g, b = [max(0, min(255, int(c))) for c in color]
+    except Exception:
+        r, g, b = 255, 0, 0
+    raw = str(name).encode('utf-8')[:255]
+    return encode_frame(PLAYER_INFO_HDR.pack(S_PLAYER_INFO, int(pid), r, g, b, len(raw)) + raw)
+
+def encode_state_binary(msg, events=False):
+    # binary encoding of a build_state_msg() dict; names and colors are left
+    # out, they travel in S_PLAYER_INFO frames. events: the bullets are spawn
+    # rows (BULLET_SPAWN_REC) instead of positions
+    pl = msg["players"]
+    removed = msg.get("removed", ())
+    bl = msg["bullets"]
+    bremoved = msg.get("bullets_removed", ())
+    parts = [STATE_HDR.pack(S_STATE, msg["seq"], msg.get("base") or 0, msg["time"],
+                            len(pl), len(removed), len(bl), len(bremoved))]
+    pack = PLAYER_REC.pack
+    for pid, p in pl.items():
+        parts.append(pack(int(pid), quantize(p["x"]), quantize(p["y"]),
+                          max(0, min(255, int(p["hp"]))), max(0, min(65535, int(p["kills"])))))
+    parts.extend(ID_REC.pack(int(pid)) for pid in removed)
+    if events:
+        pack = BULLET_SPAWN_REC.pack
+        for bid, x, y, vx, vy, t, owner in bl:
+            parts.append(pack(bid, quantize(x), quantize(y), quantize(vx), quantize(vy), t, owner))
+    else:
+        pack = BULLET_REC.pack
+        for bid, x, y, owner in bl:
+            parts.append(pack(bid, quantize(x), quantize(y), owner))
+    parts.extend(ID_REC.pack(bid) for bid in bremoved)
+    return encode_frame(b"".join(parts))
+
+def encode_input_ack(proto, seq, x, y):
+    if proto == PROTO_BINARY:
+        return encode_frame(INPUT_ACK_REC.pack(S_INPUT_ACK, seq, x, y))
+    return (json.dumps({"type": "input_ack", "seq": seq, "x": x, "y": y}) + '\n').encode('utf-8')
+
+def encode_state_json(msg, cache=None):
+    # same text as json.dumps(msg), but with every player and bullet
+    # serialized once per broadcast when a cache is given
+    if cache is None:
+        return (json.dumps(msg) + '\n').encode('utf-8')
+    pcache, bcache = cache["pj"], cache["bj"]
+    parts = []
+    for pid, p in msg["players"].items():
+        frag = pcache.get(id(p))
+        if frag is None:
+            frag = pcache[id(p)] = json.dumps(pid) + ": " + json.dumps(p)
+        parts.append(frag)
+    players_txt = "{" + ", ".join(parts) + "}"
+    parts = []
+    for row in msg["bullets"]:
+        frag = bcache.get(id(row))
+        if frag is None:
+            frag = bcache[id(row)] = json.dumps(row)
+        parts.append(frag)
+    bullets_txt = "[" + ", ".join(parts) + "]"
+    head = json.dumps({k: v for k, v in msg.items() if k != "players" and k != "bullets"})
+    return (head[:-1] + ', "players": ' + players_txt + ', "bullets": ' + bullets_txt + '}\n').encode('utf-8')
+
+def new_encode_cache():
+    # per-broadcast JSON fragments, keyed by id() of the record objects of
+    # this broadcast's snapshot (only valid while that snapshot is alive)
+    return {"pj": {}, "bj": {}}
+
+def decode_client_frame(body):
+    # binary client frame -> the same dict a JSON client would have sent
+    if not body:
+        return None
+    mtype = body[0]
+    try:
+        if mtype == C_UPDATE:
+            _, x, y = UPDATE_REC.unpack_from(body)
+            return {"type": "update", "x": x / POS_SCALE, "y": y / POS_SCALE}
+        if mtype == C_SHOOT:
+            _, dx, dy = SHOOT_REC.unpack_from(body)
+            return {"type": "shoot", "dx": dx, "dy": dy}
+        if mtype == C_ACK:
+            _, seq = ACK_REC.unpack_from(body)
+            return {"type": "ack", "seq": seq}
+        if mtype == C_QUIT:
+            return {"type": "quit"}
+        if mtype == C_UDP_OK:
+            return {"type": "udp_ok"}
+        if mtype == C_UPDATE_SEQ:
+            _, seq, x, y = UPDATE_SEQ_REC.unpack_from(body)
+            return {"type": "update", "seq": seq, "x": x / POS_SCALE, "y": y / POS_SCALE}
+        if mtype == C_INPUT:
+            _, seq, n = INPUT_HDR.unpack_from(body)
+            cmds = INPUT_CMD.iter_unpack(body[INPUT_HDR.size:INPUT_HDR.size + n * INPUT_CMD.size])
+            return {"type": "input", "seq": seq, "cmds": [list(c) for c in cmds]}
+    except struct.error:
+        pass
+    return None
+
+class SendQueue:
+    # outbound frames of one client, drained by its own writer so a client
+    # with a full socket buffer never holds up the broadcast. Snapshots are
+    # replaceable: a newer one takes the place of one still waiting, other
+    # frames are always delivered, in order.
+    def __init__(self, wake=None):
+        self.items = collections.deque()  # (is_snapshot, bytes)
+        self.cond = threading.Condition()
+        self.wake = wake            # called on push, for writers that do not wait on cond
+        self.closed = False
+        self.moved = time.time()    # last time the writer took a frame or the queue became non-empty
+        self.drops = 0              # snapshots replaced before they were sent
+        self.max_depth = 0
+        self.sent = 0               # frames handed to the socket
+        self.sent_bytes = 0
+        self.zlib = None            # compressobj for everything pushed from now on
+        self.z_raw = 0              # bytes before compression, of the frames that were compressed
+        self.z_out = 0              # the same frames after compression
+        self.z_time = 0.0           # seconds spent compressing
+
+    def push(self, data, snapshot=False):
+        # -> False when the client is too slow to keep
+        with self.cond:
+            if self.closed:
+                return True
+            now = time.time()
+            if not self.items:
+                self.moved = now
+            elif snapshot:
+                for i, (is_snap, _, _) in enumerate(self.items):
+                    if is_snap:
+                        del self.items[i]
+                        self.drops += 1
+                        break
+            self.items.append((snapshot, data, self.zlib))
+            self.max_depth = max(self.max_depth, len(self.items))
+            self.cond.notify()
+            ok = len(self.items) <= SEND_QUEUE_MAX and now - self.moved <= SLOW_CLIENT_TIMEOUT
+        if self.wake is not None:
+            self.wake()
+        return ok
+
+    def pop(self, block=True):
+        # next frame, or None once closed (or when empty and not blocking)
+        with self.cond:
+            while not self.items:
+                if self.closed or not block:
+                    return None
+                self.cond.wait()
+            self.moved = time.time()
+            _, data, z = self.items.popleft()
+        if z is not None:
+            # compress at send time, not at push time: a waiting snapshot may
+            # still be replaced, and the stream must only hold what is sent.
+            # Only the queue's one writer gets here.
+            t0 = time.perf_counter()
+            self.z_raw += len(data)
+            data = z.compress(data) + z.flush(zlib.Z_SYNC_FLUSH)
+            self.z_time += time.perf_counter() - t0
+            self.z_out += len(data)
+        self.sent += 1
+        self.sent_bytes += len(data)
+        return data
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.items.clear()
+            self.cond.notify()
+        if self.wake is not None:
+            self.wake()
+
+    def depth(self):
+        return len(self.items)
+
+def compress_note(out):
+    # ", compressed x:1" for connection summaries
+    if out.zlib is None or not out.z_out:
+        return ""
+    return f", compressed {out.z_raw / out.z_out:.1f}:1"
+
+def send_loop(conn, out):
+    # writer thread of one client in the threaded server
+    try:
+        while True:
+            data = out.pop()
+            if data is None:
+                return
+            conn.sendall(data)
+    except OSError:
+        pass
+
+def kick(conn):
+    # close a client from another thread; shutdown() wakes its blocked reader/writer
+    try:
+        conn.shutdown(socket.SHUT_RDWR)
+    except Exception:
+        pass
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+def register_player(conn, msg, out):
+    # create the player for a "join" message and queue join_ack on out; -> (player_id, proto)
     global next_id
-    buffer = ""
+    with next_id_lock:
+        player_id = str(next_id)
+        next_id += 1
+    name = msg.get("name", f"Player{player_id}")
+    color = msg.get("color", [255,0,0])
+    # first protocol in our preference order that the client offers
+    offered = msg.get("protocols", [PROTO_JSON])
+    proto = next((p for p in SUPPORTED_PROTOCOLS if p in offered), PROTO_JSON)
+    # input mode: the client sends movement commands instead of positions
+    inputs = bool(msg.get("inputs"))
+    # bullet events: the client simulates bullets from their spawn rows, so
+    # it gets each bullet once and its removal, not its position every
+    # snapshot. Area of interest filters bullets by position, so not with it
+    events = bool(msg.get("bullet_events")) and AOI_RADIUS <= 0
+    udp_token = random.getrandbits(32)
+    # send ack with assigned id and the protocol for the rest of the session
+    resp = {"type":"join_ack", "id": player_id, "proto": proto}
+    if inputs:
+        resp["inputs"] = True
+    if events:
+        resp["bullet_events"] = True
+    if udp_sock is not None and msg.get("udp"):
+        # the client says hello on this port with the token to open the UDP channel
+        resp["udp_port"] = udp_sock.getsockname()[1]
+        resp["udp_token"] = udp_token
+    z = None
+    if COMPRESSION and COMPRESS_ZLIB in (msg.get("compress") or ()):
+        resp["compress"] = COMPRESS_ZLIB
+        z = zlib.compressobj(COMPRESS_LEVEL)
+    commands.append(("join", player_id, name, color, inputs))
+    with clients_lock:
+        # join_ack is queued before the broadcaster can see the connection,
+        # so no state frame can overtake it
+        out.push((json.dumps(resp) + '\n').encode('utf-8'))
+        # join_ack itself goes out plain, everything after it compressed
+        out.zlib = z
+        clients[conn] = player_id
+        client_state[conn] = {"ack": None, "proto": proto, "known": set(), "roster": 0,
+                              "udp_token": udp_token, "udp_addr": None,
+                              "udp": False, "udp_seq": -1, "ack_time": 0.0, "last_seen": time.time(),
+                              "views": {}, "out": out,
+                              "in_tokens": INPUT_BURST, "in_time": time.time(), "in_dropped": 0,
+                              "inputs": inputs, "input_seq": 0, "input_budget": INPUT_TIME_SLACK,
+                              "input_time": time.time(), "input_acked": None, "input_ack_left": 0,
+                              "events": events}
+    return player_id, proto
+
+def drop_client(conn):
+    # forget a connection and its player; call with clients_lock held
+    st = client_state.pop(conn, None)
+    if st is not None:
+        out = st["out"]
+        broadcast_stats["tcp_bytes_closed"] += out.sent_bytes
+        if out.zlib is not None:
+            compress_stats["clients"] += 1
+            compress_stats["raw"] += out.z_raw
+            compress_stats["sent"] += out.z_out
+            compress_stats["time"] += out.z_time
+    if st is not None and st["udp_addr"] is not None:
+        udp_clients.pop(st["udp_addr"], None)
+    pid = clients.pop(conn, None)
+    if pid is not None:
+        commands.append(("quit", pid))
+    return pid
+
+def handle_client(conn, addr, join=None, buf=b""):
+    # join, buf: the join message and the bytes that followed it, when the
+    # room front process already read them off the socket
     player_id = None
+    proto = PROTO_JSON
+    out = SendQueue()
+    threading.Thread(target=send_loop, args=(conn, out), daemon=True).start()
     try:
-        lines, buffer = recv_lines(conn, "")
-        if lines is None:
-            conn.close()
-            return
-        joined = False
-        buf = buffer
-        while not joined:
-            if lines:
-                for line in lines:
-                    try:
-                        msg = json.loads(line)
-                        if msg.get("type") == "join":
-                            with next_id_lock:
-                                player_id = str(next_id)
-                                next_id += 1
-                            name = msg.get("name", f"Player{player_id}")
-                            color = msg.get("color", [255,0,0])
-                            with players_lock:
-                                players[player_id] = {
-                                    "name": name,
-                                    "x": 100 + (int(player_id) * 37) % 600,
-                                    "y": 100 + (int(player_id) * 23) % 400,
-                                    "color": color,
-                                    "last_seen": time.time(),
-                                    "hp": 100,
-                                    "kills": 0
-                                }
-                                clients[conn] = player_id
-                            # send ack with assigned id
-                            resp = {"type":"join_ack", "id": player_id}
-                            conn.sendall((json.dumps(resp) + '\n').encode('utf-8'))
-                            joined = True
-                            break
-                    except Exception:
-                        continue
-            if not joined:
+        if join is not None:
+            player_id, proto = register_player(conn, join, out)
+        else:
+            lines, buf = recv_lines(conn, b"")
+            if lines is None:
+                conn.close()
+                return
+        while player_id is None:
+            for line in lines or ():
+                try:
+                    msg = json.loads(line)
+                    if msg.get("type") == "join":
+                        player_id, proto = register_player(conn, msg, out)
+                        break
+                except (ConnectionError, OSError):
+                    raise
+                except Exception:
+                    continue
+            if player_id is None:
                 lines, buf = recv_lines(conn, buf)
                 if lines is None:
                     conn.close()
                     return
 
-        partial_buf = buf
         while True:
-            lines, partial_buf = recv_lines(conn, partial_buf)
-            if lines is None:
+            msgs, buf = recv_messages(conn, buf, proto)
+            if msgs is None:
                 break
-            for line in lines:
-                try:
-                    msg = json.loads(line)
-                except Exception:
-                    continue
-                mtype = msg.get("type")
-                if mtype == "update":
-                    x = msg.get("x")
-                    y = msg.get("y")
-                    with players_lock:
-                        if player_id in players:
-                            try:
-                                players[player_id]["x"] = float(x)
-                                players[player_id]["y"] = float(y)
-                                players[player_id]["last_seen"] = time.time()
-                            except Exception:
-                                pass
-                elif mtype == "shoot":
-                    dx = msg.get("dx", 0.0)
-                    dy = msg.get("dy", 0.0)
-                    spawn_bullet_for(player_id, dx, dy)
-                elif mtype == "quit":
+            for msg in msgs:
+                if msg.get("type") == "quit":
                     raise ConnectionResetError()
+                handle_message(conn, player_id, msg)
     except (ConnectionResetError, ConnectionAbortedError, OSError):
         pass
     finally:
+        out.close()
         conn.close()
-        with players_lock:
-            if conn in clients:
-                pid = clients.pop(conn)
-                players.pop(pid, None)
-        print(f"Connection closed: {addr}")
+        with clients_lock:
+            drop_client(conn)
+        print(f"Connection closed: {addr} (snapshots dropped: {out.drops}, max queue: {out.max_depth}{compress_note(out)})")
+
+def take_input(st, now):
+    # token bucket per client for update/shoot messages; call with clients_lock held
+    tokens = min(INPUT_BURST, st["in_tokens"] + (now - st["in_time"]) * INPUT_RATE)
+    st["in_time"] = now
+    if tokens < 1.0:
+        st["in_tokens"] = tokens
+        st["in_dropped"] += 1
+        input_stats["rate_limited"] += 1
+        return False
+    st["in_tokens"] = tokens - 1.0
+    return True
+
+def handle_message(conn, player_id, msg):
+    # game messages from a joined client, over TCP or UDP
+    mtype = msg.get("type")
+    if mtype == "update":
+        try:
+            x = float(msg.get("x"))
+            y = float(msg.get("y"))
+        except Exception:
+            return
+        if not (math.isfinite(x) and math.isfinite(y)):
+            return
+        with clients_lock:
+            st = client_state.get(conn)
+            if st is None or st["inputs"]:
+                return  # input mode players are moved by the server only
+            if "seq" in msg:
+                # UDP: drop updates that arrive after a newer one
+                try:
+                    useq = int(msg["seq"])
+                except Exception:
+                    return
+                if useq <= st["udp_seq"]:
+                    return
+                st["udp_seq"] = useq
+            now = time.time()
+            st["last_seen"] = now
+            if not take_input(st, now):
+                return
+            input_stats["updates"] += 1
+            if player_id in moves:
+                # the sim has not applied the previous one yet: only the latest counts
+                input_stats["coalesced"] += 1
+            moves[player_id] = (x, y)
+    elif mtype == "input":
+        try:
+            seq = int(msg.get("seq"))
+            cmds = [(int(keys) & 15, max(0, min(MAX_INPUT_MS, int(ms)))) for keys, ms in msg["cmds"][:MAX_INPUT_CMDS]]
+        except Exception:
+            return
+        with clients_lock:
+            st = client_state.get(conn)
+            if st is None or not st["inputs"]:
+                return
+            now = time.time()
+            st["last_seen"] = now
+            # UDP messages repeat commands we may already have
+            skip = max(0, st["input_seq"] + 1 - seq)
+            if skip >= len(cmds):
+                # all seen: the client is still waiting, so its ack got lost
+                st["input_ack_left"] = max(st["input_ack_left"], 1)
+                return
+            if not take_input(st, now):
+                return
+            # moving for longer than real time passes is not allowed
+            budget = min(INPUT_TIME_SLACK, st["input_budget"] + now - st["input_time"])
+            st["input_time"] = now
+            for i in range(skip, len(cmds)):
+                keys, ms = cmds[i]
+                dt = min(ms / 1000.0, budget)
+                budget -= dt
+                commands.append(("input", player_id, seq + i, keys, dt))
+            st["input_budget"] = budget
+            st["input_seq"] = seq + len(cmds) - 1
+    elif mtype == "shoot":
+        try:
+            dx = float(msg.get("dx", 0.0))
+            dy = float(msg.get("dy", 0.0))
+        except Exception:
+            return
+        if not (math.isfinite(dx) and math.isfinite(dy)):
+            return
+        with clients_lock:
+            st = client_state.get(conn)
+            if st is None or not take_input(st, time.time()):
+                return
+        commands.append(("shoot", player_id, dx, dy))
+    elif mtype == "ack":
+        try:
+            seq = int(msg.get("seq"))
+        except Exception:
+            return
+        with clients_lock:
+            st = client_state.get(conn)
+            if st is not None and (st["ack"] is None or seq > st["ack"]):
+                st["ack"] = seq
+                st["ack_time"] = time.time()
+                if st["inputs"]:
+                    # an idle input mode client only sends acks
+                    st["last_seen"] = st["ack_time"]
+    elif mtype == "udp_ok":
+        with clients_lock:
+            st = client_state.get(conn)
+            if st is not None and st["udp_addr"] is not None:
+                st["udp"] = True
+                st["ack_time"] = time.time()
+
+def udp_loop(usock):
+    # UDP game channel: hello handshake plus sequence-numbered updates and acks
+    while True:
+        try:
+            data, addr = usock.recvfrom(65536)
+        except OSError:
+            continue
+        handle_datagram(usock, data, addr)
+
+def handle_datagram(usock, data, addr):
+    if not data:
+        return
+    if data[:1] == b"{" and b'"udp_hello"' in data:
+        # udp_hello is JSON in either protocol and the client repeats it until
+        # acked, so look for it before the session's decoder: an address we
+        # already know has lost our udp_ack and gets it again
+        try:
+            msg = json.loads(data)
+        except Exception:
+            msg = None  # a binary frame that only starts like one
+        if isinstance(msg, dict) and msg.get("type") == "udp_hello":
+            udp_hello(usock, addr, msg)
+            return
+    with clients_lock:
+        conn = udp_clients.get(addr)
+        st = client_state.get(conn) if conn is not None else None
+        player_id = clients.get(conn) if conn is not None else None
+    if st is not None and st["proto"] == PROTO_BINARY:
+        if len(data) <= FRAME_HDR.size:
+            return
+        msg = decode_client_frame(data[FRAME_HDR.size:])
+    else:
+        try:
+            msg = json.loads(data)
+        except Exception:
+            return
+    if not isinstance(msg, dict):
+        return
+    if player_id is not None and msg.get("type") in ("update", "input", "ack"):
+        handle_message(conn, player_id, msg)
+
+def udp_hello(usock, addr, msg):
+    pid = str(msg.get("id"))
+    with clients_lock:
+        for conn, st in client_state.items():
+            if clients.get(conn) == pid and st["udp_token"] == msg.get("token"):
+                if st["udp_addr"] is not None and st["udp_addr"] != addr:
+                    udp_clients.pop(st["udp_addr"], None)
+                st["udp_addr"] = addr
+                udp_clients[addr] = conn
+                break
+        else:
+            return
+    try:
+        usock.sendto(json.dumps({"type": "udp_ack"}).encode('utf-8'), addr)
+    except OSError:
+        pass
+
+def move_by_keys(x, y, keys, dt):
+    # one input command; BATTLEARENA.py predicts with the same arithmetic
+    dx = dy = 0.0
+    if keys & KEY_UP:
+        dy -= 1
+    if keys & KEY_DOWN:
+        dy += 1
+    if keys & KEY_LEFT:
+        dx -= 1
+    if keys & KEY_RIGHT:
+        dx += 1
+    if dx != 0 and dy != 0:
+        mul = (2**0.5)/2.0
+        dx *= mul
+        dy *= mul
+    x0, y0, x1, y1 = PLAYER_BOUNDS
+    return max(x0, min(x1, x + dx * PLAYER_SPEED * dt)), max(y0, min(y1, y + dy * PLAYER_SPEED * dt))
 
 def spawn_bullet_for(player_id, dx, dy):
-    global next_bullet_id
     # normalize direction
     mag = math.hypot(dx, dy)
     if mag <= 0.0001:
         return
     nx, ny = dx / mag, dy / mag
-    speed = 420.0  # px/sec
-    with players_lock:
-        p = players.get(player_id)
-        if not p:
-            return
-        sx = p["x"]
-        sy = p["y"]
-    with next_bullet_lock:
-        bid = str(next_bullet_id)
-        next_bullet_id += 1
-    b = {"id": bid, "x": sx + nx*20, "y": sy + ny*20, "vx": nx*speed, "vy": ny*speed, "owner": player_id, "ttl": 2.5}
-    with bullets_lock:
-        bullets.append(b)
+    p = players.get(player_id)
+    if not p:
+        return
+    bullets.spawn(p["x"] + nx*20, p["y"] + ny*20, nx*BULLET_SPEED, ny*BULLET_SPEED, int(player_id))
 
 def accept_thread(sock):
     print(f"Server (TCP) listening on {HOST}:{PORT}")
@@ -169,109 +896,830 @@ def accept_thread(sock):
         except Exception as e:
             print("Accept error:", e)
 
+def build_player_grid(players, cell=GRID_CELL):
+    # spatial hash: (cx, cy) -> [(order, pid, int_pid, x, y), ...]
+    # each player goes into every cell its hit circle overlaps, so a bullet only
+    # has to look at the single cell it is in.
+    grid = {}
+    for order, (pid, p) in enumerate(players.items()):
+        px, py = p["x"], p["y"]
+        if not (math.isfinite(px) and math.isfinite(py)):
+            continue  # can never be hit anyway
+        entry = (order, pid, int(pid), px, py)
+        x0 = int((px - PLAYER_RADIUS) // cell)
+        x1 = int((px + PLAYER_RADIUS) // cell)
+        y0 = int((py - PLAYER_RADIUS) // cell)
+        y1 = int((py + PLAYER_RADIUS) // cell)
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                bucket = grid.get((cx, cy))
+                if bucket is None:
+                    grid[(cx, cy)] = [entry]
+                else:
+                    bucket.append(entry)
+    return grid
+
+def find_hits(bullet_rows, players, cell=GRID_CELL):
+    # bullet_rows: iterable of (key, x, y, owner) with owner as an int player id.
+    # returns [(key, owner, victim_id), ...] in the same order a plain
+    # "every bullet vs every player" scan would produce them
+    if not players:
+        return []
+    grid = build_player_grid(players, cell)
+    r2 = PLAYER_RADIUS * PLAYER_RADIUS
+    hits = []
+    for key, bx, by, owner in bullet_rows:
+        if not (math.isfinite(bx) and math.isfinite(by)):
+            continue
+        bucket = grid.get((int(bx // cell), int(by // cell)))
+        if not bucket:
+            continue
+        found = None
+        for order, pid, ipid, px, py in bucket:
+            if ipid == owner:
+                continue
+            dx = bx - px
+            dy = by - py
+            if dx*dx + dy*dy <= r2:
+                if found is None:
+                    found = []
+                found.append((order, pid))
+        if found:
+            if len(found) > 1:
+                found.sort()  # keep players-dict order
+            for _, pid in found:
+                hits.append((key, owner, pid))
+    return hits
+
+def apply_commands():
+    # apply what the network threads queued since the last tick: first joins
+    # and quits, so a player's first move or shot is not looked up before
+    # the player exists, then the latest position of every player that moved,
+    # one per player however many updates arrived, then inputs and shots in
+    # order (shots leave from the moved position). Only the commands already
+    # queued are taken, so a flood cannot stall the tick.
+    if sim_shared is not None:
+        pull_inputs(sim_shared)
+    pop = commands.popleft
+    actions = []
+    for _ in range(len(commands)):
+        cmd = pop()
+        kind, pid = cmd[0], cmd[1]
+        if kind == "join":
+            players[pid] = {
+                "name": cmd[2],
+                "x": 100 + (int(pid) * 37) % 600,
+                "y": 100 + (int(pid) * 23) % 400,
+                "color": cmd[3],
+                "hp": 100,
+                "kills": 0
+            }
+            if cmd[4]:
+                # input mode: last input command applied, 0 = none yet
+                players[pid]["input_seq"] = 0
+        elif kind == "quit":
+            players.pop(pid, None)
+        else:
+            actions.append(cmd)
+    for pid in list(moves):
+        x, y = moves.pop(pid)
+        p = players.get(pid)
+        if p:
+            p["x"] = x
+            p["y"] = y
+    for cmd in actions:
+        kind, pid = cmd[0], cmd[1]
+        if kind == "input":
+            p = players.get(pid)
+            if p:
+                p["x"], p["y"] = move_by_keys(p["x"], p["y"], cmd[3], cmd[4])
+                p["input_seq"] = cmd[2]
+        elif kind == "shoot":
+            spawn_bullet_for(pid, cmd[2], cmd[3])
+
+def publish(bullet_lists=None):
+    # replace the published snapshot; readers take the tuple without a lock
+    # and must not modify it. bullet_lists: (ids, xs, ys, owners) if at hand.
+    global published, input_acks, sim_tick
+    if bullet_lists is None:
+        bullet_lists = bullets.snapshot()[1:]
+    bullets.stamp(time.time())
+    rows = bullets.rows
+    bullet_lists = tuple(bullet_lists) + ([rows[bid] for bid in bullet_lists[0]],)
+    sim_tick += 1
+    if sim_shared is not None:
+        # the server process builds the snapshot dicts from shared memory
+        write_shared(sim_shared, sim_tick, bullet_lists)
+        return
+    snap = {pid: {"name": p["name"], "x": p["x"], "y": p["y"], "color": p["color"], "hp": p["hp"], "kills": p["kills"]}
+            for pid, p in players.items()}
+    published = (sim_tick, snap) + bullet_lists
+    input_acks = {pid: (p["input_seq"], p["x"], p["y"]) for pid, p in players.items() if "input_seq" in p}
+
 def physics_tick(dt):
-    # move bullets, handle collisions
-    remove_bullets = []
-    with bullets_lock:
-        for b in bullets:
-            b["x"] += b["vx"] * dt
-            b["y"] += b["vy"] * dt
-            b["ttl"] -= dt
-            if b["ttl"] <= 0:
-                remove_bullets.append(b["id"])
-    if remove_bullets:
-        with bullets_lock:
-            bullets[:] = [bb for bb in bullets if bb["id"] not in remove_bullets]
+    # one simulation step, run by the sim thread only
+    apply_commands()
+
+    # move bullets and expire them by ttl (one vectorized pass each)
+    bullets.step(dt)
+    slots, ids, xs, ys, owners = bullets.snapshot()
 
     # check bullet-player collisions
-    to_remove = []
-    hits = []  # list of (bullet_owner, victim_id)
-    with bullets_lock:
-        snapshot_bullets = list(bullets)
-    with players_lock:
-        for b in snapshot_bullets:
-            bx, by = b["x"], b["y"]
-            owner = b["owner"]
-            for pid, p in players.items():
-                if pid == owner:
-                    continue
-                # simple circle collision (player radius 16)
-                dx = bx - p["x"]
-                dy = by - p["y"]
-                if dx*dx + dy*dy <= (16*16):
-                    # hit
-                    hits.append( (b["id"], owner, pid) )
+    hits = find_hits(zip(slots, xs, ys, owners), players) if slots else None  # list of (slot, owner, victim_id)
     if hits:
-        with bullets_lock:
-            bullets[:] = [bb for bb in bullets if bb["id"] not in {h[0] for h in hits}]
-        with players_lock:
-            for bid, owner, victim in hits:
-                v = players.get(victim)
-                if not v:
-                    continue
-                v["hp"] -= 25
-                if v["hp"] <= 0:
-                    # owner gets a kill
-                    if owner in players:
-                        players[owner]["kills"] = players[owner].get("kills",0) + 1
-                    # respawn victim
-                    players[victim]["hp"] = 100
-                    players[victim]["x"] = 50 + random.random()*700
-                    players[victim]["y"] = 50 + random.random()*500
+        bullets.kill(sorted({h[0] for h in hits}))
+        for _, owner, victim in hits:
+            v = players.get(victim)
+            if not v:
+                continue
+            v["hp"] -= 25
+            if v["hp"] <= 0:
+                # owner gets a kill
+                owner = str(owner)
+                if owner in players:
+                    players[owner]["kills"] = players[owner].get("kills",0) + 1
+                # respawn victim
+                players[victim]["hp"] = 100
+                players[victim]["x"] = 50 + random.random()*700
+                players[victim]["y"] = 50 + random.random()*500
+        publish()
+    else:
+        publish((ids, xs, ys, owners))
+
+def run_physics():
+    # fixed-step physics on the monotonic clock: an accumulator collects real
+    # time, each tick consumes 1/TICK_RATE of it, and between ticks we sleep
+    # until the next deadline. After a stall at most MAX_CATCHUP_TICKS run
+    # back to back, the rest of the backlog is dropped.
+    step = 1.0 / TICK_RATE
+    clock = time.perf_counter
+    stats = tick_stats
+    last = deadline = clock()
+    acc = 0.0
+    next_report = last + TICK_REPORT_INTERVAL
+    while True:
+        delay = deadline - clock()
+        if delay > 0:
+            time.sleep(delay)
+        now = clock()
+        # how late we woke up for this tick
+        jitter = now - deadline
+        stats["jitters"].append(jitter)
+        stats["max_jitter"] = max(stats["max_jitter"], jitter)
+        acc += now - last
+        last = now
+        n = 0
+        while acc >= step and n < MAX_CATCHUP_TICKS:
+            t0 = clock()
+            physics_tick(step)
+            took = clock() - t0
+            acc -= step
+            n += 1
+            stats["ticks"] += 1
+            stats["durations"].append(took)
+            stats["duration_sum"] += took
+            stats["hist"][bisect.bisect_left(TICK_BUCKETS, took)] += 1
+            stats["max_duration"] = max(stats["max_duration"], took)
+            if took > step:
+                stats["overruns"] += 1
+        stats["catchup"][n] += 1
+        if acc >= step:
+            stats["dropped"] += int(acc / step)
+            acc %= step
+        deadline = last + (step - acc)
+        if now >= next_report:
+            next_report = now + TICK_REPORT_INTERVAL
+            print(format_tick_stats())
+
+def format_tick_stats():
+    stats = tick_stats
+    d = sorted(stats["durations"])
+    j = sorted(stats["jitters"])
+    pct = lambda v, q: v[min(len(v) - 1, int(q * len(v)))] * 1000 if v else 0.0
+    return (f"Ticks: {stats['ticks']}, duration p50/p99/max {pct(d, 0.5):.2f}/{pct(d, 0.99):.2f}/"
+            f"{stats['max_duration'] * 1000:.2f} ms, jitter p50/p99/max {pct(j, 0.5):.2f}/{pct(j, 0.99):.2f}/"
+            f"{stats['max_jitter'] * 1000:.2f} ms, overruns {stats['overruns']}, dropped {stats['dropped']}")
+
+def build_state_msg(seq, now, cur, base_seq=None, base=None):
+    # full snapshot when there is no baseline, otherwise only what was added,
+    # changed or removed since the baseline the client acknowledged
+    cur_players, cur_bullets = cur
+    if base is None:
+        return {"type":"state", "seq": seq, "players": cur_players, "bullets": list(cur_bullets.values()), "time": now}
+    base_players, base_bullets = base
+    return {
+        "type": "state",
+        "seq": seq,
+        "base": base_seq,
+        "players": {pid: p for pid, p in cur_players.items() if base_players.get(pid) != p},
+        "removed": [pid for pid in base_players if pid not in cur_players],
+        "bullets": [row for bid, row in cur_bullets.items() if base_bullets.get(bid) != row],
+        "bullets_removed": [bid for bid in base_bullets if bid not in cur_bullets],
+        "time": now,
+    }
+
+def aoi_world(cur, bstate):
+    # per-broadcast data shared by every client's area-of-interest pass.
+    # Players keep the seq their record last changed: a player that has not
+    # changed since a baseline was where it is now, so what the baseline had
+    # follows from where the client was then. Players and bullets are sorted
+    # by the AOI grid cell they are in; a row of cells is one run.
+    cur_players, cur_bullets = cur
+    seq = bstate["seq"]
+    versions, gone = bstate["versions"], bstate["gone"]
+    for pid in versions.keys() - cur_players.keys():
+        gone.append((seq, pid))
+        del versions[pid]
+    while gone and gone[0][0] < seq - SNAPSHOT_HISTORY:
+        gone.popleft()
+    for pid, p in cur_players.items():
+        v = versions.get(pid)
+        if v is None or v[0] != p:
+            # encoded once per change, not once per broadcast
+            versions[pid] = (p, seq, PLAYER_REC.pack(int(pid), quantize(p["x"]), quantize(p["y"]),
+                                                     max(0, min(255, int(p["hp"]))),
+                                                     max(0, min(65535, int(p["kills"])))),
+                             seq if v is None else v[3])
+    pids = list(cur_players)
+    precs = list(cur_players.values())
+    vers = [versions[pid] for pid in pids]
+    rows = list(cur_bullets.values())
+    # a fixed grid over where players can stand plus the radius; anything
+    # beyond it goes into its edge cells, the distance check sorts it out
+    cell = AOI_RADIUS / AOI_CELLS
+    x0, y0, x1, y1 = PLAYER_BOUNDS
+    gx0, gy0 = math.floor((x0 - AOI_RADIUS) / cell), math.floor((y0 - AOI_RADIUS) / cell)
+    ncols = math.floor((x1 + AOI_RADIUS) / cell) - gx0 + 1
+    nrows = math.floor((y1 + AOI_RADIUS) / cell) - gy0 + 1
+    cells = np.arange(ncols * nrows + 1)
+    px = np.array([p["x"] for p in precs], dtype=np.float64)
+    py = np.array([p["y"] for p in precs], dtype=np.float64)
+    pcx = np.clip(np.floor(px / cell) - gx0, 0, ncols - 1).astype(np.intp)
+    pcy = np.clip(np.floor(py / cell) - gy0, 0, nrows - 1).astype(np.intp)
+    pkey = pcy * ncols + pcx
+    porder = np.argsort(pkey, kind="stable")
+    pjoin = np.array([v[3] for v in vers], dtype=np.int64)
+    fresh = np.flatnonzero(pjoin >= seq - SNAPSHOT_HISTORY)
+    # far players are refreshed by distance band: band 0 is the cells around
+    # a client, band b the rings of cells up to AOI_CELLS << b around it,
+    # sent every 1 / AOI_FAR_RATE snapshots in band 0 and twice as rarely
+    # with each band further out, like the rate falling with r / d
+    nbands = 1
+    while AOI_CELLS << (nbands - 1) < max(ncols, nrows):
+        nbands += 1
+    periods = None
+    if AOI_FAR_RATE > 0:
+        periods = np.ceil((1 << np.arange(nbands)) / AOI_FAR_RATE).astype(np.int64)
+    brec = np.empty(len(rows), dtype=BULLET_DTYPE)
+    if rows:
+        cols = list(zip(*rows))
+        bx = np.array(cols[1], dtype=np.float64)
+        by = np.array(cols[2], dtype=np.float64)
+        gx = np.clip(np.floor(bx / cell) - gx0, 0, ncols - 1).astype(np.intp)
+        gy = np.clip(np.floor(by / cell) - gy0, 0, nrows - 1).astype(np.intp)
+        bkey = gy * ncols + gx
+        brec["id"] = cols[0]
+        brec["x"] = np.clip(np.rint(bx * POS_SCALE), -32768, 32767)
+        brec["y"] = np.clip(np.rint(by * POS_SCALE), -32768, 32767)
+        brec["owner"] = cols[3]
+    else:
+        bx = by = np.zeros(0)
+        bkey = np.zeros(0, dtype=np.intp)
+    border = np.argsort(bkey, kind="stable")
+    bids = brec["id"].astype(np.int64)
+    # bullet id -> index (-1 for none); ids are handed out in order, so the
+    # live ones span a short range
+    id_lo = int(bids.min()) if len(bids) else 0
+    id_index = np.full(int(bids.max()) - id_lo + 1 if len(bids) else 1, -1, dtype=np.intp)
+    id_index[bids - id_lo] = np.arange(len(bids))
+    return {
+        "seq": seq,
+        "pids": pids,
+        "precs": precs,
+        # binary records as rows of bytes, which numpy gathers fastest
+        "prec": np.frombuffer(b"".join([v[2] for v in vers]), dtype=np.uint8).reshape(len(vers), PLAYER_REC.size),
+        "px": px,
+        "py": py,
+        "pcx": pcx,
+        "pcy": pcy,
+        "pseq": np.array([v[1] for v in vers], dtype=np.int64),  # seq the record last changed
+        "pjoin": pjoin,  # seq the player joined
+        "fresh": fresh[np.argsort(pjoin[fresh], kind="stable")],  # players some baseline may not have, by join seq
+        "porder": porder,  # player indices in grid order
+        "periods": periods,  # snapshots between refreshes per band, None: never
+        "gone": list(gone),
+        "rows": rows,
+        "bx": bx,
+        "by": by,
+        "bids": bids,
+        "id_lo": id_lo,
+        "id_index": id_index,
+        "brec": brec.view(np.uint8).reshape(len(brec), BULLET_DTYPE.itemsize),
+        "border": border,  # bullet indices in grid order
+        "grid": (cell, gx0, gy0, ncols, nrows, np.searchsorted(pkey[porder], cells),
+                 np.searchsorted(bkey[border], cells)),
+    }
+
+def expand_runs(lo, hi):
+    # -> (run of each element, element) for the index runs lo[k]:hi[k], in order
+    lens = hi - lo
+    ends = np.cumsum(lens)
+    run = np.repeat(np.arange(len(lo)), lens)
+    return run, np.arange(ends[-1] if len(ends) else 0) + np.repeat(lo - ends + lens, lens)
+
+def aoi_pick(world, cur, clients):
+    # what every client's area of interest takes this snapshot: the players
+    # within AOI_RADIUS of its own player, the players further away when
+    # their distance band is due for it (see aoi_world; staggered by player
+    # id), players that joined since its baseline, and the bullets within
+    # AOI_RADIUS. A player is left out when the baseline already had its
+    # current record: it has not changed since and was within the radius of
+    # where the client was then. What is near is found for the clients in
+    # one grid cell together, against the cells around it, and the bands
+    # come from runs of cells, so the work follows what the clients can see.
+    # clients: [(pid, baseline seq or None, baseline view or None), ...]
+    # -> [([player indices, ...], removed pids, visible bullet indices, removed bullet ids, view), ...]
+    # where a view is (has every player, x, y of the client's player, visible bullet ids)
+    cur_players = cur[0]
+    r2 = AOI_RADIUS * AOI_RADIUS
+    seq, periods = world["seq"], world["periods"]
+    cell, gx0, gy0, ncols, nrows, pstarts, bstarts = world["grid"]
+    px, py, pcx, pcy, porder = world["px"], world["py"], world["pcx"], world["pcy"], world["porder"]
+    pseq, pjoin = world["pseq"], world["pjoin"]
+    bx, by, bids, border, id_index = world["bx"], world["by"], world["bids"], world["border"], world["id_index"]
+    nplayers = len(px)
+    everything = np.arange(len(bx))
+    me = [cur_players.get(pid) for pid, _, _ in clients]
+    cx = np.array([p["x"] if p is not None else 0.0 for p in me])
+    cy = np.array([p["y"] if p is not None else 0.0 for p in me])
+    ccx = np.clip(np.floor(cx / cell) - gx0, 0, ncols - 1).astype(np.intp)
+    ccy = np.clip(np.floor(cy / cell) - gy0, 0, nrows - 1).astype(np.intp)
+    # group the clients by cell (-1: no player)
+    groups = {}
+    for i, key in enumerate((ccy * ncols + ccx).tolist()):
+        groups.setdefault(-1 if me[i] is None else key, []).append(i)
+    # from here on the clients are numbered group by group
+    perm = [i for members in groups.values() for i in members]
+    n = len(perm)
+    mx, my, mcx, mcy = cx[perm], cy[perm], ccx[perm], ccy[perm]
+    views = [clients[i][2] for i in perm]
+    acks = np.array([-1 if clients[i][1] is None else clients[i][1] for i in perm], dtype=np.int64)
+    lost = np.array([me[i] is None for i in perm], dtype=bool)
+    full = np.array([v is not None and v[0] for v in views], dtype=bool)
+    vmx = np.array([v[1] if v is not None else 0.0 for v in views])
+    vmy = np.array([v[2] if v is not None else 0.0 for v in views])
+    normal = ~lost & (acks >= 0)
+    # for the players: no client position without a baseline (every player
+    # goes, see below), no baseline position when it had every player
+    nmx = np.where(normal, mx, np.inf)
+    bmx = np.where(full, np.nan, vmx)
+    bmy = np.where(full, np.nan, vmy)
+    # the players and bullets near the clients of each cell
+    nk, nj, bk, bj = [], [], [], []
+    k0 = 0
+    for key, members in groups.items():
+        k1 = k0 + len(members)
+        if key >= 0:
+            gy, gx = divmod(key, ncols)
+            c0, c1 = max(gx - AOI_CELLS, 0), min(gx + AOI_CELLS, ncols - 1)
+            runs = [(y * ncols + c0, y * ncols + c1 + 1)
+                    for y in range(max(gy - AOI_CELLS, 0), min(gy + AOI_CELLS, nrows - 1) + 1)]
+            gmx = mx[k0:k1, None]
+            gmy = my[k0:k1, None]
+            near = np.concatenate([border[bstarts[a]:bstarts[b]] for a, b in runs])
+            dx = bx[near] - gmx
+            dy = by[near] - gmy
+            hit = (dx * dx + dy * dy <= r2).ravel().nonzero()[0]
+            rr = hit // len(near)
+            bk.append(rr + k0)
+            bj.append(near.take(hit - rr * len(near)))
+            cand = np.concatenate([porder[pstarts[a]:pstarts[b]] for a, b in runs])
+            qx = px[cand]
+            qy = py[cand]
+            dx = qx - nmx[k0:k1, None]
+            dy = qy - gmy
+            send = dx * dx + dy * dy <= r2
+            dx = qx - bmx[k0:k1, None]
+            dy = qy - bmy[k0:k1, None]
+            send &= (pseq[cand] > acks[k0:k1, None]) | (dx * dx + dy * dy > r2)
+            hit = send.ravel().nonzero()[0]
+            rr = hit // len(cand)
+            nk.append(rr + k0)
+            nj.append(cand.take(hit - rr * len(cand)))
+        k0 = k1
+    nk = np.concatenate(nk) if nk else np.zeros(0, dtype=np.intp)
+    nj = np.concatenate(nj) if nj else np.zeros(0, dtype=np.intp)
+    bk = np.concatenate(bk) if bk else np.zeros(0, dtype=np.intp)
+    bj = np.concatenate(bj) if bj else np.zeros(0, dtype=np.intp)
+    # the bands due for each client: per grid row the cells between the
+    # band's inner and outer ring, as up to two runs left and right of it
+    if periods is not None:
+        phase = np.array([int(clients[i][0]) if me[i] is not None else 0 for i in perm], dtype=np.int64)
+        due = ((seq + phase[:, None]) % periods == 0) & normal[:, None]
+    else:
+        due = np.zeros((n, 1), dtype=bool)
+    fk, fb = np.nonzero(due)
+    outer = (AOI_CELLS << fb)[:, None]
+    inner = np.where(fb[:, None] > 0, outer >> 1, -1)
+    y = np.arange(nrows)
+    dy = np.abs(y - mcy[fk][:, None])
+    fx = mcx[fk][:, None] + np.zeros_like(dy)
+    split = dy <= inner
+    lo = np.clip(np.stack([fx - outer, fx + inner + 1], axis=2), 0, ncols)
+    hi = np.clip(np.stack([np.where(split, fx - inner, fx + outer + 1), fx + outer + 1], axis=2), 0, ncols)
+    empty = np.stack([dy > outer, (dy > outer) | ~split], axis=2) | (hi <= lo)
+    base = (y * ncols)[None, :, None]
+    lo = pstarts[base + lo]
+    hi = np.where(empty, lo, pstarts[base + hi])
+    run, at = expand_runs(lo.ravel(), hi.ravel())
+    run //= 2 * nrows
+    fk, fj = fk[run], porder[at]
+    # band 0 only adds what is not near; leave out what the baseline had
+    # as above
+    dx = px[fj] - mx[fk]
+    dy = py[fj] - my[fk]
+    keep = (fb[run] > 0) | (dx * dx + dy * dy > r2)
+    dx = px[fj] - bmx[fk]
+    dy = py[fj] - bmy[fk]
+    keep &= (pseq[fj] > acks[fk]) | (dx * dx + dy * dy > r2)
+    fk, fj = fk[keep], fj[keep]
+    # no baseline or no player: every player, but for what a full baseline had
+    lk, lj = expand_runs(np.zeros(n, dtype=np.intp), np.where(normal, 0, nplayers))
+    keep = (pseq[lj] > acks[lk]) | ~full[lk]
+    lk, lj = lk[keep], lj[keep]
+    # players that joined since the baseline and are not in what was taken
+    fresh = world["fresh"]
+    lo = np.searchsorted(pjoin[fresh], acks, side="right")
+    sk, at = expand_runs(lo, np.where(normal, len(fresh), lo))
+    sj = fresh[at]
+    ring = np.maximum(np.abs(pcx[sj] - mcx[sk]), np.abs(pcy[sj] - mcy[sk]))
+    band = np.minimum(np.searchsorted(AOI_CELLS << np.arange(due.shape[1]), ring), due.shape[1] - 1)
+    dx = px[sj] - mx[sk]
+    dy = py[sj] - my[sk]
+    taken = (dx * dx + dy * dy <= r2) | due[sk, band]
+    sk, sj = sk[~taken], sj[~taken]
+    # bullets a baseline had that are gone or out of range now; the id of
+    # one that is gone looks up some other bullet
+    based = np.flatnonzero(acks >= 0)
+    ids = [views[k][3] for k in based.tolist()]
+    owner = np.repeat(based, [len(v) for v in ids])
+    ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+    still = np.zeros(len(ids), dtype=bool)
+    if len(bids):
+        bi = id_index.take(ids - world["id_lo"], mode="clip")
+        dx = bx.take(bi) - mx[owner]
+        dy = by.take(bi) - my[owner]
+        still = (bids.take(bi) == ids) & ((dx * dx + dy * dy <= r2) | lost[owner])
+    dropped = np.flatnonzero(~still)
+    gone_k = owner[dropped]
+    gone_ids = ids[dropped]
+    # split everything by client
+    seen = bids[bj]
+    every = np.arange(n + 1)
+    bcuts = np.searchsorted(bk, every).tolist()
+    gcuts = np.searchsorted(gone_k, every).tolist()
+    ncuts = np.searchsorted(nk, every).tolist()
+    pcuts = [(j, np.searchsorted(k, every)) for k, j in ((fk, fj), (lk, lj), (sk, sj))]
+    more = sum(np.diff(c) for _, c in pcuts).tolist()
+    pcuts = [(j, c.tolist()) for j, c in pcuts]
+    removed = {}
+    picks = [None] * n
+    mxs, mys, losts = mx.tolist(), my.tolist(), lost.tolist()
+    for k, i in enumerate(perm):
+        ack = clients[i][1]
+        if ack is not None and ack not in removed:
+            removed[ack] = [q for g, q in world["gone"] if g > ack and q not in cur_players]
+        players = [nj[ncuts[k]:ncuts[k + 1]]]
+        if more[k]:
+            players += [j[c[k]:c[k + 1]] for j, c in pcuts if c[k] < c[k + 1]]
+        if losts[k]:
+            vis, vids = everything, bids
+        else:
+            vis, vids = bj[bcuts[k]:bcuts[k + 1]], seen[bcuts[k]:bcuts[k + 1]]
+        picks[i] = (players, removed.get(ack, []), vis, gone_ids[gcuts[k]:gcuts[k + 1]],
+                    (losts[k] or ack is None, mxs[k], mys[k], vids))
+    return picks
+
+def aoi_state(pick, seq, now, world, base_seq, proto, cache):
+    # encode one client's area-of-interest snapshot from its aoi_pick() entry
+    # -> (view, encoded message)
+    changed, removed, visible, bremoved, view = pick
+    if proto == PROTO_BINARY:
+        # records straight from the per-broadcast encodings
+        prec = world["prec"]
+        parts = [STATE_HDR.pack(S_STATE, seq, base_seq or 0, now,
+                                sum(map(len, changed)), len(removed), len(visible), len(bremoved))]
+        parts.extend(prec.take(c, axis=0).tobytes() for c in changed)
+        parts.extend(ID_REC.pack(int(q)) for q in removed)
+        parts.append(world["brec"].take(visible, axis=0).tobytes())
+        parts.append(bremoved.astype("<u4").tobytes())
+        data = encode_frame(b"".join(parts))
+    else:
+        pids, precs, rows = world["pids"], world["precs"], world["rows"]
+        msg = {"type": "state", "seq": seq, "players": {pids[i]: precs[i] for c in changed for i in c.tolist()},
+               "bullets": [rows[i] for i in visible.tolist()], "time": now}
+        if base_seq is not None:
+            msg["base"] = base_seq
+            msg["removed"] = removed
+            msg["bullets_removed"] = bremoved.tolist()
+        data = encode_state_json(msg, cache)
+    return view, data
+
+def encode_state(msg, proto, events=False):
+    if proto == PROTO_BINARY:
+        return encode_state_binary(msg, events)
+    return encode_state_json(msg)
 
 def broadcast_loop():
     interval = 1.0 / BROADCAST_FPS
+    bstate = new_broadcast_state()
     while True:
         time.sleep(interval)
-        with players_lock:
-            snapshot = {pid: {"name": p["name"], "x": p["x"], "y": p["y"], "color": p["color"], "hp": p.get("hp",100), "kills": p.get("kills",0)} for pid,p in players.items()}
-            conns = list(clients.keys())
-        with bullets_lock:
-            bcopy = [ {"id": b["id"], "x": b["x"], "y": b["y"], "owner": b["owner"]} for b in bullets ]
-        if not conns:
-            continue
-        msg = {"type":"state", "players": snapshot, "bullets": bcopy, "time": time.time()}
-        data = (json.dumps(msg) + '\n').encode('utf-8')
-        for conn in conns:
+        broadcast_once(bstate)
+
+def new_broadcast_state():
+    # seq: last snapshot sequence number
+    # history: seq -> (players snapshot, bullets by id), the possible delta baselines
+    # events: the same with bullets as spawn rows, for bullet event clients
+    # players: pids of the last snapshot, roster: bumped whenever they change
+    # area of interest: versions: pid -> (player record, seq it changed,
+    # packed record, seq the player joined); gone: (seq, pid) of players that
+    # left within SNAPSHOT_HISTORY
+    return {"seq": 0, "history": {}, "events": {}, "players": set(), "roster": 0,
+            "versions": {}, "gone": collections.deque()}
+
+def broadcast_once(bstate):
+    # build this tick's snapshot, encode it once per (protocol, baseline) and
+    # queue it for every client. Only the clients' writers touch the sockets,
+    # so this serves both the threaded and the asyncio server.
+    t_start = time.perf_counter()
+    _, snapshot, ids, xs, ys, owners, spawns = published
+    acks = input_acks
+    with clients_lock:
+        conns = [(conn, st, clients.get(conn)) for conn, st in client_state.items()]
+    if not conns:
+        return
+    clock = time.perf_counter
+    encode_time = 0.0
+    # bullets go out as [id, x, y, owner] rows straight from the pool arrays
+    cur = (snapshot, dict(zip(ids, zip(ids, xs, ys, owners))))
+    history = bstate["history"]
+    seq = bstate["seq"] = bstate["seq"] + 1
+    history[seq] = cur
+    history.pop(seq - SNAPSHOT_HISTORY, None)
+    ev_history = bstate["events"]
+    if any(st["events"] for _, st, _ in conns):
+        # spawn rows do not change, so a delta only carries new bullets and removals
+        ev_history[seq] = (snapshot, dict(zip(ids, spawns)))
+    ev_history.pop(seq - SNAPSHOT_HISTORY, None)
+    now = time.time()
+    if recorder is not None:
+        recorder.record(seq, now, cur)
+    encoded = {}  # (protocol, baseline seq, bullet events) -> bytes, shared by every client on that baseline
+    if snapshot.keys() != bstate["players"]:
+        # players came or went: binary clients check what static info they lack
+        bstate["players"] = set(snapshot)
+        bstate["roster"] += 1
+    roster = bstate["roster"]
+    infos = {}  # pid -> encoded S_PLAYER_INFO frame
+    world = aoi_world(cur, bstate) if AOI_RADIUS > 0 else None
+    if world is not None:
+        # every client has its own view, so its own baselines
+        aoi_acks = []
+        for conn, st, pid in conns:
+            ack, views = st["ack"], st["views"]
+            if ack not in views:
+                ack = None
+            else:
+                # acks only move forward: older views can no longer be a baseline
+                for k in [k for k in views if k < ack]:
+                    del views[k]
+            aoi_acks.append(ack)
+        t0 = clock()
+        picks = aoi_pick(world, cur, [(pid, ack, st["views"].get(ack)) for (_, st, pid), ack in zip(conns, aoi_acks)])
+        encode_time += clock() - t0
+    cache = new_encode_cache()
+    slow = []  # clients whose send queue stopped moving
+    for n, (conn, st, pid) in enumerate(conns):
+        ack, proto, known = st["ack"], st["proto"], st["known"]
+        if world is not None:
+            ack = aoi_acks[n]
+            t0 = clock()
+            view, data = aoi_state(picks[n], seq, now, world, ack, proto, cache)
+            encode_time += clock() - t0
+            views = st["views"]
+            views[seq] = view
+            views.pop(seq - SNAPSHOT_HISTORY, None)
+        else:
+            events = st["events"]
+            hist = ev_history if events else history
+            if ack not in hist:
+                ack = None
+            data = encoded.get((proto, ack, events))
+            if data is None:
+                t0 = clock()
+                msg = build_state_msg(seq, now, hist[seq], ack, hist.get(ack))
+                data = encoded[(proto, ack, events)] = encode_state(msg, proto, events)
+                encode_time += clock() - t0
+        pre = b""
+        if proto == PROTO_BINARY and st["roster"] != roster:
+            st["roster"] = roster
+            if not known.issuperset(snapshot):
+                # static data for players this client has not heard about yet
+                parts = []
+                for qid in snapshot:
+                    if qid not in known:
+                        info = infos.get(qid)
+                        if info is None:
+                            p = snapshot[qid]
+                            info = infos[qid] = encode_player_info(qid, p["name"], p["color"])
+                        parts.append(info)
+                        known.add(qid)
+                pre = b"".join(parts)
+            if len(known) > len(snapshot):
+                known.intersection_update(snapshot)
+        if st["udp"] and now - st["ack_time"] > UDP_TIMEOUT:
+            # acks stopped arriving over UDP; assume it is blocked and go back to TCP
+            st["udp"] = False
+            print("UDP channel timed out, falling back to TCP for player", clients.get(conn))
+        out = st["out"]
+        ok = True
+        if pre:
+            # static info always goes on the reliable channel
+            ok = out.push(pre)
+        if st["udp"] and len(data) <= UDP_MAX_DATAGRAM:
             try:
-                conn.sendall(data)
-            except Exception:
+                udp_sock.sendto(data, st["udp_addr"])
+                broadcast_stats["udp_bytes"] += len(data)
+            except OSError:
                 pass
+        else:
+            ok = out.push(data, snapshot=True) and ok
+        if st["inputs"] and pid in acks:
+            # where the client's input commands got it, for its prediction;
+            # sent when it changes (also on a respawn), nothing while idle
+            a = acks[pid]
+            if a != st["input_acked"]:
+                st["input_acked"] = a
+                st["input_ack_left"] = INPUT_ACK_REPEAT if st["udp"] else 1
+            if st["input_ack_left"] > 0:
+                st["input_ack_left"] -= 1
+                frame = encode_input_ack(proto, *a)
+                if st["udp"]:
+                    try:
+                        udp_sock.sendto(frame, st["udp_addr"])
+                        broadcast_stats["udp_bytes"] += len(frame)
+                    except OSError:
+                        pass
+                else:
+                    ok = out.push(frame) and ok
+        if not ok:
+            slow.append(conn)
+    if slow:
+        with clients_lock:
+            for conn in slow:
+                out = client_state[conn]["out"] if conn in client_state else None
+                print("Disconnecting slow client", clients.get(conn),
+                      f"(queue: {out.depth() if out else 0}, snapshots dropped: {out.drops if out else 0})")
+                drop_client(conn)
+                kick(conn)
+    stats = broadcast_stats
+    took = time.perf_counter() - t_start
+    stats["count"] += 1
+    stats["time"] += took
+    stats["max_time"] = max(stats["max_time"], took)
+    stats["encode_time"] += encode_time
+    stats["max_encode_time"] = max(stats["max_encode_time"], encode_time)
+    samples = stats["rate_samples"]
+    if not samples or now - samples[-1][0] >= 1.0:
+        samples.append((now, bytes_sent_total()))
+
+class Recorder:
+    # writes broadcast snapshots to a recording from a background thread.
+    # record() only appends to a queue, so the broadcaster never waits on
+    # encoding or the disk; if the writer falls behind, snapshots are dropped
+    # and the next one written is a keyframe.
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "wb")
+        self.idx = open(path + ".idx", "wb")
+        self.f.write(RECORD_HDR.pack(RECORD_MAGIC, RECORD_VERSION, time.time()))
+        self.offset = RECORD_HDR.size
+        self.queue = collections.deque()
+        self.wake = threading.Event()
+        self.lost = False       # set by the producer when it had to drop a snapshot
+        self.records = 0
+        self.keyframes = 0
+        self.dropped = 0
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def record(self, seq, now, cur):
+        # called by the broadcaster; cur is never modified after this
+        if len(self.queue) >= RECORD_QUEUE_MAX:
+            self.dropped += 1
+            self.lost = True
+            return
+        self.queue.append((seq, now, cur, self.lost))
+        self.lost = False
+        self.wake.set()
+
+    def run(self):
+        base = None     # (seq, snapshot) of the last record written
+        key_time = None
+        key_offset = 0
+        next_flush = time.time() + RECORD_FLUSH_INTERVAL
+        while True:
+            self.wake.wait(RECORD_FLUSH_INTERVAL)
+            self.wake.clear()
+            while self.queue:
+                seq, now, cur, gap = self.queue.popleft()
+                parts = []
+                if base is None or gap or now - key_time >= RECORD_KEYFRAME_INTERVAL:
+                    # keyframe: self-contained, so a viewer can start here
+                    for pid, p in cur[0].items():
+                        parts.append(encode_player_info(pid, p["name"], p["color"]))
+                    parts.append(encode_state_binary(build_state_msg(seq, now, cur)))
+                    key_time = now
+                    key_offset = self.offset
+                    self.keyframes += 1
+                else:
+                    for pid, p in cur[0].items():
+                        if pid not in base[1][0]:
+                            parts.append(encode_player_info(pid, p["name"], p["color"]))
+                    parts.append(encode_state_binary(build_state_msg(seq, now, cur, base[0], base[1])))
+                data = b"".join(parts)
+                self.f.write(data)
+                self.idx.write(INDEX_REC.pack(seq, now, self.offset, key_offset))
+                self.offset += len(data)
+                self.records += 1
+                base = (seq, cur)
+            if time.time() >= next_flush:
+                next_flush = time.time() + RECORD_FLUSH_INTERVAL
+                # data before index, so every index entry points at data on disk
+                self.f.flush()
+                self.idx.flush()
+
+recorder = None  # Recorder when --record is given
+
+def bytes_sent_total():
+    # TCP bytes handed to client sockets, including clients that left, plus UDP snapshots
+    with clients_lock:
+        live = sum(st["out"].sent_bytes for st in client_state.values())
+        return live + broadcast_stats["tcp_bytes_closed"] + broadcast_stats["udp_bytes"]
 
 def reap_inactive():
     while True:
         time.sleep(5)
-        now = time.time()
+        reap_once()
+
+def reap_once():
+    now = time.time()
+    with clients_lock:
+        stale = [conn for conn, st in client_state.items() if now - st["last_seen"] > 12]
+        if not stale:
+            return
         to_remove = []
-        with players_lock:
-            for pid, p in list(players.items()):
-                if now - p.get("last_seen", 0) > 12:
-                    to_remove.append(pid)
-            if to_remove:
-                remove_conns = []
-                for conn, pidc in list(clients.items()):
-                    if pidc in to_remove:
-                        try:
-                            conn.close()
-                        except Exception:
-                            pass
-                        remove_conns.append(conn)
-                for conn in remove_conns:
-                    clients.pop(conn, None)
-                for pid in to_remove:
-                    players.pop(pid, None)
-                if to_remove:
-                    print("Reaped inactive players:", to_remove)
-
-def discovery_beacon():
+        for conn in stale:
+            # shutdown wakes the reader and send_loop threads blocked on it
+            kick(conn)
+            to_remove.append(drop_client(conn))
+    print("Reaped inactive players:", to_remove)
+
+def tick_health(last):
+    # -> (healthy, tick duration p99 in ms) over the recent ticks. Unhealthy
+    # when the p99 eats too much of the tick budget or ticks were dropped
+    # since the previous call; last: {"dropped": count at that call}
+    d = sorted(tick_stats["durations"])
+    p99 = d[min(len(d) - 1, int(0.99 * len(d)))] if d else 0.0
+    dropped = tick_stats["dropped"] - last.get("dropped", tick_stats["dropped"])
+    last["dropped"] = tick_stats["dropped"]
+    return p99 < HEALTHY_TICK_P99 / TICK_RATE and dropped == 0, p99 * 1000
+
+def discovery_beacon(rooms=None):
+    # announce this server once a second, with its load so clients can
+    # pick the least loaded server on the LAN; rooms: when we are the front
     udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     udp.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
     udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     local_ip = get_local_ip()
     payload = {"type":"server_announce", "host": local_ip, "tcp_port": PORT, "name": "PyArenaServer"}
-    b = (json.dumps(payload)).encode('utf-8')
     print(f"Discovery beacon running (UDP port {DISCOVERY_PORT}) advertising {local_ip}:{PORT}")
+    last = {}
     while True:
+        if rooms:
+            live = [r for r in rooms if r["players"] != float("inf")]
+            payload["players"] = sum(r["players"] for r in live)
+            payload["capacity"] = MAX_PLAYERS * len(live)
+            payload["healthy"] = bool(live) and all(r["healthy"] for r in live)
+            payload["tick_p99_ms"] = round(max((r["tick_p99_ms"] for r in live), default=0.0), 3)
+        else:
+            healthy, p99 = tick_health(last)
+            with clients_lock:
+                payload["players"] = len(clients)
+            payload["capacity"] = MAX_PLAYERS
+            payload["healthy"] = healthy
+            payload["tick_p99_ms"] = round(p99, 3)
+        b = (json.dumps(payload)).encode('utf-8')
         try:
             udp.sendto(b, ('<broadcast>', DISCOVERY_PORT))
         except Exception:
@@ -279,43 +1727,760 @@ def discovery_beacon():
                 udp.sendto(b, ('255.255.255.255', DISCOVERY_PORT))
             except Exception:
                 pass
+        time.sleep(BEACON_INTERVAL)
+
+# ----------------- asyncio server mode -----------------
+# One event loop (in its own thread) runs accept, every client reader, the UDP
+# channel, the broadcast schedule and the reaper. Physics keeps the main thread,
+# which now competes with one network thread instead of one per client.
+
+class AsyncConn:
+    # stands in for a client socket in clients/client_state so the shared
+    # join, broadcast and reaper code can keep calling close()/shutdown()
+    def __init__(self, writer):
+        self.writer = writer
+
+    def close(self):
+        self.writer.close()
+
+    def shutdown(self, how):
+        # drop whatever is still buffered, for clients that stopped reading
+        self.writer.transport.abort()
+
+async def send_task(conn, out, wake):
+    # writer of one client in the asyncio server; drain() waits while the
+    # transport buffer is full, and the frames meanwhile wait in out
+    try:
+        while True:
+            data = out.pop(block=False)
+            if data is None:
+                if out.closed:
+                    return
+                await wake.wait()
+                wake.clear()
+                continue
+            conn.writer.write(data)
+            await conn.writer.drain()
+    except (ConnectionError, OSError):
+        pass
+
+class ArenaDatagramProtocol(asyncio.DatagramProtocol):
+    def datagram_received(self, data, addr):
+        handle_datagram(udp_sock, data, addr)
+
+async def handle_client_async(reader, writer):
+    conn = AsyncConn(writer)
+    addr = writer.get_extra_info("peername")
+    print("Client connected from", addr)
+    player_id = None
+    wake = asyncio.Event()
+    out = SendQueue(wake.set)
+    sender = asyncio.create_task(send_task(conn, out, wake))
+    try:
+        while player_id is None:
+            line = await reader.readline()
+            if not line:
+                return
+            try:
+                msg = json.loads(line)
+            except Exception:
+                continue
+            if isinstance(msg, dict) and msg.get("type") == "join":
+                player_id, proto = register_player(conn, msg, out)
+
+        while True:
+            if proto == PROTO_BINARY:
+                n, = FRAME_HDR.unpack(await reader.readexactly(FRAME_HDR.size))
+                msg = decode_client_frame(await reader.readexactly(n))
+            else:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    msg = json.loads(line)
+                except Exception:
+                    continue
+            if not isinstance(msg, dict):
+                continue
+            if msg.get("type") == "quit":
+                break
+            handle_message(conn, player_id, msg)
+    except (asyncio.IncompleteReadError, ConnectionError, OSError):
+        pass
+    finally:
+        out.close()
+        sender.cancel()
+        writer.close()
+        with clients_lock:
+            drop_client(conn)
+        print(f"Connection closed: {addr} (snapshots dropped: {out.drops}, max queue: {out.max_depth}{compress_note(out)})")
+
+async def broadcast_task():
+    # fixed schedule against the loop clock, so slow ticks do not add drift
+    loop = asyncio.get_running_loop()
+    interval = 1.0 / BROADCAST_FPS
+    bstate = new_broadcast_state()
+    deadline = loop.time()
+    while True:
+        deadline += interval
+        await asyncio.sleep(max(0.0, deadline - loop.time()))
+        if loop.time() - deadline > interval:
+            deadline = loop.time()  # fell far behind, do not burst
+        broadcast_once(bstate)
+
+async def reap_task():
+    while True:
+        await asyncio.sleep(5)
+        reap_once()
+
+async def serve_async(sock):
+    loop = asyncio.get_running_loop()
+    server = await asyncio.start_server(handle_client_async, sock=sock)
+    if udp_sock is not None:
+        await loop.create_datagram_endpoint(ArenaDatagramProtocol, sock=udp_sock)
+    tasks = [asyncio.create_task(broadcast_task()), asyncio.create_task(reap_task())]  # keep references so the tasks are not collected
+    print(f"Server (TCP, asyncio) listening on {HOST}:{PORT}")
+    async with server:
+        await server.serve_forever()
+
+# --- metrics endpoint ---
+
+def collect_metrics():
+    # one consistent-enough look at the server, read without stopping the sim
+    tick, snap, ids = published[0], published[1], published[2]
+    ts = tick_stats
+    bs = broadcast_stats
+    with clients_lock:
+        queues = [(clients.get(conn), st["out"], st["in_dropped"]) for conn, st in client_state.items()]
+        zq = [st["out"] for st in client_state.values() if st["out"].zlib is not None]
+    cs = compress_stats
+    z_raw = cs["raw"] + sum(out.z_raw for out in zq)
+    z_out = cs["sent"] + sum(out.z_out for out in zq)
+    durations = sorted(ts["durations"])
+    jitters = sorted(ts["jitters"])
+    pct = lambda v, q: v[min(len(v) - 1, int(q * len(v)))] if v else 0.0
+    samples = list(bs["rate_samples"])
+    rate = 0.0
+    if len(samples) >= 2 and samples[-1][0] > samples[0][0]:
+        rate = (samples[-1][1] - samples[0][1]) / (samples[-1][0] - samples[0][0])
+    return {
+        "tick": {
+            "count": ts["ticks"],
+            "rate": TICK_RATE,
+            "duration_buckets": [[le, n] for le, n in zip(list(TICK_BUCKETS) + ["+Inf"], ts["hist"])],
+            "duration_sum": ts["duration_sum"],
+            "duration_p50": pct(durations, 0.5),
+            "duration_p99": pct(durations, 0.99),
+            "duration_max": ts["max_duration"],
+            "jitter_p50": pct(jitters, 0.5),
+            "jitter_p99": pct(jitters, 0.99),
+            "jitter_max": ts["max_jitter"],
+            "overruns": ts["overruns"],
+            "dropped": ts["dropped"],
+            "catchup_steps": {str(n): c for n, c in enumerate(ts["catchup"])},
+        },
+        "broadcast": {
+            "count": bs["count"],
+            "time_sum": bs["time"],
+            "time_max": bs["max_time"],
+            "encode_time_sum": bs["encode_time"],
+            "encode_time_max": bs["max_encode_time"],
+            "bytes_sent": bytes_sent_total(),
+            "bytes_per_second": rate,
+        },
+        "record": {"records": recorder.records, "keyframes": recorder.keyframes, "dropped": recorder.dropped,
+                   "bytes": recorder.offset, "queued": len(recorder.queue)} if recorder else None,
+        "compression": {"clients": len(zq), "closed_clients": cs["clients"], "raw_bytes": z_raw, "bytes": z_out,
+                        "ratio": z_raw / z_out if z_out else 0.0,
+                        "seconds": cs["time"] + sum(out.z_time for out in zq)},
+        "input": dict(input_stats),
+        "sim_process": dict(sim_link_stats) if sim_link_stats else None,
+        "world": {"tick": tick, "players": len(snap), "bullets": len(ids), "commands_queued": len(commands)},
+        "clients": [{"player": pid, "queue_depth": out.depth(), "queue_max": out.max_depth,
+                     "snapshots_dropped": out.drops, "bytes_sent": out.sent_bytes, "inputs_dropped": dropped,
+                     "compression_ratio": out.z_raw / out.z_out if out.z_out else None}
+                    for pid, out, dropped in queues],
+        "locks": {l.name: {"acquires": l.acquires, "contended": l.contended, "wait_sum": l.wait,
+                           "wait_max": l.max_wait} for l in timed_locks},
+    }
+
+def format_metrics_text(m):
+    # Prometheus text format, all times in seconds
+    t, b, w = m["tick"], m["broadcast"], m["world"]
+    lines = []
+    add = lines.append
+    add("# TYPE arena_tick_duration_seconds histogram")
+    total = 0
+    for le, n in t["duration_buckets"]:
+        total += n
+        add(f'arena_tick_duration_seconds_bucket{{le="{le}"}} {total}')
+    add(f"arena_tick_duration_seconds_sum {t['duration_sum']:.6f}")
+    add(f"arena_tick_duration_seconds_count {t['count']}")
+    add(f"arena_tick_duration_max_seconds {t['duration_max']:.6f}")
+    add(f"arena_tick_jitter_seconds{{quantile=\"0.5\"}} {t['jitter_p50']:.6f}")
+    add(f"arena_tick_jitter_seconds{{quantile=\"0.99\"}} {t['jitter_p99']:.6f}")
+    add(f"arena_tick_jitter_max_seconds {t['jitter_max']:.6f}")
+    add(f"arena_tick_overruns_total {t['overruns']}")
+    add(f"arena_ticks_dropped_total {t['dropped']}")
+    for n, c in t["catchup_steps"].items():
+        add(f'arena_tick_wakeups_total{{steps="{n}"}} {c}')
+    add(f"arena_broadcasts_total {b['count']}")
+    add(f"arena_broadcast_seconds_sum {b['time_sum']:.6f}")
+    add(f"arena_broadcast_max_seconds {b['time_max']:.6f}")
+    add(f"arena_broadcast_encode_seconds_sum {b['encode_time_sum']:.6f}")
+    add(f"arena_broadcast_encode_max_seconds {b['encode_time_max']:.6f}")
+    add(f"arena_bytes_sent_total {b['bytes_sent']}")
+    add(f"arena_bytes_sent_per_second {b['bytes_per_second']:.1f}")
+    r = m["record"]
+    if r:
+        add(f"arena_record_snapshots_total {r['records']}")
+        add(f"arena_record_keyframes_total {r['keyframes']}")
+        add(f"arena_record_dropped_total {r['dropped']}")
+        add(f"arena_record_bytes_total {r['bytes']}")
+        add(f"arena_record_queued {r['queued']}")
+    z = m["compression"]
+    add(f"arena_compressed_clients {z['clients']}")
+    add(f"arena_compress_raw_bytes_total {z['raw_bytes']}")
+    add(f"arena_compress_bytes_total {z['bytes']}")
+    add(f"arena_compress_seconds_total {z['seconds']:.6f}")
+    sp = m["sim_process"]
+    if sp:
+        add(f"arena_sim_snapshots_total {sp['snapshots']}")
+        add(f"arena_sim_torn_reads_total {sp['torn_reads']}")
+        add(f"arena_sim_ring_full_total {sp['ring_full']}")
+    i = m["input"]
+    add(f"arena_input_updates_total {i['updates']}")
+    add(f"arena_input_updates_coalesced_total {i['coalesced']}")
+    add(f"arena_input_rate_limited_total {i['rate_limited']}")
+    add(f"arena_players {w['players']}")
+    add(f"arena_bullets {w['bullets']}")
+    add(f"arena_commands_queued {w['commands_queued']}")
+    add(f"arena_clients {len(m['clients'])}")
+    for c in m["clients"]:
+        label = f'player="{c["player"]}"'
+        add(f"arena_send_queue_depth{{{label}}} {c['queue_depth']}")
+        add(f"arena_send_queue_max_depth{{{label}}} {c['queue_max']}")
+        add(f"arena_snapshots_dropped_total{{{label}}} {c['snapshots_dropped']}")
+        add(f"arena_client_bytes_sent_total{{{label}}} {c['bytes_sent']}")
+        add(f"arena_client_inputs_dropped_total{{{label}}} {c['inputs_dropped']}")
+        if c["compression_ratio"] is not None:
+            add(f"arena_client_compression_ratio{{{label}}} {c['compression_ratio']:.3f}")
+    for name, l in m["locks"].items():
+        label = f'lock="{name}"'
+        add(f"arena_lock_acquires_total{{{label}}} {l['acquires']}")
+        add(f"arena_lock_contended_total{{{label}}} {l['contended']}")
+        add(f"arena_lock_wait_seconds_sum{{{label}}} {l['wait_sum']:.6f}")
+        add(f"arena_lock_wait_max_seconds{{{label}}} {l['wait_max']:.6f}")
+    return "\n".join(lines) + "\n"
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/metrics":
+            body = format_metrics_text(collect_metrics()).encode('utf-8')
+            ctype = "text/plain; version=0.0.4"
+        elif path == "/metrics.json":
+            body = json.dumps(collect_metrics()).encode('utf-8')
+            ctype = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # no line per scrape
+
+def start_metrics(port):
+    # serve the metrics on localhost only; None when disabled or the port is taken
+    if not port:
+        return None
+    try:
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    except OSError as e:
+        print("Metrics endpoint disabled:", e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Metrics on http://127.0.0.1:{port}/metrics (and /metrics.json)")
+    return server
+
+def open_udp(host, port):
+    # UDP game channel socket, or None when disabled or the port is taken
+    if not port:
+        return None
+    try:
+        usock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        usock.bind((host, port))
+    except OSError as e:
+        print("UDP game channel disabled:", e)
+        return None
+    print(f"Server (UDP) game channel on {host}:{port}")
+    return usock
+
+# --- sim process: physics in its own process, state in shared memory ---
+# One shared memory block holds a double buffer of snapshots, written by the
+# sim every tick, and a ring of client input records going the other way.
+# The server process keeps all network I/O and encoding; sim_link() moves
+# input into the ring and the newest snapshot into published once per tick.
+SHM_PLAYER_DTYPE = np.dtype([("id", "<u4"), ("x", "<f8"), ("y", "<f8"), ("hp", "<i4"), ("kills", "<i4"),
+                             ("input_seq", "<i8")])  # -1 unless in input mode
+SHM_BULLET_DTYPE = np.dtype([("id", "<u4"), ("x", "<f8"), ("y", "<f8"), ("owner", "<u4"),
+                             ("sx", "<f8"), ("sy", "<f8"), ("vx", "<f8"), ("vy", "<f8"), ("t", "<f8")])  # + spawn row
+SIM_INPUT_DTYPE = np.dtype([("kind", "u1"), ("pid", "<u4"), ("a", "<f8"), ("b", "<f8"), ("c", "<f8")])
+SIM_IN_JOIN, SIM_IN_UPDATE, SIM_IN_SHOOT, SIM_IN_QUIT, SIM_IN_INPUT = 1, 2, 3, 4, 5
+# tick_stats of the sim, copied into shared memory once a second
+SIM_STATS_DTYPE = np.dtype([("ticks", "<u8"), ("overruns", "<u8"), ("dropped", "<u8"), ("max_duration", "<f8"),
+                            ("max_jitter", "<f8"), ("duration_sum", "<f8"), ("hist", "<u8", (len(TICK_BUCKETS) + 1,)),
+                            ("catchup", "<u8", (MAX_CATCHUP_TICKS + 1,)), ("n_durations", "<u4"), ("n_jitters", "<u4"),
+                            ("durations", "<f8", (tick_stats["durations"].maxlen,)),
+                            ("jitters", "<f8", (tick_stats["jitters"].maxlen,))])
+# version is odd while the sim writes the slot; readers retry on a change
+SIM_SLOT_DTYPE = np.dtype([("version", "<u8"), ("tick", "<u8"), ("n_players", "<u4"), ("n_bullets", "<u4"),
+                           ("players", SHM_PLAYER_DTYPE, (SIM_MAX_PLAYERS,)),
+                           ("bullets", SHM_BULLET_DTYPE, (MAX_BULLETS,))])
+SIM_SHM_DTYPE = np.dtype([("current", "<u8"), ("slots", SIM_SLOT_DTYPE, (2,)), ("stats", SIM_STATS_DTYPE),
+                          ("head", "<u8"), ("tail", "<u8"), ("ring", SIM_INPUT_DTYPE, (SIM_RING_SIZE,))])
+
+sim_link_stats = None  # {"snapshots", "torn_reads", "ring_full"} when running with --sim-process
+
+def start_sim_process():
+    # -> (shared memory, its structured view, process) running the physics
+    shm = multiprocessing.shared_memory.SharedMemory(create=True, size=SIM_SHM_DTYPE.itemsize)
+    sh = np.ndarray((), dtype=SIM_SHM_DTYPE, buffer=shm.buf)
+    sh["slots"]["version"] = 0
+    sh["slots"]["tick"] = 0
+    sh["slots"]["n_players"] = 0
+    sh["slots"]["n_bullets"] = 0
+    sh["current"] = sh["head"] = sh["tail"] = 0
+    proc = multiprocessing.Process(target=sim_main, args=(shm,), daemon=True)
+    proc.start()
+    print(f"Simulation running in process {proc.pid}")
+    return shm, sh, proc
+
+def sim_main(shm):
+    # entry point of the sim process: the physics loop and nothing else
+    global sim_shared
+    sim_shared = np.ndarray((), dtype=SIM_SHM_DTYPE, buffer=shm.buf)
+    threading.Thread(target=sim_stats_loop, args=(sim_shared,), daemon=True).start()
+    try:
+        run_physics()
+    except KeyboardInterrupt:
+        pass
+
+def sim_stats_loop(sh):
+    # sim side: share our tick stats, and quit with the server process
+    server = multiprocessing.parent_process()
+    st = sh["stats"]
+    while server.is_alive():
+        s = tick_stats
+        for k in ("ticks", "overruns", "dropped", "max_duration", "max_jitter", "duration_sum", "hist", "catchup"):
+            st[k] = s[k]
+        d, j = list(s["durations"]), list(s["jitters"])
+        st["durations"][:len(d)] = d
+        st["jitters"][:len(j)] = j
+        st["n_durations"], st["n_jitters"] = len(d), len(j)
         time.sleep(1.0)
+    os._exit(0)
+
+def write_shared(sh, tick, bullet_lists):
+    # sim side: write the world into the slot readers are not using, then flip
+    k = 1 - int(sh["current"])
+    slots = sh["slots"]
+    pl = list(players.items())[:SIM_MAX_PLAYERS]
+    ids, xs, ys, owners, spawns = bullet_lists
+    slots["version"][k] += 1
+    rows = slots["players"][k]
+    n = len(pl)
+    rows["id"][:n] = [int(pid) for pid, _ in pl]
+    rows["x"][:n] = [p["x"] for _, p in pl]
+    rows["y"][:n] = [p["y"] for _, p in pl]
+    rows["hp"][:n] = [p["hp"] for _, p in pl]
+    rows["kills"][:n] = [p["kills"] for _, p in pl]
+    rows["input_seq"][:n] = [p.get("input_seq", -1) for _, p in pl]
+    rows = slots["bullets"][k]
+    m = len(ids)
+    rows["id"][:m] = ids
+    rows["x"][:m] = xs
+    rows["y"][:m] = ys
+    rows["owner"][:m] = owners
+    if m:
+        _, sx, sy, vx, vy, t, _ = zip(*spawns)
+        rows["sx"][:m] = sx
+        rows["sy"][:m] = sy
+        rows["vx"][:m] = vx
+        rows["vy"][:m] = vy
+        rows["t"][:m] = t
+    slots["tick"][k] = tick
+    slots["n_players"][k] = n
+    slots["n_bullets"][k] = m
+    slots["version"][k] += 1
+    sh["current"] = k
+
+def read_shared(sh):
+    # server side: -> (tick, player rows, bullet rows) copied out of the
+    # newest slot, or None if the sim kept overwriting it while we read
+    slots = sh["slots"]
+    for _ in range(3):
+        k = int(sh["current"])
+        v = int(slots["version"][k])
+        if v % 2 == 0:
+            tick = int(slots["tick"][k])
+            pl = slots["players"][k][:int(slots["n_players"][k])].copy()
+            bl = slots["bullets"][k][:int(slots["n_bullets"][k])].copy()
+            if int(slots["version"][k]) == v:
+                return tick, pl, bl
+        sim_link_stats["torn_reads"] += 1
+    return None
+
+def push_inputs(sh, backlog):
+    # server side, the only writer of head: move as much of backlog as fits
+    # into the ring. Nothing is dropped; what does not fit waits for the next call.
+    head, tail = int(sh["head"]), int(sh["tail"])
+    n = min(len(backlog), SIM_RING_SIZE - (head - tail))
+    if n < len(backlog):
+        sim_link_stats["ring_full"] += 1
+    if n <= 0:
+        return
+    recs = np.array([backlog.popleft() for _ in range(n)], dtype=SIM_INPUT_DTYPE)
+    ring = sh["ring"]
+    i = head % SIM_RING_SIZE
+    first = min(n, SIM_RING_SIZE - i)
+    ring[i:i + first] = recs[:first]
+    ring[:n - first] = recs[first:]
+    # records first, then the head that makes them visible
+    sh["head"] = head + n
+
+def pull_inputs(sh):
+    # sim side, the only writer of tail: turn the ring's records back into
+    # moves and commands for apply_commands()
+    head, tail = int(sh["head"]), int(sh["tail"])
+    n = head - tail
+    if n <= 0:
+        return
+    ring = sh["ring"]
+    i = tail % SIM_RING_SIZE
+    first = min(n, SIM_RING_SIZE - i)
+    recs = ring[i:i + first].tolist() + ring[:n - first].tolist()
+    sh["tail"] = head
+    for kind, pid, a, b, c in recs:
+        pid = str(pid)
+        if kind == SIM_IN_UPDATE:
+            moves[pid] = (a, b)
+        elif kind == SIM_IN_INPUT:
+            commands.append(("input", pid, int(a), int(b), c))
+        elif kind == SIM_IN_SHOOT:
+            commands.append(("shoot", pid, a, b))
+        elif kind == SIM_IN_JOIN:
+            # name and color stay in the server process
+            commands.append(("join", pid, "", None, bool(a)))
+        elif kind == SIM_IN_QUIT:
+            commands.append(("quit", pid))
+
+def sim_link(sh, proc):
+    # server side of --sim-process, in place of run_physics(): every tick,
+    # forward client input to the sim and publish the sim's newest snapshot.
+    # Returns when the sim process is gone.
+    global published, input_acks, sim_link_stats
+    sim_link_stats = {"snapshots": 0, "torn_reads": 0, "ring_full": 0}
+    step = 1.0 / TICK_RATE
+    meta = {}  # pid -> (name, color); the sim only knows ids
+    gone = set()  # quit players whose meta goes once they left the snapshot
+    backlog = collections.deque()
+    last_tick = 0
+    next_stats = 0.0
+    st = sh["stats"]
+    while proc.is_alive():
+        for pid in list(moves):
+            x, y = moves.pop(pid)
+            backlog.append((SIM_IN_UPDATE, int(pid), x, y, 0.0))
+        for _ in range(len(commands)):
+            cmd = commands.popleft()
+            kind, pid = cmd[0], cmd[1]
+            if kind == "input":
+                backlog.append((SIM_IN_INPUT, int(pid), cmd[2], cmd[3], cmd[4]))
+            elif kind == "shoot":
+                backlog.append((SIM_IN_SHOOT, int(pid), cmd[2], cmd[3], 0.0))
+            elif kind == "join":
+                meta[pid] = (cmd[2], cmd[3])
+                backlog.append((SIM_IN_JOIN, int(pid), float(cmd[4]), 0.0, 0.0))
+            elif kind == "quit":
+                gone.add(pid)
+                backlog.append((SIM_IN_QUIT, int(pid), 0.0, 0.0, 0.0))
+        if backlog:
+            push_inputs(sh, backlog)
+        cur = read_shared(sh)
+        if cur is not None and cur[0] != last_tick:
+            last_tick, pl, bl = cur
+            snap = {}
+            acks = {}
+            for pid, x, y, hp, kills, input_seq in pl.tolist():
+                pid = str(pid)
+                name, color = meta.get(pid, (f"Player{pid}", [255,0,0]))
+                snap[pid] = {"name": name, "x": x, "y": y, "color": color, "hp": hp, "kills": kills}
+                if input_seq >= 0:
+                    acks[pid] = (input_seq, x, y)
+            for pid in [pid for pid in gone if pid not in snap]:
+                gone.discard(pid)
+                meta.pop(pid, None)
+            ids, owners = bl["id"].tolist(), bl["owner"].tolist()
+            spawns = list(zip(ids, bl["sx"].tolist(), bl["sy"].tolist(), bl["vx"].tolist(), bl["vy"].tolist(),
+                              bl["t"].tolist(), owners))
+            published = (last_tick, snap, ids, bl["x"].tolist(), bl["y"].tolist(), owners, spawns)
+            input_acks = acks
+            sim_link_stats["snapshots"] += 1
+        now = time.time()
+        if now >= next_stats:
+            # mirror the sim's tick stats for /metrics and the exit report
+            next_stats = now + 1.0
+            s = tick_stats
+            for k in ("ticks", "overruns", "dropped"):
+                s[k] = int(st[k])
+            for k in ("max_duration", "max_jitter", "duration_sum"):
+                s[k] = float(st[k])
+            s["hist"] = st["hist"].tolist()
+            s["catchup"] = st["catchup"].tolist()
+            s["durations"].clear()
+            s["durations"].extend(st["durations"][:int(st["n_durations"])].tolist())
+            s["jitters"].clear()
+            s["jitters"].extend(st["jitters"][:int(st["n_jitters"])].tolist())
+        time.sleep(step)
+    print("Simulation process exited.")
+
+# --- rooms: independent arenas in worker processes behind one TCP port ---
+
+def start_rooms(n, settings):
+    # start n room processes; -> list of room dicts for room_front()
+    # hand-over pipe (sockets, front -> room) and a separate load report pipe
+    rooms = []
+    for i in range(n):
+        front_end, room_end = multiprocessing.Pipe()
+        report_recv, report_send = multiprocessing.Pipe(duplex=False)
+        proc = multiprocessing.Process(target=room_main, args=(i, room_end, report_send, settings), daemon=True)
+        proc.start()
+        room_end.close()
+        report_send.close()
+        room = {"index": i, "proc": proc, "pipe": front_end, "reports": report_recv, "lock": threading.Lock(),
+                "players": 0, "handed": 0, "received": 0,
+                "healthy": True, "tick_p99_ms": 0.0}
+        rooms.append(room)
+        threading.Thread(target=room_reports, args=(room,), daemon=True).start()
+    return rooms
+
+def room_reports(room):
+    # front side: load reports from one room process
+    while True:
+        try:
+            msg = room["reports"].recv()
+        except (EOFError, OSError):
+            print(f"Room {room['index']} process exited")
+            room["players"] = float("inf")  # never pick it again
+            return
+        if msg[0] == "load":
+            _, room["players"], room["received"], room["healthy"], room["tick_p99_ms"] = msg
+
+def pick_room(rooms):
+    # least players, counting handed over connections the room has not reported yet
+    return min(rooms, key=lambda r: r["players"] + r["handed"] - r["received"])
+
+def room_front(sock, rooms):
+    print(f"Server (TCP) listening on {HOST}:{PORT}, {len(rooms)} rooms")
+    while True:
+        try:
+            conn, addr = sock.accept()
+        except OSError as e:
+            print("Accept error:", e)
+            continue
+        threading.Thread(target=hand_over, args=(conn, addr, rooms), daemon=True).start()
+
+def hand_over(conn, addr, rooms):
+    # read the join line, then pass the socket and what was read to a room
+    conn.settimeout(JOIN_TIMEOUT)
+    buf = b""
+    join = None
+    try:
+        while join is None:
+            lines, buf = recv_lines(conn, buf)
+            if lines is None:
+                conn.close()
+                return
+            for i, line in enumerate(lines):
+                try:
+                    msg = json.loads(line)
+                except Exception:
+                    continue
+                if isinstance(msg, dict) and msg.get("type") == "join":
+                    # lines after the join go along with the raw bytes
+                    join = msg
+                    buf = b"".join(l.encode('utf-8') + b"\n" for l in lines[i + 1:]) + buf
+                    break
+        conn.settimeout(None)
+        room = pick_room(rooms)
+        with room["lock"]:
+            if hasattr(conn, "share"):
+                # Windows sockets are duplicated with share()/fromshare()
+                room["pipe"].send(conn.share(room["proc"].pid))
+            else:
+                multiprocessing.reduction.send_handle(room["pipe"], conn.fileno(), room["proc"].pid)
+            room["pipe"].send((join, buf, addr))
+            room["handed"] += 1
+        print(f"Client {addr} joined room {room['index']}")
+    except (OSError, ValueError) as e:
+        print("Hand-over failed for", addr, e)
+    conn.close()
+
+def room_main(index, pipe, reports, settings):
+    # entry point of a room process: a complete arena (physics, broadcast,
+    # reaper, its own UDP port) whose clients arrive from the front process
+    global udp_sock, HOST, UDP_PORT, AOI_RADIUS, COMPRESSION, BROADCAST_FPS, recorder
+    HOST, AOI_RADIUS, COMPRESSION = settings["host"], settings["aoi_radius"], settings["compress"]
+    BROADCAST_FPS = settings["broadcast_fps"]
+    UDP_PORT = settings["udp_port"] + index if settings["udp_port"] else 0
+    print(f"Room {index} running in process {os.getpid()}")
+    if settings["record"]:
+        recorder = Recorder(f"{settings['record']}.{index}")
+    udp_sock = open_udp(HOST, UDP_PORT)
+    start_metrics(settings["metrics_port"] + index if settings["metrics_port"] else 0)
+    if udp_sock is not None:
+        threading.Thread(target=udp_loop, args=(udp_sock,), daemon=True).start()
+    threading.Thread(target=broadcast_loop, daemon=True).start()
+    threading.Thread(target=reap_inactive, daemon=True).start()
+    threading.Thread(target=room_intake, args=(pipe, reports), daemon=True).start()
+    try:
+        run_physics()
+    except KeyboardInterrupt:
+        pass
+
+def room_intake(pipe, reports):
+    # room side: take over sockets from the front, report our load back
+    received = 0
+    next_report = 0.0
+    last = {}
+    front = multiprocessing.parent_process()
+    while True:
+        try:
+            if pipe.poll(ROOM_REPORT_INTERVAL):
+                if hasattr(socket, "fromshare"):
+                    conn = socket.fromshare(pipe.recv())
+                else:
+                    conn = socket.socket(fileno=multiprocessing.reduction.recv_handle(pipe))
+                join, buf, addr = pipe.recv()
+                received += 1
+                threading.Thread(target=handle_client, args=(conn, addr, join, buf), daemon=True).start()
+            now = time.time()
+            if now >= next_report:
+                next_report = now + ROOM_REPORT_INTERVAL
+                if not front.is_alive():
+                    # forked rooms also hold the front's end of the pipe, so EOF alone cannot tell
+                    os._exit(0)
+                with clients_lock:
+                    n = len(clients)
+                reports.send(("load", n, received) + tick_health(last))
+        except (EOFError, OSError):
+            # front process is gone, and with it every way in
+            os._exit(0)
 
 def main():
+    global udp_sock, HOST, PORT, UDP_PORT, AOI_RADIUS, COMPRESSION, MAX_PLAYERS, BROADCAST_FPS, recorder
+    ap = argparse.ArgumentParser(description="PyArena LAN server")
+    ap.add_argument("--host", default=HOST)
+    ap.add_argument("--port", type=int, default=PORT)
+    ap.add_argument("--udp-port", type=int, default=UDP_PORT, help="UDP game channel port (0 disables it)")
+    ap.add_argument("--aoi-radius", type=float, default=AOI_RADIUS,
+                    help="only send each client the entities within this many px of its player (0 = everything)")
+    ap.add_argument("--asyncio", action="store_true", help="serve clients from one asyncio event loop instead of a thread per client")
+    ap.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                    help="local HTTP port for /metrics and /metrics.json (0 disables it; rooms use port + room index)")
+    ap.add_argument("--rooms", type=int, default=1,
+                    help="run this many independent arenas, one process each; players go to the least loaded one")
+    ap.add_argument("--record", metavar="PATH",
+                    help="record every broadcast snapshot to PATH (and an index to PATH.idx) for arena_replay.py; rooms use PATH.<room index>")
+    ap.add_argument("--broadcast-fps", type=float, default=BROADCAST_FPS,
+                    help="snapshots per second sent to each client (clients interpolate between them)")
+    ap.add_argument("--capacity", type=int, default=MAX_PLAYERS,
+                    help="players this server announces room for (per room with --rooms)")
+    ap.add_argument("--compress", action="store_true",
+                    help="let clients that ask for it receive a zlib-compressed TCP stream")
+    ap.add_argument("--sim-process", action="store_true",
+                    help="run the physics in its own process, sharing state with the network side through shared memory")
+    args = ap.parse_args()
+    if args.rooms > 1 and args.asyncio:
+        ap.error("--asyncio is not supported together with --rooms")
+    if args.rooms > 1 and args.sim_process:
+        ap.error("--sim-process is not supported together with --rooms")
+    HOST, PORT, UDP_PORT = args.host, args.port, args.udp_port
+    AOI_RADIUS = args.aoi_radius
+    COMPRESSION = args.compress
+    MAX_PLAYERS = args.capacity
+    BROADCAST_FPS = args.broadcast_fps
+
+    rooms = None
+    if args.rooms > 1:
+        # started first, so forked rooms do not inherit the listening socket
+        rooms = start_rooms(args.rooms, {"host": HOST, "udp_port": UDP_PORT, "aoi_radius": AOI_RADIUS,
+                                         "metrics_port": args.metrics_port, "record": args.record,
+                                         "compress": args.compress, "broadcast_fps": BROADCAST_FPS})
+
+    sim = None
+    if args.sim_process:
+        # same here: no listening socket or threads in the forked sim
+        sim = start_sim_process()
+
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     sock.bind((HOST, PORT))
     sock.listen(100)
 
-    t = threading.Thread(target=accept_thread, args=(sock,), daemon=True)
-    t.start()
-    b = threading.Thread(target=broadcast_loop, daemon=True)
-    b.start()
-    r = threading.Thread(target=reap_inactive, daemon=True)
-    r.start()
+    if rooms:
+        # this process only hands connections to the room processes
+        d = threading.Thread(target=discovery_beacon, args=(rooms,), daemon=True)
+        d.start()
+        try:
+            room_front(sock, rooms)
+        except KeyboardInterrupt:
+            print("Shutting down server.")
+            sock.close()
+            for room in rooms:
+                room["proc"].terminate()
+        return
+
+    udp_sock = open_udp(HOST, UDP_PORT)
+    start_metrics(args.metrics_port)
+    if args.record:
+        recorder = Recorder(args.record)
+
     d = threading.Thread(target=discovery_beacon, daemon=True)
     d.start()
 
-    # physics loop
-    last = time.time()
+    if args.asyncio:
+        a = threading.Thread(target=asyncio.run, args=(serve_async(sock),), daemon=True)
+        a.start()
+    else:
+        if udp_sock is not None:
+            u = threading.Thread(target=udp_loop, args=(udp_sock,), daemon=True)
+            u.start()
+        t = threading.Thread(target=accept_thread, args=(sock,), daemon=True)
+        t.start()
+        b = threading.Thread(target=broadcast_loop, daemon=True)
+        b.start()
+        r = threading.Thread(target=reap_inactive, daemon=True)
+        r.start()
+
     try:
-        while True:
-            now = time.time()
-            dt = now - last
-            if dt <= 0:
-                time.sleep(0.001)
-                continue
-            # We can run multiple physics ticks if we fell behind
-            max_step = 1.0 / TICK_RATE
-            while dt > 0:
-                step = min(max_step, dt)
-                physics_tick(step)
-                dt -= step
-            last = now
-            time.sleep(0.001)
+        if sim:
+            sim_link(sim[1], sim[2])
+        else:
+            run_physics()
     except KeyboardInterrupt:
+        print(format_tick_stats())
         print("Shutting down server.")
         sock.close()
+    finally:
+        if sim:
+            sim[0].unlink()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file